@@ -0,0 +1,590 @@
+#!/bin/python3
+"""
+End-to-end capacity benchmark.
+
+Boots the full application (src/samowarium.py) against the Postgres from the
+environment and the local Samoware and Telegram simulators, seeds N users,
+sends them letters and measures how fast the letters reach Telegram. Every
+step of --users is a separate run, the report is written as JSON.
+
+The database is shared with the seeded users only: users with the loadtest
+login prefix are removed before and after every step. Values of a .env file
+in the working directory override the ones set here, so keep SAMOWARE_URL,
+SAMOWARE_LOGIN_URL, TELEGRAM_API_URL and ENCRYPTION out of it.
+"""
+
+import argparse
+import asyncio
+import json
+import logging as log
+import os
+import random
+import secrets
+import signal
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import aiohttp
+from prometheus_client.parser import text_string_to_metric_families
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_PATH, "src"))
+# migrations and .env are looked up in the working directory, like for the bot
+os.chdir(ROOT_PATH)
+
+from context import Context  # noqa: E402
+from database import Database  # noqa: E402
+from encryption import Encrypter  # noqa: E402
+from samoware_api import SamowarePollingContext  # noqa: E402
+
+LOGIN_PREFIX = "loadtest-"
+PASSWORD = "loadtest"
+TELEGRAM_ID_BASE = 900_000_000
+# matches the samoware session format, so the bot relogins with the password
+STALE_SESSION = "000000-" + "0" * 20
+SEED_CONCURRENCY = 8
+SAMPLE_INTERVAL_SEC = 1
+SIMULATOR_START_TIMEOUT_SEC = 10
+BOT_STOP_TIMEOUT_SEC = 30
+LATENCY_PERCENTILES = (50, 90, 95, 99)
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def percentile(values: list[float], p: float) -> float | None:
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def summarize(values: list[float]) -> dict:
+    summary = {f"p{p}": percentile(values, p) for p in LATENCY_PERCENTILES}
+    summary["max"] = max(values) if len(values) > 0 else None
+    summary["mean"] = sum(values) / len(values) if len(values) > 0 else None
+    return summary
+
+
+def count_difference(after: dict, before: dict) -> dict:
+    difference = {key: value - before.get(key, 0) for key, value in after.items()}
+    return {key: value for key, value in difference.items() if value != 0}
+
+
+def histogram_percentile(buckets: list[tuple[float, float]], p: float) -> float | None:
+    # buckets are cumulative (upper bound, count) pairs
+    if len(buckets) == 0 or buckets[-1][1] == 0:
+        return None
+    rank = buckets[-1][1] * p / 100
+    finite_bound = None
+    for bound, count in buckets:
+        if count >= rank:
+            # the +Inf bucket is reported by its lower bound
+            return bound if bound != float("inf") else finite_bound
+        finite_bound = bound
+    return finite_bound
+
+
+class ProcessSampler:
+    """Reads cpu, memory and sockets of a process and its children from /proc."""
+
+    def __init__(self, pid: int) -> None:
+        self.pid = pid
+
+    def get_tree(self) -> list[int]:
+        children: dict[int, list[int]] = {}
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                with open(f"/proc/{name}/stat") as file:
+                    # the command may contain spaces, the fields follow its ')'
+                    fields = file.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            children.setdefault(int(fields[1]), []).append(int(name))
+        tree = [self.pid]
+        for pid in tree:
+            tree.extend(children.get(pid, []))
+        return tree
+
+    def sample(self) -> dict:
+        cpu_sec = 0.0
+        rss_bytes = 0
+        sockets = 0
+        for pid in self.get_tree():
+            try:
+                with open(f"/proc/{pid}/stat") as file:
+                    fields = file.read().rsplit(")", 1)[1].split()
+                # utime and stime, the state is the first field after ')'
+                cpu_sec += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+                rss_bytes += int(fields[21]) * PAGE_SIZE
+                for fd in os.listdir(f"/proc/{pid}/fd"):
+                    try:
+                        if os.readlink(f"/proc/{pid}/fd/{fd}").startswith("socket:"):
+                            sockets += 1
+                    except OSError:
+                        pass
+            except OSError:
+                continue
+        return {"cpu_sec": cpu_sec, "rss_bytes": rss_bytes, "sockets": sockets}
+
+
+class Benchmark:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.samoware_url = f"http://127.0.0.1:{args.samoware_port}"
+        self.telegram_url = f"http://127.0.0.1:{args.telegram_port}"
+        self.metrics_url = f"http://127.0.0.1:{args.metrics_port}/metrics"
+        # the bot and the seeding share the key
+        os.environ.setdefault("ENCRYPTION", secrets.token_hex(16))
+        self.db = Database(Encrypter())
+        self.http: aiohttp.ClientSession | None = None
+        self.simulators: list[subprocess.Popen] = []
+
+    async def run(self) -> dict:
+        await self.db.open()
+        self.http = aiohttp.ClientSession()
+        try:
+            self.start_simulators()
+            await self.wait_simulators()
+            steps = []
+            for users in self.args.users:
+                log.info(f"running the step with {users} users...")
+                steps.append(await self.run_step(users))
+                log.info(f"step with {users} users: {json.dumps(steps[-1]['summary'])}")
+            return {
+                "started_at": datetime.now(timezone.utc).isoformat(),
+                "commit": get_commit(),
+                "params": {
+                    key: value for key, value in vars(self.args).items() if key != "env"
+                },
+                "env": self.args.env,
+                "steps": steps,
+            }
+        finally:
+            await self.remove_users()
+            await self.http.close()
+            for simulator in self.simulators:
+                simulator.terminate()
+            await self.db.close()
+
+    def start_simulators(self) -> None:
+        # the simulators get their own processes, so their load is not measured
+        self.simulators.append(
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    os.path.join(ROOT_PATH, "loadtest", "samoware_simulator.py"),
+                    "--port",
+                    str(self.args.samoware_port),
+                    "--latency-ms",
+                    str(self.args.samoware_latency_ms),
+                    "--error-rate",
+                    str(self.args.samoware_error_rate),
+                ]
+            )
+        )
+        self.simulators.append(
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    os.path.join(ROOT_PATH, "loadtest", "telegram_simulator.py"),
+                    "--port",
+                    str(self.args.telegram_port),
+                    "--latency-ms",
+                    str(self.args.telegram_latency_ms),
+                    "--global-rate",
+                    str(self.args.telegram_global_rate),
+                ]
+            )
+        )
+
+    async def wait_simulators(self) -> None:
+        deadline = time.monotonic() + SIMULATOR_START_TIMEOUT_SEC
+        for url in (self.samoware_url, self.telegram_url):
+            while True:
+                try:
+                    async with self.http.get(f"{url}/_control/stats") as response:
+                        if response.status == 200:
+                            break
+                except aiohttp.ClientError:
+                    pass
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"simulator at {url} has not started")
+                await asyncio.sleep(0.2)
+
+    async def get_stats(self, url: str, query: str = "") -> dict:
+        async with self.http.get(f"{url}/_control/stats{query}") as response:
+            return await response.json()
+
+    # users
+
+    def get_login(self, index: int) -> str:
+        return f"{LOGIN_PREFIX}{index}"
+
+    async def remove_users(self) -> None:
+        async with self.db.pool.connection() as conn:
+            await conn.execute(
+                "DELETE FROM users WHERE samoware_login LIKE %s", (LOGIN_PREFIX + "%",)
+            )
+            await conn.commit()
+
+    async def seed_users(self, count: int) -> None:
+        semaphore = asyncio.Semaphore(SEED_CONCURRENCY)
+
+        async def seed(index: int) -> None:
+            async with semaphore:
+                telegram_id = TELEGRAM_ID_BASE + index
+                await self.db.add_user(
+                    telegram_id,
+                    Context(
+                        telegram_id,
+                        self.get_login(index),
+                        SamowarePollingContext(session=STALE_SESSION),
+                    ),
+                )
+                await self.db.set_password(telegram_id, PASSWORD)
+
+        await self.remove_users()
+        await asyncio.gather(*[seed(index) for index in range(count)])
+
+    # bot
+
+    def start_bot(self) -> subprocess.Popen:
+        bot_env = dict(os.environ)
+        bot_env.update(
+            {
+                "SAMOWARE_URL": self.samoware_url,
+                "SAMOWARE_LOGIN_URL": self.samoware_url,
+                "TELEGRAM_API_URL": self.telegram_url,
+                "TELEGRAM_TOKEN": os.environ.get("TELEGRAM_TOKEN", "1:loadtest"),
+                "ENABLE_PROMETHEUS_METRICS_SERVER": "1",
+                "PROMETHEUS_METRICS_SERVER_PORT": str(self.args.metrics_port),
+                "LOOP_MONITOR": "1",
+            }
+        )
+        for variable in self.args.env:
+            (name, value) = variable.split("=", 1)
+            bot_env[name] = value
+        return subprocess.Popen(
+            [sys.executable, os.path.join(ROOT_PATH, "src", "samowarium.py")],
+            cwd=ROOT_PATH,
+            env=bot_env,
+        )
+
+    async def stop_bot(self, bot: subprocess.Popen) -> None:
+        bot.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.to_thread(bot.wait, BOT_STOP_TIMEOUT_SEC)
+        except subprocess.TimeoutExpired:
+            log.warning("the bot has not stopped in time, killing it")
+            bot.kill()
+            await asyncio.to_thread(bot.wait)
+
+    async def wait_online(self, users: int) -> float | None:
+        started_at = time.monotonic()
+        while time.monotonic() - started_at < self.args.startup_timeout_sec:
+            stats = await self.get_stats(self.samoware_url)
+            if stats["polling_mailboxes"] >= users:
+                return time.monotonic() - started_at
+            await asyncio.sleep(SAMPLE_INTERVAL_SEC)
+        log.warning(f"not every user is online in {self.args.startup_timeout_sec}s")
+        return None
+
+    # sampling
+
+    async def get_db_queries(self) -> tuple[str, int]:
+        async with self.db.pool.connection() as conn:
+            try:
+                cursor = await conn.execute(
+                    "SELECT sum(calls)::bigint FROM pg_stat_statements"
+                )
+                return ("statements", (await cursor.fetchone())[0] or 0)
+            except Exception:
+                # without pg_stat_statements the transactions are counted
+                await conn.rollback()
+                cursor = await conn.execute(
+                    "SELECT xact_commit + xact_rollback FROM pg_stat_database WHERE datname = current_database()"
+                )
+                return ("transactions", (await cursor.fetchone())[0])
+
+    async def get_loop_lag(self) -> list[tuple[float, float]] | None:
+        try:
+            async with self.http.get(self.metrics_url) as response:
+                text = await response.text()
+        except aiohttp.ClientError:
+            return None
+        for family in text_string_to_metric_families(text):
+            if family.name == "event_loop_lag_sec":
+                return [
+                    (float(sample.labels["le"]), sample.value)
+                    for sample in family.samples
+                    if sample.name.endswith("_bucket")
+                ]
+        return None
+
+    async def sample(self, sampler: ProcessSampler) -> dict:
+        (db_source, db_queries) = await self.get_db_queries()
+        return {
+            "at": time.time(),
+            **sampler.sample(),
+            "db_source": db_source,
+            "db_queries": db_queries,
+            "loop_lag_buckets": await self.get_loop_lag(),
+        }
+
+    # load
+
+    async def generate_mail(self, users: int, stop: asyncio.Event) -> int:
+        sent = 0
+        # poisson arrivals for all the users together
+        rate = users * self.args.letters_per_user_hour / 3600
+        next_mass_mail_at = time.monotonic() + (self.args.mass_mail_every_sec or 0)
+        while not stop.is_set():
+            await asyncio.sleep(random.expovariate(max(rate, 1e-9)))
+            letter = {
+                "text": "Текст письма. " * (self.args.text_size // 14 + 1),
+                "attachments": self.args.attachments,
+            }
+            if (
+                self.args.mass_mail_every_sec is not None
+                and time.monotonic() >= next_mass_mail_at
+            ):
+                # a mailing list letter reaches everyone at once
+                next_mass_mail_at += self.args.mass_mail_every_sec
+                letter["logins"] = [self.get_login(index) for index in range(users)]
+                letter["subject"] = "Рассылка"
+            else:
+                letter["login"] = self.get_login(random.randrange(users))
+            if stop.is_set():
+                break
+            async with self.http.post(
+                f"{self.samoware_url}/_control/mail", json=letter
+            ) as response:
+                sent += len((await response.json())["delivered"])
+        return sent
+
+    async def run_step(self, users: int) -> dict:
+        await self.seed_users(users)
+        bot = self.start_bot()
+        sampler = ProcessSampler(bot.pid)
+        try:
+            startup_sec = await self.wait_online(users)
+            await asyncio.sleep(self.args.warmup_sec)
+            samoware_before = await self.get_stats(self.samoware_url, "?arrivals")
+            telegram_before = await self.get_stats(self.telegram_url)
+            samples = [await self.sample(sampler)]
+            stop = asyncio.Event()
+            generator = asyncio.create_task(self.generate_mail(users, stop))
+            measure_until = time.monotonic() + self.args.duration_sec
+            while time.monotonic() < measure_until:
+                await asyncio.sleep(SAMPLE_INTERVAL_SEC)
+                samples.append(await self.sample(sampler))
+            stop.set()
+            sent = await generator
+            # the letters sent at the end are still delivered
+            drain_until = time.monotonic() + self.args.drain_sec
+            while time.monotonic() < drain_until:
+                telegram = await self.get_stats(self.telegram_url)
+                if telegram["letters"] - telegram_before["letters"] >= sent:
+                    break
+                await asyncio.sleep(SAMPLE_INTERVAL_SEC)
+            samoware = await self.get_stats(self.samoware_url, "?arrivals")
+            telegram = await self.get_stats(self.telegram_url, "?deliveries")
+        finally:
+            await self.stop_bot(bot)
+        return self.make_report(
+            users,
+            startup_sec,
+            sent,
+            samples,
+            samoware_before,
+            samoware,
+            telegram_before,
+            telegram,
+        )
+
+    def make_report(
+        self,
+        users: int,
+        startup_sec: float | None,
+        sent: int,
+        samples: list[dict],
+        samoware_before: dict,
+        samoware: dict,
+        telegram_before: dict,
+        telegram: dict,
+    ) -> dict:
+        arrivals = {
+            marker: arrived_at
+            for marker, arrived_at in samoware["arrivals"].items()
+            if marker not in samoware_before["arrivals"]
+        }
+        latencies = []
+        duplicates = 0
+        for marker, arrived_at in arrivals.items():
+            received = telegram["deliveries"].get(marker, [])
+            if len(received) > 0:
+                latencies.append(min(received) - arrived_at)
+            if len(received) > 1:
+                duplicates += 1
+        (first, last) = (samples[0], samples[-1])
+        elapsed = last["at"] - first["at"]
+        lag_buckets = None
+        if (
+            first["loop_lag_buckets"] is not None
+            and last["loop_lag_buckets"] is not None
+        ):
+            lag_buckets = [
+                (bound, count - before_count)
+                for ((bound, count), (_, before_count)) in zip(
+                    last["loop_lag_buckets"], first["loop_lag_buckets"]
+                )
+            ]
+        return {
+            "users": users,
+            "startup_sec": startup_sec,
+            "summary": {
+                "letters_per_sec": len(latencies) / elapsed if elapsed > 0 else None,
+                "latency_p50_sec": percentile(latencies, 50),
+                "latency_p99_sec": percentile(latencies, 99),
+                "cpu_percent": (
+                    100 * (last["cpu_sec"] - first["cpu_sec"]) / elapsed
+                    if elapsed > 0
+                    else None
+                ),
+                "rss_max_mb": max(sample["rss_bytes"] for sample in samples) / 2**20,
+            },
+            "letters": {
+                "sent": sent,
+                "delivered": len(latencies),
+                "lost": len(arrivals) - len(latencies),
+                "duplicated": duplicates,
+            },
+            "latency_sec": summarize(latencies),
+            "process": {
+                "cpu_sec": last["cpu_sec"] - first["cpu_sec"],
+                "rss_max_bytes": max(sample["rss_bytes"] for sample in samples),
+                "rss_end_bytes": last["rss_bytes"],
+                "sockets_max": max(sample["sockets"] for sample in samples),
+            },
+            "db": {
+                "source": last["db_source"],
+                "queries_per_sec": (
+                    (last["db_queries"] - first["db_queries"]) / elapsed
+                    if elapsed > 0
+                    else None
+                ),
+            },
+            "loop_lag_sec": (
+                None
+                if lag_buckets is None
+                else {
+                    f"p{p}": histogram_percentile(lag_buckets, p)
+                    for p in LATENCY_PERCENTILES
+                }
+            ),
+            "telegram": {
+                "requests": count_difference(
+                    telegram["requests"], telegram_before["requests"]
+                ),
+                "errors": count_difference(
+                    telegram["errors"], telegram_before["errors"]
+                ),
+            },
+            "samoware": {
+                "requests": count_difference(
+                    samoware["requests"], samoware_before["requests"]
+                ),
+            },
+            "samples": [
+                {
+                    key: value
+                    for key, value in sample.items()
+                    if key not in ("loop_lag_buckets", "db_source")
+                }
+                for sample in samples
+            ],
+        }
+
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT_PATH,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--users",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000],
+        help="a step for every value",
+    )
+    parser.add_argument("--letters-per-user-hour", type=float, default=2)
+    parser.add_argument(
+        "--mass-mail-every-sec",
+        type=float,
+        default=None,
+        help="a letter to every user at once",
+    )
+    parser.add_argument("--text-size", type=int, default=2000)
+    parser.add_argument(
+        "--attachments",
+        type=int,
+        nargs="*",
+        default=[],
+        help="attachment sizes in bytes",
+    )
+    parser.add_argument("--duration-sec", type=float, default=120)
+    parser.add_argument("--warmup-sec", type=float, default=10)
+    parser.add_argument("--drain-sec", type=float, default=60)
+    parser.add_argument("--startup-timeout-sec", type=float, default=600)
+    parser.add_argument("--samoware-port", type=int, default=8090)
+    parser.add_argument("--samoware-latency-ms", type=float, default=50)
+    parser.add_argument("--samoware-error-rate", type=float, default=0)
+    parser.add_argument("--telegram-port", type=int, default=8081)
+    parser.add_argument("--telegram-latency-ms", type=float, default=30)
+    parser.add_argument("--telegram-global-rate", type=float, default=30)
+    parser.add_argument("--metrics-port", type=int, default=53900)
+    parser.add_argument(
+        "--env", nargs="*", default=[], help="NAME=VALUE for the bot, e.g. WORKERS=4"
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="relative to the repository root (loadtest/results/<time>-<commit>.json, if not set)",
+    )
+    return parser
+
+
+async def main(args: argparse.Namespace) -> None:
+    report = await Benchmark(args).run()
+    output = args.output
+    if output is None:
+        output = os.path.join(
+            ROOT_PATH,
+            "loadtest",
+            "results",
+            f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{report['commit']}.json",
+        )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(report, file, ensure_ascii=False, indent=2)
+    log.info(f"the report is written to {output}")
+
+
+if __name__ == "__main__":
+    log.basicConfig(level=log.INFO)
+    asyncio.run(main(make_parser().parse_args()))
@@ -0,0 +1,512 @@
+#!/bin/python3
+"""
+Samoware (CommuniGate XIMSS) stand-in for load and integration tests.
+
+Serves the endpoints used by src/samoware_api.py: /XIMSSLogin/, the session
+long poll, /sync commands, sessionadmin.wcgp, FORMAT/Samoware letter pages
+and attachment refs. Letters are delivered by the /_control API or by the
+mail generator, faults are injected by rates that can be changed at runtime.
+
+Point the bot at it with SAMOWARE_URL and SAMOWARE_LOGIN_URL.
+"""
+
+import argparse
+import asyncio
+import logging as log
+import random
+import string
+import time
+import xml.etree.ElementTree as ET
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from html import escape
+
+from aiohttp import web
+
+FOLDER = "INBOX-MM-1"
+WRONG_PASSWORD_PREFIX = "wrong"
+LOCAL_TIMEZONE = timezone(timedelta(hours=3))
+# the samoware page carries a lot of ui around the letter
+PAGE_CHROME = "<div class='samoware-ui'>" + "&nbsp;" * 30000 + "</div>"
+LETTER_MARKER_FORMAT = "[loadtest:{}:{}]"
+
+
+class Faults:
+    def __init__(self) -> None:
+        # probabilities per request
+        self.error_rate = 0.0
+        self.expire_rate = 0.0
+        self.drop_rate = 0.0
+        self.slow_rate = 0.0
+        self.slow_sec = 10.0
+
+    def update(self, values: dict) -> None:
+        for key, value in values.items():
+            if hasattr(self, key):
+                setattr(self, key, float(value))
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+
+class Letter:
+    def __init__(
+        self,
+        uid: int,
+        login: str,
+        sender: str,
+        subject: str,
+        text: str,
+        attachments: list[int],
+    ) -> None:
+        self.uid = uid
+        self.arrived_at = datetime.now(timezone.utc)
+        self.sender = sender
+        self.subject = f"{subject} {LETTER_MARKER_FORMAT.format(login, uid)}"
+        self.text = text
+        self.attachments = attachments
+        self.flags = "Recent"
+
+    def size(self) -> int:
+        return len(self.text.encode()) + sum(self.attachments)
+
+    def to_report(self, login: str) -> str:
+        local_time = self.arrived_at.astimezone(LOCAL_TIMEZONE)
+        return (
+            f'<folderReport folder="{FOLDER}" mode="added" UID="{self.uid}">'
+            f"<FLAGS>{self.flags}</FLAGS>"
+            f'<E-From realName="{escape(self.sender)}">sender@example.com</E-From>'
+            f"<Subject>{escape(self.subject)}</Subject>"
+            f'<INTERNALDATE localTime="{local_time.strftime("%Y%m%dT%H%M%S")}">'
+            f'{self.arrived_at.strftime("%Y%m%dT%H%M%SZ")}</INTERNALDATE>'
+            f"<SIZE>{self.size()}</SIZE>"
+            f'<E-To realName="{escape(login)}">{escape(login)}@student.bmstu.ru</E-To>'
+            "</folderReport>"
+        )
+
+
+class Mailbox:
+    def __init__(self, login: str) -> None:
+        self.login = login
+        self.letters: dict[int, Letter] = {}
+        self.next_uid = 1
+
+    def max_uid(self) -> int:
+        return self.next_uid - 1
+
+
+class Session:
+    def __init__(self, login: str, ttl_sec: float) -> None:
+        self.id = "".join(random.choices(string.digits, k=6)) + "-"
+        self.id += "".join(random.choices(string.ascii_letters + string.digits, k=20))
+        self.login = login
+        self.ttl_sec = ttl_sec
+        self.last_seen = time.monotonic()
+        self.is_expired = False
+        self.known_uid = 0
+        self.resp_seq = 0
+        self.last_response = "<XIMSS/>"
+        self.has_notify = False
+        self.is_polling = False
+        self.wakeup = asyncio.Event()
+
+    def is_alive(self) -> bool:
+        return not self.is_expired and time.monotonic() - self.last_seen < self.ttl_sec
+
+    def touch(self) -> None:
+        self.last_seen = time.monotonic()
+
+
+class SamowareSimulator:
+    def __init__(
+        self,
+        latency_ms: float = 50,
+        session_ttl_sec: float = 300,
+        seed: int | None = None,
+    ) -> None:
+        if seed is not None:
+            random.seed(seed)
+        self.latency_ms = latency_ms
+        self.session_ttl_sec = session_ttl_sec
+        self.faults = Faults()
+        self.mailboxes: dict[str, Mailbox] = {}
+        self.sessions: dict[str, Session] = {}
+        self.requests = Counter()
+        self.bytes_sent = 0
+        self.app = web.Application(middlewares=[self.simulate])
+        self.app.router.add_get("/XIMSSLogin/", self.login)
+        self.app.router.add_get("/Session/{session}/", self.longpoll)
+        self.app.router.add_route("*", "/Session/{session}/sync", self.sync)
+        self.app.router.add_post(
+            "/Session/{session}/sessionadmin.wcgp", self.session_admin
+        )
+        self.app.router.add_get(
+            "/Session/{session}/FORMAT/Samoware/{folder}/{uid}", self.letter_page
+        )
+        self.app.router.add_get(
+            "/Session/{session}/attachments/{uid}/{index}", self.attachment
+        )
+        self.app.router.add_post("/_control/mail", self.control_mail)
+        self.app.router.add_post("/_control/faults", self.control_faults)
+        self.app.router.add_post("/_control/expire", self.control_expire)
+        self.app.router.add_get("/_control/stats", self.control_stats)
+
+    # scripting
+
+    def get_mailbox(self, login: str) -> Mailbox:
+        if login not in self.mailboxes:
+            self.mailboxes[login] = Mailbox(login)
+        return self.mailboxes[login]
+
+    def deliver(
+        self,
+        login: str,
+        subject: str = "Письмо",
+        text: str = "Текст письма",
+        sender: str = "Отправитель",
+        attachments: list[int] | None = None,
+    ) -> Letter:
+        mailbox = self.get_mailbox(login)
+        letter = Letter(
+            mailbox.next_uid, login, sender, subject, text, attachments or []
+        )
+        mailbox.letters[letter.uid] = letter
+        mailbox.next_uid += 1
+        for session in self.sessions.values():
+            if session.login == login and session.is_alive():
+                session.has_notify = True
+                session.wakeup.set()
+        return letter
+
+    def mass_mail(
+        self, logins: list[str] | None = None, **letter
+    ) -> list[tuple[str, Letter]]:
+        # a mailing list letter reaches every mailbox at once
+        if logins is None:
+            logins = list(self.mailboxes)
+        return [(login, self.deliver(login, **letter)) for login in logins]
+
+    def expire(self, login: str | None = None) -> int:
+        expired = 0
+        for session in self.sessions.values():
+            if login is None or session.login == login:
+                session.is_expired = True
+                session.wakeup.set()
+                expired += 1
+        return expired
+
+    async def generate_mail(
+        self, letters_per_minute: float, text_size: int, attachments: list[int]
+    ) -> None:
+        # a poisson arrival for every known mailbox
+        while True:
+            await asyncio.sleep(random.expovariate(max(letters_per_minute, 1e-9) / 60))
+            if len(self.mailboxes) == 0:
+                continue
+            login = random.choice(list(self.mailboxes))
+            self.deliver(
+                login,
+                text="Текст письма. " * (text_size // 14 + 1),
+                attachments=attachments,
+            )
+
+    # simulation
+
+    @web.middleware
+    async def simulate(self, request: web.Request, handler):
+        if request.path.startswith("/_control/"):
+            return await handler(request)
+        resource = request.match_info.route.resource
+        self.requests[resource.canonical if resource is not None else "unknown"] += 1
+        is_longpoll = request.match_info.route.handler == self.longpoll
+        if not is_longpoll:
+            # lognormal latency with the given median
+            await asyncio.sleep(random.lognormvariate(0, 0.5) * self.latency_ms / 1000)
+        if random.random() < self.faults.slow_rate:
+            await asyncio.sleep(self.faults.slow_sec)
+        if random.random() < self.faults.drop_rate:
+            request.transport.close()
+            raise web.HTTPInternalServerError()
+        if random.random() < self.faults.error_rate:
+            return web.Response(status=500, text="simulated error")
+        session_id = request.match_info.get("session")
+        if session_id is not None:
+            session = self.sessions.get(session_id)
+            if session is not None and random.random() < self.faults.expire_rate:
+                session.is_expired = True
+            if session is None or not session.is_alive():
+                return web.Response(status=550, text="session expired")
+            session.touch()
+        response = await handler(request)
+        if response.body is not None:
+            self.bytes_sent += len(response.body)
+        return response
+
+    def get_session(self, request: web.Request) -> Session:
+        return self.sessions[request.match_info["session"]]
+
+    async def login(self, request: web.Request) -> web.Response:
+        login = request.query.get("userName", "")
+        session_token = request.query.get("sessionid")
+        password = request.query.get("password")
+        if session_token is not None:
+            resumed = self.sessions.get(session_token)
+            is_valid = resumed is not None and resumed.login == login
+            if is_valid and resumed.is_alive():
+                resumed.touch()
+                return self.make_session_response(resumed)
+            is_valid = False
+        else:
+            is_valid = password is not None and not password.startswith(
+                WRONG_PASSWORD_PREFIX
+            )
+        if not is_valid or login == "":
+            return web.Response(
+                text='<XIMSS><response errorText="incorrect password or account name"/></XIMSS>',
+                content_type="text/xml",
+            )
+        self.get_mailbox(login)
+        session = Session(login, self.session_ttl_sec)
+        self.sessions[session.id] = session
+        return self.make_session_response(session)
+
+    def make_session_response(self, session: Session) -> web.Response:
+        return web.Response(
+            text=f'<XIMSS><session urlID="{session.id}" userName="{session.login}"/></XIMSS>',
+            content_type="text/xml",
+        )
+
+    async def longpoll(self, request: web.Request) -> web.Response:
+        session = self.get_session(request)
+        session.is_polling = True
+        ack_seq = int(request.query.get("ackSeq", 0))
+        max_wait = float(request.query.get("maxWait", 20))
+        if ack_seq < session.resp_seq:
+            # the client did not see the last response, so it is sent again
+            return web.Response(text=session.last_response, content_type="text/xml")
+        if not session.has_notify:
+            session.wakeup.clear()
+            try:
+                await asyncio.wait_for(session.wakeup.wait(), max_wait)
+            except asyncio.TimeoutError:
+                pass
+        if not session.is_alive():
+            return web.Response(status=550, text="session expired")
+        session.touch()
+        if not session.has_notify:
+            return web.Response(text="<XIMSS/>", content_type="text/xml")
+        session.has_notify = False
+        session.resp_seq += 1
+        session.last_response = f'<XIMSS respSeq="{session.resp_seq}"><folderReport folder="{FOLDER}" mode="notify"/></XIMSS>'
+        return web.Response(text=session.last_response, content_type="text/xml")
+
+    async def sync(self, request: web.Request) -> web.Response:
+        session = self.get_session(request)
+        mailbox = self.get_mailbox(session.login)
+        body = await request.text()
+        responses = []
+        for command in ET.fromstring(body) if body else []:
+            command_id = command.attrib.get("id", "")
+            if command.tag == "folderOpen":
+                session.known_uid = mailbox.max_uid()
+            elif command.tag == "folderSync":
+                limit = int(command.attrib.get("limit", 300))
+                new_uids = [uid for uid in mailbox.letters if uid > session.known_uid]
+                for uid in new_uids[:limit]:
+                    responses.append(mailbox.letters[uid].to_report(session.login))
+                    session.known_uid = uid
+            elif command.tag == "messageMark":
+                for uid_element in command.findall("UID"):
+                    letter = mailbox.letters.get(int(uid_element.text))
+                    if letter is not None:
+                        letter.flags = command.attrib.get("flags", "Read")
+            elif command.tag == "prefsRead":
+                responses.append(
+                    f'<prefs id="{command_id}"><Language>russian</Language></prefs>'
+                )
+            elif command.tag == "folderRead":
+                letter = mailbox.letters.get(int(command.attrib.get("UID", 0)))
+                if letter is not None:
+                    responses.append(self.make_folder_message(letter, command_id))
+            responses.append(f'<response id="{command_id}"/>')
+        response = web.Response(
+            text=f"<XIMSS>{''.join(responses)}</XIMSS>", content_type="text/xml"
+        )
+        response.set_cookie("samoware-session", session.id)
+        return response
+
+    def make_folder_message(self, letter: Letter, command_id: str) -> str:
+        parts = f'<MIME type="text" subtype="plain">{escape(letter.text)}</MIME>'
+        for index, size in enumerate(letter.attachments):
+            parts += f'<MIME type="application" subtype="octet-stream" disposition="attachment" fileName="file-{index}.bin" estimatedSize="{size}"/>'
+        return (
+            f'<folderMessage folder="{FOLDER}" id="{command_id}" UID="{letter.uid}">'
+            f'<EMail><MIME type="multipart" subtype="mixed">{parts}</MIME></EMail>'
+            "</folderMessage>"
+        )
+
+    async def session_admin(self, request: web.Request) -> web.Response:
+        return web.Response(text="{}", content_type="application/json")
+
+    async def letter_page(self, request: web.Request) -> web.Response:
+        session = self.get_session(request)
+        letter = self.get_mailbox(session.login).letters.get(
+            int(request.match_info["uid"])
+        )
+        if letter is None:
+            return web.Response(status=404)
+        paragraphs = "".join(
+            f"<p>{escape(line)}</p>" for line in letter.text.split("\n")
+        )
+        attachments = "".join(
+            f'<cg-message-attachment attachment-ref="/Session/{session.id}/attachments/{letter.uid}/{index}" attachment-name="file-{index}.bin"></cg-message-attachment>'
+            for index in range(len(letter.attachments))
+        )
+        return web.Response(
+            text=(
+                f"<html><body>{PAGE_CHROME}"
+                f'<div class="samoware-RFC822-body"><div class="textBeg"></div>{paragraphs}<div class="textEnd"></div></div>'
+                f"{attachments}{PAGE_CHROME}</body></html>"
+            ),
+            content_type="text/html",
+        )
+
+    async def attachment(self, request: web.Request) -> web.Response:
+        session = self.get_session(request)
+        letter = self.get_mailbox(session.login).letters.get(
+            int(request.match_info["uid"])
+        )
+        index = int(request.match_info["index"])
+        if letter is None or index >= len(letter.attachments):
+            return web.Response(status=404)
+        return web.Response(
+            body=random.randbytes(letter.attachments[index]),
+            content_type="application/octet-stream",
+        )
+
+    # control api
+
+    async def control_mail(self, request: web.Request) -> web.Response:
+        """
+        {"login": "user" | "logins": ["user", ...] | omitted for everyone,
+         "count": 1, "subject": ..., "text": ..., "attachments": [bytes, ...]}
+        """
+        params = await request.json()
+        logins = [params["login"]] if "login" in params else params.get("logins")
+        letter = {
+            key: params[key]
+            for key in ("subject", "text", "sender", "attachments")
+            if key in params
+        }
+        delivered = []
+        for _ in range(int(params.get("count", 1))):
+            delivered += self.mass_mail(logins, **letter)
+        return web.json_response(
+            {
+                "delivered": [
+                    LETTER_MARKER_FORMAT.format(login, letter.uid)
+                    for (login, letter) in delivered
+                ]
+            }
+        )
+
+    async def control_faults(self, request: web.Request) -> web.Response:
+        self.faults.update(await request.json())
+        return web.json_response(self.faults.to_dict())
+
+    async def control_expire(self, request: web.Request) -> web.Response:
+        params = await request.json() if request.can_read_body else {}
+        return web.json_response({"expired": self.expire(params.get("login"))})
+
+    async def control_stats(self, request: web.Request) -> web.Response:
+        stats = self.stats()
+        if "arrivals" in request.query:
+            stats["arrivals"] = self.letter_arrivals()
+        return web.json_response(stats)
+
+    def letter_arrivals(self) -> dict[str, float]:
+        # the marker is in the subject, so a harness can find the letter in telegram
+        return {
+            LETTER_MARKER_FORMAT.format(login, uid): letter.arrived_at.timestamp()
+            for login, mailbox in self.mailboxes.items()
+            for uid, letter in mailbox.letters.items()
+        }
+
+    def stats(self) -> dict:
+        return {
+            "requests": dict(self.requests),
+            "bytes_sent": self.bytes_sent,
+            "sessions": sum(
+                1 for session in self.sessions.values() if session.is_alive()
+            ),
+            "mailboxes": len(self.mailboxes),
+            # the mailboxes whose users are online
+            "polling_mailboxes": len(
+                {
+                    session.login
+                    for session in self.sessions.values()
+                    if session.is_alive() and session.is_polling
+                }
+            ),
+            "letters": sum(len(mailbox.letters) for mailbox in self.mailboxes.values()),
+            "faults": self.faults.to_dict(),
+        }
+
+    async def start(self, host: str, port: int) -> web.AppRunner:
+        runner = web.AppRunner(self.app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        log.info(f"samoware simulator is listening on {host}:{port}")
+        return runner
+
+
+async def main(args: argparse.Namespace) -> None:
+    simulator = SamowareSimulator(args.latency_ms, args.session_ttl_sec, args.seed)
+    simulator.faults.update(
+        {
+            "error_rate": args.error_rate,
+            "expire_rate": args.expire_rate,
+            "drop_rate": args.drop_rate,
+            "slow_rate": args.slow_rate,
+        }
+    )
+    await simulator.start(args.host, args.port)
+    if args.letters_per_minute > 0:
+        await simulator.generate_mail(
+            args.letters_per_minute, args.text_size, args.attachments
+        )
+    else:
+        await asyncio.Event().wait()
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-ms", type=float, default=50, help="median latency")
+    parser.add_argument("--session-ttl-sec", type=float, default=300)
+    parser.add_argument(
+        "--letters-per-minute", type=float, default=0, help="for all mailboxes together"
+    )
+    parser.add_argument("--text-size", type=int, default=2000)
+    parser.add_argument(
+        "--attachments",
+        type=int,
+        nargs="*",
+        default=[],
+        help="attachment sizes in bytes",
+    )
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--expire-rate", type=float, default=0)
+    parser.add_argument("--drop-rate", type=float, default=0)
+    parser.add_argument("--slow-rate", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=None)
+    return parser
+
+
+if __name__ == "__main__":
+    log.basicConfig(level=log.INFO)
+    try:
+        asyncio.run(main(make_parser().parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,582 @@
+#!/bin/python3
+"""
+Telegram Bot API stand-in for load and integration tests.
+
+Serves the methods used by src/telegram_bot.py: sendMessage, sendMediaGroup,
+editMessageText, deleteMessage(s), getUpdates and setWebhook/deleteWebhook.
+Sends are limited by global and per-chat token buckets answered with 429 and
+retry_after, texts are checked like Telegram parses entities, and every chat
+keeps what it has received. While a webhook is set, the updates are posted to
+it with the secret token header instead of being returned by getUpdates.
+
+Point the bot at it with TELEGRAM_API_URL.
+"""
+
+import argparse
+import asyncio
+import json
+import logging as log
+import math
+import random
+import re
+import time
+from collections import Counter
+from html.parser import HTMLParser
+
+import aiohttp
+from aiohttp import web
+
+MAX_MESSAGE_LENGTH = 4096
+MAX_MEDIA_GROUP_SIZE = 10
+GET_UPDATES_LIMIT = 100
+DEFAULT_WEBHOOK_MAX_CONNECTIONS = 40
+WEBHOOK_RETRY_DELAY_SEC = 1
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+BOT_USER = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "Samowarium",
+    "username": "samowarium_bot",
+}
+# the samoware simulator puts it into the subject of every letter
+LETTER_MARKER_PATTERN = re.compile(r"\[loadtest:[^\]]+\]")
+HTML_TAGS = {
+    "b",
+    "strong",
+    "i",
+    "em",
+    "u",
+    "ins",
+    "s",
+    "strike",
+    "del",
+    "span",
+    "tg-spoiler",
+    "tg-emoji",
+    "a",
+    "code",
+    "pre",
+    "blockquote",
+}
+HTML_ENTITIES = {"lt", "gt", "amp", "quot"}
+
+
+class ApiError(Exception):
+    def __init__(self, code: int, description: str, retry_after: int | None = None):
+        self.code = code
+        self.description = description
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        self.refill()
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount: float) -> None:
+        self.refill()
+        self.tokens -= amount
+
+
+class EntityChecker(HTMLParser):
+    """
+    Rejects the html that Telegram fails to parse: unknown tags and entities,
+    unbalanced tags and a bare '<'.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=False)
+        self.open_tags: list[str] = []
+        self.error: str | None = None
+
+    def fail(self, error: str) -> None:
+        if self.error is None:
+            self.error = error
+
+    def handle_starttag(self, tag, attrs) -> None:
+        if tag not in HTML_TAGS:
+            self.fail(f'Unsupported start tag "{tag}"')
+        self.open_tags.append(tag)
+
+    def handle_endtag(self, tag) -> None:
+        if len(self.open_tags) == 0 or self.open_tags[-1] != tag:
+            self.fail(f'Unexpected end tag "{tag}"')
+            return
+        self.open_tags.pop()
+
+    def handle_entityref(self, name) -> None:
+        if name not in HTML_ENTITIES:
+            self.fail(f'Unsupported HTML entity "&{name};"')
+
+    def handle_data(self, data) -> None:
+        if "<" in data:
+            self.fail("Unexpected character '<'")
+
+
+def check_entities(text: str, parse_mode: str | None) -> None:
+    if parse_mode is None:
+        return
+    parse_mode = parse_mode.lower()
+    if parse_mode == "html":
+        checker = EntityChecker()
+        checker.feed(text)
+        checker.close()
+        if checker.error is None and len(checker.open_tags) > 0:
+            checker.fail(
+                f'Can\'t find end tag corresponding to start tag "{checker.open_tags[-1]}"'
+            )
+        if checker.error is not None:
+            raise ApiError(400, f"Bad Request: can't parse entities: {checker.error}")
+    elif parse_mode == "markdown":
+        # legacy markdown has no escaping outside of code, every entity must be closed
+        open_entity = None
+        for offset, char in enumerate(text):
+            if open_entity is None and char in "*_`[":
+                open_entity = (char, offset)
+            elif open_entity is not None and char == {"[": "]"}.get(
+                open_entity[0], open_entity[0]
+            ):
+                open_entity = None
+        if open_entity is not None:
+            raise ApiError(
+                400,
+                f"Bad Request: can't parse entities: Can't find end of the entity starting at byte offset {len(text[:open_entity[1]].encode())}",
+            )
+    else:
+        raise ApiError(400, f"Bad Request: unsupported parse_mode {parse_mode}")
+
+
+class Chat:
+    def __init__(self, chat_id: int, bucket: TokenBucket) -> None:
+        self.id = chat_id
+        self.bucket = bucket
+        self.messages: dict[int, dict] = {}
+        self.received: list[dict] = []
+        self.is_blocked = False
+
+    def to_dict(self) -> dict:
+        return {"id": self.id, "type": "private", "first_name": f"user{self.id}"}
+
+
+class TelegramSimulator:
+    def __init__(
+        self,
+        global_rate: float = 30,
+        chat_rate: float = 1,
+        chat_burst: float = 5,
+        latency_ms: float = 30,
+        seed: int | None = None,
+    ) -> None:
+        if seed is not None:
+            random.seed(seed)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.latency_ms = latency_ms
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chats: dict[int, Chat] = {}
+        self.next_message_id = 1
+        self.updates: list[dict] = []
+        self.next_update_id = 1
+        self.has_updates = asyncio.Event()
+        self.webhook_url: str | None = None
+        self.webhook_secret: str | None = None
+        self.webhook_max_connections = DEFAULT_WEBHOOK_MAX_CONNECTIONS
+        self.webhook_task: asyncio.Task | None = None
+        self.webhook_deliveries = 0
+        self.requests = Counter()
+        self.errors = Counter()
+        self.bytes_received = 0
+        self.app = web.Application(middlewares=[self.simulate])
+        self.app.router.add_route("*", "/bot{token}/{method}", self.call)
+        self.app.router.add_post("/_control/update", self.control_update)
+        self.app.router.add_post("/_control/block", self.control_block)
+        self.app.router.add_get("/_control/stats", self.control_stats)
+        self.app.router.add_get("/_control/chats/{chat_id}", self.control_chat)
+        self.methods = {
+            "getMe": self.get_me,
+            "getUpdates": self.get_updates,
+            "setWebhook": self.set_webhook,
+            "deleteWebhook": self.delete_webhook,
+            "sendMessage": self.send_message,
+            "sendMediaGroup": self.send_media_group,
+            "editMessageText": self.edit_message_text,
+            "deleteMessage": self.delete_message,
+            "deleteMessages": self.delete_messages,
+        }
+
+    # scripting
+
+    def get_chat(self, chat_id: int) -> Chat:
+        if chat_id not in self.chats:
+            self.chats[chat_id] = Chat(
+                chat_id, TokenBucket(self.chat_rate, self.chat_burst)
+            )
+        return self.chats[chat_id]
+
+    def push_message(self, chat_id: int, text: str) -> dict:
+        """Queues a message from the user for getUpdates or the webhook, e.g. /login."""
+        chat = self.get_chat(chat_id)
+        message = {
+            "message_id": self.make_message_id(),
+            "date": int(time.time()),
+            "chat": chat.to_dict(),
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [
+                {"type": "bot_command", "offset": 0, "length": len(text.split()[0])}
+            ]
+        update = {"update_id": self.next_update_id, "message": message}
+        self.next_update_id += 1
+        self.updates.append(update)
+        self.has_updates.set()
+        return update
+
+    def make_message_id(self) -> int:
+        self.next_message_id += 1
+        return self.next_message_id - 1
+
+    def marker_deliveries(self) -> dict[str, list[float]]:
+        # several sends of one letter are duplicates
+        deliveries: dict[str, list[float]] = {}
+        for chat in self.chats.values():
+            for record in chat.received:
+                if record["method"] != "sendMessage":
+                    continue
+                for marker in LETTER_MARKER_PATTERN.findall(record["text"]):
+                    deliveries.setdefault(marker, []).append(record["received_at"])
+        return deliveries
+
+    # simulation
+
+    @web.middleware
+    async def simulate(self, request: web.Request, handler):
+        if request.path.startswith("/_control/"):
+            return await handler(request)
+        method = request.match_info.get("method", "unknown")
+        self.requests[method] += 1
+        if method != "getUpdates":
+            await asyncio.sleep(random.lognormvariate(0, 0.5) * self.latency_ms / 1000)
+        try:
+            return await handler(request)
+        except ApiError as error:
+            self.errors[f"{method}:{error.code}"] += 1
+            response = {
+                "ok": False,
+                "error_code": error.code,
+                "description": error.description,
+            }
+            if error.retry_after is not None:
+                response["parameters"] = {"retry_after": error.retry_after}
+            return web.json_response(response, status=error.code)
+
+    async def call(self, request: web.Request) -> web.Response:
+        method = self.methods.get(request.match_info["method"])
+        params = dict(request.query)
+        if request.can_read_body:
+            form = await request.post()
+            for key, value in form.items():
+                if isinstance(value, web.FileField):
+                    value = value.file.read()
+                    self.bytes_received += len(value)
+                params[key] = value
+        if method is None:
+            # the rest is accepted without checks, e.g. setMyCommands
+            return web.json_response({"ok": True, "result": True})
+        return web.json_response({"ok": True, "result": await method(params)})
+
+    def limit(self, chat: Chat, amount: int) -> None:
+        if chat.is_blocked:
+            raise ApiError(403, "Forbidden: bot was blocked by the user")
+        wait_time = max(
+            self.global_bucket.wait_time(amount), chat.bucket.wait_time(amount)
+        )
+        if wait_time > 0:
+            retry_after = math.ceil(wait_time)
+            raise ApiError(
+                429, f"Too Many Requests: retry after {retry_after}", retry_after
+            )
+        self.global_bucket.take(amount)
+        chat.bucket.take(amount)
+
+    def record(self, chat: Chat, method: str, message: dict) -> None:
+        chat.messages[message["message_id"]] = message
+        chat.received.append(
+            {
+                "method": method,
+                "message_id": message["message_id"],
+                "text": message.get("text", ""),
+                "document": message.get("document"),
+                "received_at": time.time(),
+            }
+        )
+
+    def make_message(self, chat: Chat, **content) -> dict:
+        return {
+            "message_id": self.make_message_id(),
+            "date": int(time.time()),
+            "chat": chat.to_dict(),
+            "from": BOT_USER,
+            **content,
+        }
+
+    async def get_me(self, params: dict) -> dict:
+        return BOT_USER
+
+    async def get_updates(self, params: dict) -> list[dict]:
+        if self.webhook_url is not None:
+            raise ApiError(
+                409,
+                "Conflict: can't use getUpdates method while webhook is active; use deleteWebhook to delete the webhook first",
+            )
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", GET_UPDATES_LIMIT))
+        # updates before the offset are confirmed
+        self.updates = [
+            update for update in self.updates if update["update_id"] >= offset
+        ]
+        if len(self.updates) == 0:
+            self.has_updates.clear()
+            try:
+                await asyncio.wait_for(
+                    self.has_updates.wait(), float(params.get("timeout", 0))
+                )
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:limit]
+
+    async def set_webhook(self, params: dict) -> bool:
+        self.stop_webhook()
+        self.webhook_url = params["url"]
+        self.webhook_secret = params.get("secret_token")
+        self.webhook_max_connections = int(
+            params.get("max_connections", DEFAULT_WEBHOOK_MAX_CONNECTIONS)
+        )
+        if str(params.get("drop_pending_updates", "")).lower() == "true":
+            self.updates = []
+        log.info(f"webhook is set to {self.webhook_url}")
+        self.webhook_task = asyncio.create_task(self.deliver_updates())
+        return True
+
+    async def delete_webhook(self, params: dict) -> bool:
+        self.stop_webhook()
+        self.webhook_url = None
+        self.webhook_secret = None
+        if str(params.get("drop_pending_updates", "")).lower() == "true":
+            self.updates = []
+        return True
+
+    def stop_webhook(self) -> None:
+        if self.webhook_task is not None:
+            self.webhook_task.cancel()
+            self.webhook_task = None
+
+    async def deliver_updates(self) -> None:
+        async with aiohttp.ClientSession() as session:
+            while True:
+                if len(self.updates) == 0:
+                    self.has_updates.clear()
+                    await self.has_updates.wait()
+                    continue
+                batch = self.updates[: self.webhook_max_connections]
+                results = await asyncio.gather(
+                    *[self.post_update(session, update) for update in batch]
+                )
+                # like telegram, an update is sent again until the webhook accepts it
+                delivered = {
+                    update["update_id"]
+                    for (update, is_delivered) in zip(batch, results)
+                    if is_delivered
+                }
+                self.updates = [
+                    update
+                    for update in self.updates
+                    if update["update_id"] not in delivered
+                ]
+                self.webhook_deliveries += len(delivered)
+                if len(delivered) < len(batch):
+                    await asyncio.sleep(WEBHOOK_RETRY_DELAY_SEC)
+
+    async def post_update(self, session: aiohttp.ClientSession, update: dict) -> bool:
+        headers = {}
+        if self.webhook_secret is not None:
+            headers[SECRET_TOKEN_HEADER] = self.webhook_secret
+        try:
+            async with session.post(
+                self.webhook_url, json=update, headers=headers
+            ) as response:
+                if response.status != 200:
+                    self.errors[f"webhook:{response.status}"] += 1
+                    return False
+                return True
+        except aiohttp.ClientError:
+            self.errors["webhook:network"] += 1
+            return False
+
+    def check_text(self, text: str, parse_mode: str | None) -> None:
+        if len(text.strip()) == 0:
+            raise ApiError(400, "Bad Request: message text is empty")
+        if len(text) > MAX_MESSAGE_LENGTH:
+            raise ApiError(400, "Bad Request: message is too long")
+        check_entities(text, parse_mode)
+
+    async def send_message(self, params: dict) -> dict:
+        chat = self.get_chat(int(params["chat_id"]))
+        text = params.get("text", "")
+        self.check_text(text, params.get("parse_mode"))
+        self.limit(chat, 1)
+        message = self.make_message(chat, text=text)
+        self.record(chat, "sendMessage", message)
+        return message
+
+    async def send_media_group(self, params: dict) -> list[dict]:
+        chat = self.get_chat(int(params["chat_id"]))
+        media = json.loads(params["media"])
+        if not 2 <= len(media) <= MAX_MEDIA_GROUP_SIZE:
+            raise ApiError(400, "Bad Request: wrong number of media in the group")
+        # every item of a group counts as a message
+        self.limit(chat, len(media))
+        messages = []
+        for item in media:
+            file = params.get(item["media"].removeprefix("attach://"), b"")
+            file_id = f"file{self.next_message_id}"
+            message = self.make_message(
+                chat,
+                document={
+                    "file_id": file_id,
+                    "file_unique_id": file_id,
+                    "file_name": item.get("filename", file_id),
+                    "file_size": len(file),
+                },
+            )
+            self.record(chat, "sendMediaGroup", message)
+            messages.append(message)
+        return messages
+
+    async def edit_message_text(self, params: dict) -> dict:
+        chat = self.get_chat(int(params["chat_id"]))
+        message = chat.messages.get(int(params["message_id"]))
+        if message is None:
+            raise ApiError(400, "Bad Request: message to edit not found")
+        text = params.get("text", "")
+        self.check_text(text, params.get("parse_mode"))
+        if message.get("text") == text:
+            raise ApiError(
+                400,
+                "Bad Request: message is not modified: specified new message content and reply markup are exactly the same as a current content and reply markup of the message",
+            )
+        self.limit(chat, 1)
+        message["text"] = text
+        message["edit_date"] = int(time.time())
+        self.record(chat, "editMessageText", message)
+        return message
+
+    async def delete_message(self, params: dict) -> bool:
+        chat = self.get_chat(int(params["chat_id"]))
+        if chat.messages.pop(int(params["message_id"]), None) is None:
+            raise ApiError(400, "Bad Request: message to delete not found")
+        return True
+
+    async def delete_messages(self, params: dict) -> bool:
+        chat = self.get_chat(int(params["chat_id"]))
+        for message_id in json.loads(params["message_ids"]):
+            chat.messages.pop(message_id, None)
+        return True
+
+    # control api
+
+    async def control_update(self, request: web.Request) -> web.Response:
+        """{"chat_id": 100, "text": "/login user password"}"""
+        params = await request.json()
+        return web.json_response(
+            self.push_message(int(params["chat_id"]), params["text"])
+        )
+
+    async def control_block(self, request: web.Request) -> web.Response:
+        """{"chat_id": 100, "is_blocked": true}"""
+        params = await request.json()
+        self.get_chat(int(params["chat_id"])).is_blocked = params.get(
+            "is_blocked", True
+        )
+        return web.json_response({"ok": True})
+
+    async def control_stats(self, request: web.Request) -> web.Response:
+        stats = self.stats()
+        if "deliveries" in request.query:
+            stats["deliveries"] = self.marker_deliveries()
+        return web.json_response(stats)
+
+    async def control_chat(self, request: web.Request) -> web.Response:
+        chat = self.chats.get(int(request.match_info["chat_id"]))
+        if chat is None:
+            return web.Response(status=404)
+        return web.json_response(chat.received)
+
+    def stats(self) -> dict:
+        deliveries = self.marker_deliveries()
+        return {
+            "requests": dict(self.requests),
+            "errors": dict(self.errors),
+            "bytes_received": self.bytes_received,
+            "webhook_deliveries": self.webhook_deliveries,
+            "chats": len(self.chats),
+            "messages": sum(len(chat.received) for chat in self.chats.values()),
+            "letters": len(deliveries),
+            "duplicate_letters": sum(
+                1 for times in deliveries.values() if len(times) > 1
+            ),
+        }
+
+    async def start(self, host: str, port: int) -> web.AppRunner:
+        runner = web.AppRunner(self.app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        log.info(f"telegram simulator is listening on {host}:{port}")
+        return runner
+
+
+async def main(args: argparse.Namespace) -> None:
+    simulator = TelegramSimulator(
+        args.global_rate, args.chat_rate, args.chat_burst, args.latency_ms, args.seed
+    )
+    await simulator.start(args.host, args.port)
+    await asyncio.Event().wait()
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument(
+        "--global-rate",
+        type=float,
+        default=30,
+        help="messages per second for all chats",
+    )
+    parser.add_argument(
+        "--chat-rate", type=float, default=1, help="messages per second for one chat"
+    )
+    parser.add_argument("--chat-burst", type=float, default=5)
+    parser.add_argument("--latency-ms", type=float, default=30, help="median latency")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser
+
+
+if __name__ == "__main__":
+    log.basicConfig(level=log.INFO)
+    try:
+        asyncio.run(main(make_parser().parse_args()))
+    except KeyboardInterrupt:
+        pass
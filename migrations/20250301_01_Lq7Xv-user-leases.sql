@@ -0,0 +1,10 @@
+-- user-leases
+-- depends: 20250109_01_zWsRw-fix-telegram-id
+
+ALTER TABLE users ADD lease_owner text;
+ALTER TABLE users ADD lease_expires_at timestamp with time zone;
+
+CREATE TABLE IF NOT EXISTS nodes(
+    node_id                 text PRIMARY KEY,
+    heartbeat_at            timestamp with time zone NOT NULL
+);
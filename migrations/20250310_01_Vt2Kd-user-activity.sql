@@ -0,0 +1,5 @@
+-- user-activity
+-- depends: 20250301_01_Lq7Xv-user-leases
+
+ALTER TABLE users ADD last_mail_at timestamp with time zone;
+ALTER TABLE users ADD parked_at timestamp with time zone;
@@ -0,0 +1,5 @@
+-- forwarded-uids
+-- depends: 20250310_01_Vt2Kd-user-activity
+
+ALTER TABLE users ADD forwarded_uid_high_water bigint;
+ALTER TABLE users ADD forwarded_uids bigint[];
@@ -0,0 +1,110 @@
+import asyncio
+import logging as log
+from contextvars import ContextVar
+
+from metrics import user_usage_top_metric
+
+REQUESTS_RESOURCE = "requests"
+BYTES_RESOURCE = "bytes"
+LETTERS_RESOURCE = "letters"
+SENDS_RESOURCE = "sends"
+ERRORS_RESOURCE = "errors"
+RESOURCES = (
+    REQUESTS_RESOURCE,
+    BYTES_RESOURCE,
+    LETTERS_RESOURCE,
+    SENDS_RESOURCE,
+    ERRORS_RESOURCE,
+)
+
+TRACKED_USERS_COUNT = 64
+TOP_GAUGES_COUNT = 5
+DECAY_FACTOR = 0.5
+DECAY_INTERVAL_SEC = 15 * 60
+GAUGES_UPDATE_INTERVAL_SEC = 30
+
+# the user whose handler runs in the current task
+current_user: ContextVar[int | None] = ContextVar("current_user", default=None)
+
+
+# a new user replaces the smallest counter and inherits its value
+# as the possible overestimation
+class SpaceSaving:
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.counts: dict[int, float] = {}
+        self.errors: dict[int, float] = {}
+
+    def add(self, key: int, amount: float) -> None:
+        if key in self.counts:
+            self.counts[key] += amount
+            return
+        if len(self.counts) < self.capacity:
+            self.counts[key] = amount
+            self.errors[key] = 0
+            return
+        evicted = min(self.counts, key=self.counts.get)
+        floor = self.counts.pop(evicted)
+        del self.errors[evicted]
+        self.counts[key] = floor + amount
+        self.errors[key] = floor
+
+    def decay(self, factor: float) -> None:
+        for key in list(self.counts):
+            self.counts[key] *= factor
+            self.errors[key] *= factor
+            if self.counts[key] < 1:
+                del self.counts[key]
+                del self.errors[key]
+
+    def top(self, count: int) -> list[tuple[int, float, float]]:
+        keys = sorted(self.counts, key=self.counts.get, reverse=True)[:count]
+        return [(key, self.counts[key], self.errors[key]) for key in keys]
+
+
+class Accountant:
+    def __init__(self) -> None:
+        self.usage = {
+            resource: SpaceSaving(TRACKED_USERS_COUNT) for resource in RESOURCES
+        }
+
+    def account(
+        self, resource: str, amount: float = 1, telegram_id: int | None = None
+    ) -> None:
+        if telegram_id is None:
+            telegram_id = current_user.get()
+        if telegram_id is not None and amount > 0:
+            self.usage[resource].add(telegram_id, amount)
+
+    def report(self, count: int = TRACKED_USERS_COUNT) -> dict:
+        return {
+            resource: [
+                {"telegram_id": key, "amount": amount, "overestimation": error}
+                for (key, amount, error) in usage.top(count)
+            ]
+            for resource, usage in self.usage.items()
+        }
+
+    def update_gauges(self) -> None:
+        for resource, usage in self.usage.items():
+            top = usage.top(TOP_GAUGES_COUNT)
+            for rank in range(TOP_GAUGES_COUNT):
+                user_usage_top_metric.labels(resource=resource, rank=rank + 1).set(
+                    top[rank][1] if rank < len(top) else 0
+                )
+
+    async def run(self) -> None:
+        # recent usage outweighs the old one, so the top follows the current load
+        elapsed = 0
+        while True:
+            await asyncio.sleep(GAUGES_UPDATE_INTERVAL_SEC)
+            elapsed += GAUGES_UPDATE_INTERVAL_SEC
+            if elapsed >= DECAY_INTERVAL_SEC:
+                elapsed = 0
+                for usage in self.usage.values():
+                    usage.decay(DECAY_FACTOR)
+                log.debug("user usage is decayed")
+            self.update_gauges()
+
+
+accountant = Accountant()
@@ -0,0 +1,25 @@
+from datetime import datetime, timedelta, timezone
+
+import env
+
+HOT_TIER = "hot"
+COLD_TIER = "cold"
+PARKED_TIER = "parked"
+
+HOT_LONGPOLL_WAIT_SEC = 20
+
+
+def get_tier(last_mail_at: datetime) -> str:
+    idle = datetime.now(timezone.utc) - last_mail_at
+    park_after_days = env.get_park_inactive_after_days()
+    if park_after_days > 0 and idle > timedelta(days=park_after_days):
+        return PARKED_TIER
+    if idle > timedelta(hours=env.get_cold_after_hours()):
+        return COLD_TIER
+    return HOT_TIER
+
+
+def get_longpoll_wait_sec(tier: str) -> int:
+    if tier == HOT_TIER:
+        return HOT_LONGPOLL_WAIT_SEC
+    return env.get_cold_longpoll_wait_sec()
@@ -0,0 +1,185 @@
+import asyncio
+import cProfile
+import io
+import logging as log
+import os
+import pstats
+import tracemalloc
+from datetime import datetime
+
+from aiohttp import web
+
+from accounting import accountant
+from const import ADMIN_ARTIFACTS_FOLDER_PATH
+import env
+import util
+
+MAX_CAPTURE_SEC = 300
+DEFAULT_CAPTURE_SEC = 30
+DEFAULT_TOP_N = 30
+MAX_TOP_N = 1000
+TRACEMALLOC_FRAMES = 10
+MAX_ARTIFACTS = 50
+
+
+def make_artifact_name(kind: str, extension: str) -> str:
+    return f"{kind}-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.{extension}"
+
+
+def get_capture_seconds(request: web.Request) -> float:
+    try:
+        seconds = float(request.query.get("seconds", DEFAULT_CAPTURE_SEC))
+    except ValueError:
+        raise web.HTTPBadRequest(text="seconds must be a number")
+    if not 0 <= seconds <= MAX_CAPTURE_SEC:
+        raise web.HTTPBadRequest(
+            text=f"seconds must be between 0 and {MAX_CAPTURE_SEC}"
+        )
+    return seconds
+
+
+def get_top(request: web.Request) -> int:
+    try:
+        top = int(request.query.get("top", DEFAULT_TOP_N))
+    except ValueError:
+        raise web.HTTPBadRequest(text="top must be an integer")
+    if not 0 < top <= MAX_TOP_N:
+        raise web.HTTPBadRequest(text=f"top must be between 1 and {MAX_TOP_N}")
+    return top
+
+
+def remove_old_artifacts() -> None:
+    paths = [
+        os.path.join(ADMIN_ARTIFACTS_FOLDER_PATH, name)
+        for name in os.listdir(ADMIN_ARTIFACTS_FOLDER_PATH)
+    ]
+    paths.sort(key=os.path.getmtime)
+    for path in paths[:-MAX_ARTIFACTS]:
+        os.remove(path)
+        log.debug(f"admin artifact {os.path.basename(path)} is removed")
+
+
+class AdminServer:
+    def __init__(self, port: int) -> None:
+        self.host = env.get_admin_server_host()
+        self.port = port
+        self.token = env.get_admin_token()
+        # captures of one kind can not overlap
+        self.profile_lock = asyncio.Lock()
+        self.heap_lock = asyncio.Lock()
+        self.app = web.Application(middlewares=[self.check_token])
+        self.app.router.add_post("/profile", self.profile)
+        self.app.router.add_post("/heap", self.heap)
+        self.app.router.add_post("/tasks", self.tasks)
+        self.app.router.add_get("/usage", self.usage)
+        self.app.router.add_get("/artifacts", self.list_artifacts)
+        self.app.router.add_get("/artifacts/{name}", self.get_artifact)
+        self.runner: web.AppRunner | None = None
+
+    async def start(self) -> None:
+        util.make_dir_if_not_exist(ADMIN_ARTIFACTS_FOLDER_PATH)
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        log.info(f"admin server is listening on {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    @web.middleware
+    async def check_token(self, request: web.Request, handler):
+        if (
+            self.token is not None
+            and request.headers.get("Authorization") != f"Bearer {self.token}"
+        ):
+            return web.Response(status=401)
+        return await handler(request)
+
+    def write_artifact(self, name: str, content: str) -> web.Response:
+        with open(
+            os.path.join(ADMIN_ARTIFACTS_FOLDER_PATH, name), "w", encoding="utf-8"
+        ) as file:
+            file.write(content)
+        log.info(f"admin artifact {name} is written")
+        remove_old_artifacts()
+        return web.json_response({"artifact": name, "url": f"/artifacts/{name}"})
+
+    async def profile(self, request: web.Request) -> web.Response:
+        seconds = get_capture_seconds(request)
+        top = get_top(request)
+        if self.profile_lock.locked():
+            return web.Response(status=409, text="profiling is already running")
+        async with self.profile_lock:
+            log.info(f"profiling the event loop for {seconds} seconds...")
+            # the loop thread runs every handler, so it sees all of them
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profiler.disable()
+        name = make_artifact_name("profile", "prof")
+        profiler.dump_stats(os.path.join(ADMIN_ARTIFACTS_FOLDER_PATH, name))
+        stats_text = io.StringIO()
+        pstats.Stats(profiler, stream=stats_text).sort_stats("cumulative").print_stats(
+            top
+        )
+        self.write_artifact(name.replace(".prof", ".txt"), stats_text.getvalue())
+        return web.json_response(
+            {
+                "artifact": name,
+                "url": f"/artifacts/{name}",
+                "summary_url": f"/artifacts/{name.replace('.prof', '.txt')}",
+            }
+        )
+
+    async def heap(self, request: web.Request) -> web.Response:
+        seconds = get_capture_seconds(request)
+        top = get_top(request)
+        if self.heap_lock.locked():
+            return web.Response(status=409, text="heap capture is already running")
+        async with self.heap_lock:
+            is_started_here = not tracemalloc.is_tracing()
+            if is_started_here:
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            try:
+                log.info(f"tracing allocations for {seconds} seconds...")
+                before = tracemalloc.take_snapshot()
+                await asyncio.sleep(seconds)
+                after = tracemalloc.take_snapshot()
+            finally:
+                if is_started_here:
+                    tracemalloc.stop()
+        lines = [f"top {top} allocation differences over {seconds} seconds"]
+        for stat in after.compare_to(before, "lineno")[:top]:
+            lines.append(str(stat))
+        lines.append("")
+        lines.append(f"top {top} allocations")
+        for stat in after.statistics("lineno")[:top]:
+            lines.append(str(stat))
+        return self.write_artifact(make_artifact_name("heap", "txt"), "\n".join(lines))
+
+    async def tasks(self, request: web.Request) -> web.Response:
+        dump = io.StringIO()
+        tasks = asyncio.all_tasks()
+        dump.write(f"{len(tasks)} tasks\n\n")
+        for task in tasks:
+            dump.write(f"{task!r}\n")
+            task.print_stack(file=dump)
+            dump.write("\n")
+        return self.write_artifact(make_artifact_name("tasks", "txt"), dump.getvalue())
+
+    async def usage(self, request: web.Request) -> web.Response:
+        return web.json_response(accountant.report(get_top(request)))
+
+    async def list_artifacts(self, request: web.Request) -> web.Response:
+        return web.json_response(sorted(os.listdir(ADMIN_ARTIFACTS_FOLDER_PATH)))
+
+    async def get_artifact(self, request: web.Request) -> web.StreamResponse:
+        name = os.path.basename(request.match_info["name"])
+        path = os.path.join(ADMIN_ARTIFACTS_FOLDER_PATH, name)
+        if not os.path.isfile(path):
+            return web.Response(status=404)
+        return web.FileResponse(path)
@@ -0,0 +1,54 @@
+import heapq
+from collections import Counter
+from datetime import datetime
+from itertools import count
+
+from samoware_api import MailHeader
+
+SUMMARY_TOP_SENDERS = 5
+
+
+# keeps the newest letters of a catch-up and summarises the rest
+class MailBacklog:
+    def __init__(self, cap: int) -> None:
+        self.cap = cap
+        self.newest: list[tuple[datetime, int, MailHeader]] = []
+        self.order = count()
+        self.skipped_count = 0
+        self.skipped_uids: list[str] = []
+        self.skipped_since: datetime | None = None
+        self.skipped_until: datetime | None = None
+        self.skipped_senders: Counter[str] = Counter()
+
+    def add(self, header: MailHeader) -> None:
+        heapq.heappush(self.newest, (header.utc_time, next(self.order), header))
+        if len(self.newest) > self.cap:
+            (_, _, oldest) = heapq.heappop(self.newest)
+            self.skip(oldest)
+
+    def skip(self, header: MailHeader) -> None:
+        self.skipped_count += 1
+        self.skipped_uids.append(header.uid)
+        if self.skipped_since is None or header.local_time < self.skipped_since:
+            self.skipped_since = header.local_time
+        if self.skipped_until is None or header.local_time > self.skipped_until:
+            self.skipped_until = header.local_time
+        self.skipped_senders[header.from_name] += 1
+
+    def letters(self) -> list[MailHeader]:
+        return [header for (_, _, header) in sorted(self.newest)]
+
+    def summary(self) -> str | None:
+        if self.skipped_count == 0:
+            return None
+        senders = "\n".join(
+            f"{name}: {amount}"
+            for (name, amount) in self.skipped_senders.most_common(SUMMARY_TOP_SENDERS)
+        )
+        return (
+            f"Пропущено писем: {self.skipped_count} "
+            f'(с {datetime.strftime(self.skipped_since, "%d.%m.%Y %H:%M")} '
+            f'по {datetime.strftime(self.skipped_until, "%d.%m.%Y %H:%M")}). '
+            f"Ниже пересланы последние {len(self.newest)}.\n\n"
+            f"Чаще всего писали:\n{senders}"
+        )
@@ -1,18 +1,37 @@
 import asyncio
 import logging as log
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 import re
-from typing import Self
+from typing import Awaitable, Self, TypeVar
 
 import aiohttp
+from activity import (
+    HOT_LONGPOLL_WAIT_SEC,
+    HOT_TIER,
+    PARKED_TIER,
+    get_longpoll_wait_sec,
+    get_tier,
+)
+from accounting import LETTERS_RESOURCE, accountant, current_user
+from backlog import MailBacklog
 from context import Context
 
 from const import (
     HTML_FORMAT,
-    HTTP_RETRY_DELAY_SEC,
     MARKDOWN_FORMAT,
 )
 from database import Database
+from tracing import Span, tracer
+from delivery import (
+    BODY_STAGE,
+    HEADERS_STAGE,
+    RENDERED_STAGE,
+    Delivery,
+    current_delivery,
+)
+import env
+from governor import CircuitOpenError, backoff_delay, set_low_priority
+from revalidation import RevalidationScheduler
 import samoware_api
 from samoware_api import (
     Mail,
@@ -27,9 +46,18 @@ from metrics import (
     revalidation_metric,
     user_handler_error_metric,
     incoming_letter_metric,
+    login_duration_metric,
+    login_step_duration_metric,
+    longpoll_metric,
+    longpoll_saved_metric,
+    parked_metric,
+    folder_sync_page_metric,
+    catch_up_skipped_letter_metric,
+    duplicate_letter_metric,
 )
 
-REVALIDATE_INTERVAL = timedelta(hours=5)
+FOLDER_SYNC_PAGE_SIZE = 50
+LOGIN_MAX_ATTEMPTS = 5
 SESSION_TOKEN_PATTERN = re.compile("^[0-9]{6}-[a-zA-Z0-9]{20}$")
 
 SUCCESSFUL_LOGIN_PROMPT = (
@@ -39,8 +67,17 @@ CAN_NOT_REVALIDATE_PROMPT = "Невозможно продлить сессию
 SESSION_EXPIRED_PROMPT = "Сессия доступа к почте истекла. Для продолжения работы необходима повторная авторизация\n/login _логин_ _пароль_"
 CAN_NOT_RELOGIN_PROMPT = "Ошибка при автоматической повторной авторизации, невозможно продлить сессию. Для продолжения работы необходима авторизация\n/login _логин_ _пароль_"
 WRONG_CREDS_PROMPT = "Неверный логин или пароль."
+LOGIN_UNAVAILABLE_PROMPT = "Почтовый сервер недоступен. Попробуйте позже."
 HANDLER_IS_ALREADY_WORKED_PROMPT = "Доступ уже был выдан."
 HANDLER_IS_ALREADY_SHUTTED_DOWN_PROMPT = "Доступ уже был отозван."
+PARKED_PROMPT = "Новых писем давно не было, поэтому пересылка приостановлена. Для возобновления отправьте /start"
+
+T = TypeVar("T")
+
+
+async def timed_step(step: str, coro: Awaitable[T]) -> T:
+    with login_step_duration_metric.labels(step=step).time():
+        return await coro
 
 
 class UserHandler:
@@ -49,10 +86,13 @@ class UserHandler:
         message_sender: MessageSender,
         db: Database,
         context: Context,
+        revalidation_scheduler: RevalidationScheduler,
     ):
         self.message_sender = message_sender
         self.db = db
         self.context = context
+        self.revalidation_scheduler = revalidation_scheduler
+        self.online = asyncio.Event()
 
     @classmethod
     async def make_new(
@@ -62,14 +102,26 @@ class UserHandler:
         samoware_password: str,
         message_sender: MessageSender,
         db: Database,
+        revalidation_scheduler: RevalidationScheduler,
     ) -> Self | None:
         if await db.is_user_active(telegram_id):
             await message_sender(
                 telegram_id, HANDLER_IS_ALREADY_WORKED_PROMPT, MARKDOWN_FORMAT
             )
             return None
-        handler = UserHandler(message_sender, db, Context(telegram_id, samoware_login))
-        is_successful_login = await handler.login(samoware_password)
+        current_user.set(telegram_id)
+        handler = UserHandler(
+            message_sender,
+            db,
+            Context(telegram_id, samoware_login),
+            revalidation_scheduler,
+        )
+        try:
+            is_successful_login = await handler.login(samoware_password)
+        except Exception:
+            login_metric.labels(is_successful=False).inc()
+            await message_sender(telegram_id, LOGIN_UNAVAILABLE_PROMPT, MARKDOWN_FORMAT)
+            return None
         login_metric.labels(is_successful=is_successful_login).inc()
         if not is_successful_login:
             await message_sender(telegram_id, WRONG_CREDS_PROMPT, MARKDOWN_FORMAT)
@@ -80,17 +132,27 @@ class UserHandler:
 
     @classmethod
     async def make_from_context(
-        cls, context: Context, message_sender: MessageSender, db: Database
+        cls,
+        context: Context,
+        message_sender: MessageSender,
+        db: Database,
+        revalidation_scheduler: RevalidationScheduler,
     ) -> Self:
-        return UserHandler(message_sender, db, context)
+        return UserHandler(message_sender, db, context, revalidation_scheduler)
 
     async def start_handling(self) -> asyncio.Task:
+        self.revalidation_scheduler.schedule(
+            self.context.telegram_id, self.context.last_revalidation
+        )
         self.polling_task = asyncio.create_task(self.polling())
         return self.polling_task
 
     def get_polling_task(self) -> asyncio.Task:
         return self.polling_task
 
+    async def wait_online(self) -> None:
+        await self.online.wait()
+
     async def stop_handling(self) -> None:
         if not (self.polling_task.cancelled() or self.polling_task.done()):
             self.polling_task.cancel()
@@ -98,6 +160,7 @@ class UserHandler:
         await asyncio.wait([self.polling_task])
 
     async def polling(self) -> None:
+        current_user.set(self.context.telegram_id)
         try:
             retry_count = 0
             log.info(f"longpolling for {self.context.samoware_login} is started")
@@ -105,32 +168,36 @@ class UserHandler:
             while await self.db.is_user_active(self.context.telegram_id):
                 try:
                     polling_context = self.context.polling_context
+                    tier = get_tier(self.context.last_mail_at)
+                    if tier == PARKED_TIER:
+                        await self.park()
+                        return
+                    set_low_priority(tier != HOT_TIER)
+                    max_wait = get_longpoll_wait_sec(tier)
+                    longpoll_metric.labels(tier=tier).inc()
+                    longpoll_saved_metric.inc(max_wait / HOT_LONGPOLL_WAIT_SEC - 1)
                     await self.db.set_handler_context(self.context)
-                    (polling_result, polling_context) = (
-                        await samoware_api.longpoll_updates(polling_context)
-                    )
-                    if samoware_api.has_updates(polling_result):
-                        (mails, polling_context) = await samoware_api.get_new_mails(
-                            polling_context
+                    with tracer.trace(
+                        "poll",
+                        {"user.telegram_id": self.context.telegram_id, "tier": tier},
+                    ) as poll_span:
+                        # the handler is online once its long poll is sent,
+                        # a cold poll is held by the server for a minute
+                        (polling_result, polling_context) = (
+                            await samoware_api.longpoll_updates(
+                                polling_context, max_wait, self.online.set
+                            )
                         )
-                        for mail_header in mails:
-                            incoming_letter_metric.inc()
-                            log.info(f"new mail for {self.context.samoware_login}")
-                            log.debug(f"email flags: {mail_header.flags}")
-                            mail_body = await samoware_api.get_mail_body_by_id(
-                                polling_context, mail_header.uid
+                        if samoware_api.has_updates(polling_result):
+                            polling_context = await self.handle_new_mails(
+                                polling_context, datetime.now(timezone.utc), poll_span
                             )
-                            await self.forward_mail(Mail(mail_header, mail_body))
-                            if await self.db.get_autoread(self.context.telegram_id):
-                                polling_context = await samoware_api.mark_as_read(
-                                    polling_context, mail_header.uid
-                                )
                     self.context.polling_context = polling_context
-                    if datetime.astimezone(
-                        self.context.last_revalidation + REVALIDATE_INTERVAL,
-                        timezone.utc,
-                    ) < datetime.now(timezone.utc):
-                        is_successful_revalidation = await self.revalidate()
+                    if self.revalidation_scheduler.is_due(self.context.telegram_id):
+                        async with self.revalidation_scheduler.slot(
+                            self.context.telegram_id
+                        ):
+                            is_successful_revalidation = await self.revalidate()
                         revalidation_metric.labels(
                             is_successful=is_successful_revalidation
                         ).inc()
@@ -145,6 +212,9 @@ class UserHandler:
                 except UnauthorizedError as error:
                     user_handler_error_metric.labels(type=type(error).__name__).inc()
                     log.info(f"session for {self.context.samoware_login} expired")
+                    if await self.try_resume_session():
+                        relogin_metric.labels(is_successful=True).inc()
+                        continue
                     samoware_password = await self.db.get_password(
                         self.context.telegram_id
                     )
@@ -160,36 +230,119 @@ class UserHandler:
                         await self.db.remove_user(self.context.telegram_id)
                         forced_logout_metric.inc()
                         return
+                    self.revalidation_scheduler.schedule(
+                        self.context.telegram_id, self.context.last_revalidation
+                    )
+                except CircuitOpenError as error:
+                    delay = backoff_delay(retry_count)
+                    log.info(
+                        f"retry_count={retry_count}. Samoware circuit is open. Retrying longpolling for {self.context.samoware_login} in {delay:.1f} seconds..."
+                    )
+                    user_handler_error_metric.labels(type=type(error).__name__).inc()
+                    retry_count += 1
+                    await asyncio.sleep(delay)
                 except (
                     aiohttp.ClientOSError
                 ) as error:  # unknown source error https://github.com/aio-libs/aiohttp/issues/6912
+                    delay = backoff_delay(retry_count)
                     log.warning(
-                        f"retry_count={retry_count}. ClientOSError. Probably Broken pipe. Retrying in {HTTP_RETRY_DELAY_SEC} seconds. {str(error)}"
+                        f"retry_count={retry_count}. ClientOSError. Probably Broken pipe. Retrying in {delay:.1f} seconds. {str(error)}"
                     )
                     user_handler_error_metric.labels(type=type(error).__name__).inc()
                     retry_count += 1
-                    await asyncio.sleep(HTTP_RETRY_DELAY_SEC)
+                    await asyncio.sleep(delay)
                 except Exception as error:
                     log.exception("exception in user_handler")
+                    delay = backoff_delay(retry_count)
                     log.warning(
-                        f"retry_count={retry_count}. Retrying longpolling for {self.context.samoware_login} in {HTTP_RETRY_DELAY_SEC} seconds..."
+                        f"retry_count={retry_count}. Retrying longpolling for {self.context.samoware_login} in {delay:.1f} seconds..."
                     )
                     user_handler_error_metric.labels(type=type(error).__name__).inc()
                     retry_count += 1
-                    await asyncio.sleep(HTTP_RETRY_DELAY_SEC)
+                    await asyncio.sleep(delay)
         finally:
+            self.revalidation_scheduler.unschedule(self.context.telegram_id)
+            self.online.set()
             log.info(f"longpolling for {self.context.samoware_login} stopped")
 
+    async def handle_new_mails(
+        self,
+        polling_context: samoware_api.SamowarePollingContext,
+        notified_at: datetime,
+        poll_span: Span | None = None,
+    ) -> samoware_api.SamowarePollingContext:
+        backlog = MailBacklog(env.get_catch_up_max_letters())
+        has_more = True
+        while has_more:
+            (mails, polling_context, has_more) = await samoware_api.get_new_mails(
+                polling_context, FOLDER_SYNC_PAGE_SIZE
+            )
+            folder_sync_page_metric.inc()
+            for mail_header in mails:
+                if self.context.forwarded_uids.contains(mail_header.uid):
+                    log.debug(f"mail {mail_header.uid} is already forwarded")
+                    duplicate_letter_metric.inc()
+                    continue
+                backlog.add(mail_header)
+            if has_more:
+                # lets the other handlers run between the pages of a large backlog
+                await asyncio.sleep(0)
+        headers_at = datetime.now(timezone.utc)
+
+        summary = backlog.summary()
+        if summary is not None:
+            log.info(
+                f"skipped {backlog.skipped_count} letters of the backlog for {self.context.samoware_login}"
+            )
+            catch_up_skipped_letter_metric.inc(backlog.skipped_count)
+            await self.message_sender(self.context.telegram_id, summary)
+            for uid in backlog.skipped_uids:
+                self.context.forwarded_uids.add(uid)
+            await self.db.set_forwarded_uids(self.context)
+
+        for mail_header in backlog.letters():
+            delivery = Delivery(mail_header.utc_time, notified_at)
+            delivery.stage(HEADERS_STAGE, headers_at)
+            self.context.last_mail_at = datetime.now(timezone.utc)
+            incoming_letter_metric.inc()
+            accountant.account(LETTERS_RESOURCE)
+            log.info(f"new mail for {self.context.samoware_login}")
+            log.debug(f"email flags: {mail_header.flags}")
+            # the sends run in their own tasks and stay in this trace
+            with tracer.trace(
+                "mail",
+                {
+                    "user.telegram_id": self.context.telegram_id,
+                    "mail.uid": mail_header.uid,
+                },
+                links=[poll_span],
+            ):
+                (mail_body, polling_context) = await samoware_api.fetch_mail_body(
+                    polling_context, mail_header
+                )
+                delivery.stage(BODY_STAGE)
+                await self.forward_mail(Mail(mail_header, mail_body), delivery)
+            if await self.db.get_autoread(self.context.telegram_id):
+                polling_context = await samoware_api.mark_as_read(
+                    polling_context, mail_header.uid
+                )
+        return polling_context
+
     async def login(self, samoware_password: str) -> bool:
         log.debug("trying to login")
         retry_count = 0
         while True:
             try:
-                polling_context = await samoware_api.login(
-                    self.context.samoware_login, samoware_password
-                )
-                polling_context = await samoware_api.set_session_info(polling_context)
-                polling_context = await samoware_api.open_inbox(polling_context)
+                with login_duration_metric.labels(path="full").time():
+                    polling_context = await timed_step(
+                        "login",
+                        samoware_api.login(
+                            self.context.samoware_login, samoware_password
+                        ),
+                    )
+                    polling_context = await self.open_session(
+                        polling_context, is_new=True
+                    )
                 self.context.polling_context = polling_context
                 self.context.last_revalidation = datetime.now(timezone.utc)
                 await self.db.set_handler_context(self.context)
@@ -203,36 +356,92 @@ class UserHandler:
                 log.info("login cancelled")
                 return False
             except Exception as error:
+                user_handler_error_metric.labels(type=type(error).__name__).inc()
+                if retry_count + 1 >= LOGIN_MAX_ATTEMPTS:
+                    # the caller decides what to do while samoware is unavailable
+                    log.exception(f"login failed after {LOGIN_MAX_ATTEMPTS} attempts")
+                    raise
+                delay = backoff_delay(retry_count)
                 log.exception(
-                    f"retry_count={retry_count}. exception on login. retrying in {HTTP_RETRY_DELAY_SEC}..."
+                    f"retry_count={retry_count}. exception on login. retrying in {delay:.1f}..."
                 )
-                user_handler_error_metric.labels(type=type(error).__name__).inc()
                 retry_count += 1
-                await asyncio.sleep(HTTP_RETRY_DELAY_SEC)
+                await asyncio.sleep(delay)
+
+    async def open_session(
+        self, polling_context: samoware_api.SamowarePollingContext, is_new: bool
+    ) -> samoware_api.SamowarePollingContext:
+        if not is_new:
+            # the session continues, so the server already has the session info
+            return await self.open_inbox(polling_context)
+        (polling_context, _) = await asyncio.gather(
+            self.open_inbox(polling_context),
+            timed_step("session_info", samoware_api.set_session_info(polling_context)),
+        )
+        return polling_context
+
+    async def open_inbox(
+        self, polling_context: samoware_api.SamowarePollingContext
+    ) -> samoware_api.SamowarePollingContext:
+        polling_context = await timed_step(
+            "prefs", samoware_api.read_prefs(polling_context)
+        )
+        return await timed_step("open_inbox", samoware_api.open_inbox(polling_context))
+
+    async def try_resume_session(self) -> bool:
+        if self.context.polling_context.session == "":
+            return False
+        log.debug(f"trying to resume session for {self.context.samoware_login}")
+        try:
+            return await self.revalidate()
+        except Exception:
+            log.exception("exception on resuming session")
+            return False
 
     async def revalidate(self) -> bool:
         log.debug("trying to revalidate")
         try:
-            polling_context = await samoware_api.revalidate(
-                self.context.samoware_login, self.context.polling_context.session
-            )
-            if polling_context is None:
-                log.info(
-                    f"unsuccessful revalidation for user {self.context.samoware_login}"
+            with login_duration_metric.labels(path="resume").time():
+                polling_context = await timed_step(
+                    "revalidate",
+                    samoware_api.revalidate(
+                        self.context.samoware_login,
+                        self.context.polling_context.session,
+                    ),
+                )
+                if polling_context is None:
+                    log.info(
+                        f"unsuccessful revalidation for user {self.context.samoware_login}"
+                    )
+                    return False
+                polling_context = await self.open_session(
+                    polling_context,
+                    is_new=(
+                        polling_context.session != self.context.polling_context.session
+                    ),
                 )
-                return False
-            polling_context = await samoware_api.set_session_info(polling_context)
-            polling_context = await samoware_api.open_inbox(polling_context)
             self.context.polling_context = polling_context
             self.context.last_revalidation = datetime.now(timezone.utc)
             await self.db.set_handler_context(self.context)
+            self.revalidation_scheduler.schedule(
+                self.context.telegram_id, self.context.last_revalidation
+            )
             log.info(f"successful revalidation for user {self.context.samoware_login}")
             return True
         except UnauthorizedError as error:
-            log.exception("UnauthorizedError on revalidation")
+            # an expired session is an expected outcome, not an error
+            log.info(f"session of {self.context.samoware_login} can not be revalidated")
             user_handler_error_metric.labels(type=type(error).__name__).inc()
             return False
 
+    async def park(self):
+        log.info(f"parking inactive user {self.context.samoware_login}")
+        await self.message_sender(
+            self.context.telegram_id, PARKED_PROMPT, MARKDOWN_FORMAT
+        )
+        await self.db.park_user(self.context.telegram_id)
+        parked_metric.labels(reason="inactive").inc()
+
     async def can_not_revalidate(self):
         await self.message_sender(
             self.context.telegram_id,
@@ -252,20 +461,45 @@ class UserHandler:
             MARKDOWN_FORMAT,
         )
 
-    async def forward_mail(self, mail: Mail):
-        from_str = f'<a href="copy-this-mail.example/{mail.header.from_mail}">{mail.header.from_name}</a>'
-        to_str = ", ".join(
-            f'<a href="copy-this-mail.example/{recipient[0]}">{recipient[1]}</a>'
-            for recipient in mail.header.recipients
-        )
+    async def forward_mail(self, mail: Mail, delivery: Delivery | None = None):
+        with tracer.span("render"):
+            from_str = f'<a href="copy-this-mail.example/{mail.header.from_mail}">{mail.header.from_name}</a>'
+            to_str = ", ".join(
+                f'<a href="copy-this-mail.example/{recipient[0]}">{recipient[1]}</a>'
+                for recipient in mail.header.recipients
+            )
+
+            mail_text = f'{datetime.strftime(mail.header.local_time, "%d.%m.%Y %H:%M")}\n\nОт кого: {from_str}\n\nКому: {to_str}\n\n<b>{mail.header.subject}</b>\n\n{mail.body.text}'
 
-        mail_text = f'{datetime.strftime(mail.header.local_time, "%d.%m.%Y %H:%M")}\n\nОт кого: {from_str}\n\nКому: {to_str}\n\n<b>{mail.header.subject}</b>\n\n{mail.body.text}'
+        if delivery is not None:
+            delivery.stage(RENDERED_STAGE)
 
+        # the letter is stored as in flight before the next poll stores the advanced ack_seq
+        self.context.forwarded_uids.start(mail.header.uid)
+        await self.db.set_forwarded_uids(self.context)
+        # the task copies the context, so the sender sees the delivery
+        token = current_delivery.set(delivery)
         asyncio.create_task(
-            self.message_sender(
-                self.context.telegram_id,
+            self.send_mail(
+                mail.header.uid,
                 mail_text,
-                HTML_FORMAT,
                 mail.body.attachments if len(mail.body.attachments) > 0 else None,
             )
         )
+        current_delivery.reset(token)
+
+    async def send_mail(
+        self, uid: str, mail_text: str, attachments: list[tuple[bytes, str]] | None
+    ) -> None:
+        try:
+            await self.message_sender(
+                self.context.telegram_id, mail_text, HTML_FORMAT, attachments
+            )
+        except Exception:
+            # the letter is forwarded again when the folder reports it next time
+            log.exception(f"letter {uid} is not sent")
+            self.context.forwarded_uids.cancel(uid)
+            await self.db.set_forwarded_uids(self.context)
+            return
+        self.context.forwarded_uids.add(uid)
+        await self.db.set_forwarded_uids(self.context)
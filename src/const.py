@@ -2,8 +2,9 @@
 HTTP_COMMON_TIMEOUT_SEC = 5
 HTTP_FILE_LOAD_TIMEOUT_SEC = 30
 HTTP_CONNECT_LONGPOLL_TIMEOUT_SEC = 60
-HTTP_TOTAL_LONGPOLL_TIMEOUT_SEC = 80
-HTTP_RETRY_DELAY_SEC = 10
+HTTP_LONGPOLL_TIMEOUT_MARGIN_SEC = 60
+HTTP_RETRY_BASE_DELAY_SEC = 2
+HTTP_RETRY_MAX_DELAY_SEC = 120
 TELEGRAM_SEND_RETRY_DELAY_SEC = 2
 
 # tg message formats
@@ -13,3 +14,9 @@ MARKDOWN_FORMAT = "markdown"
 # logs
 LOGGER_FOLDER_PATH = "logs"
 LOGGER_PATH = f"{LOGGER_FOLDER_PATH}/samowarium.log"
+LOGGER_WORKER_PATH_FORMAT = LOGGER_FOLDER_PATH + "/samowarium-{}.log"
+LOGGER_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+DEBUG_PAYLOAD_MAX_LENGTH = 2000
+
+# admin
+ADMIN_ARTIFACTS_FOLDER_PATH = "artifacts"
@@ -1,6 +1,46 @@
+import bisect
 from datetime import datetime, timezone
 from samoware_api import SamowarePollingContext
 
+FORWARDED_UIDS_WINDOW = 50
+
+
+# letters in a folder get increasing UIDs, so everything below the high-water
+# mark is already handled and only the latest UIDs are kept one by one
+class ForwardedUids:
+    def __init__(self, high_water: int = 0, recent: list[int] | None = None) -> None:
+        self.high_water = high_water
+        self.recent = sorted(recent or [])
+        # letters being sent, the high-water mark does not pass them
+        self.in_flight: set[int] = set()
+
+    def contains(self, uid: str) -> bool:
+        value = int(uid)
+        return (
+            value <= self.high_water or value in self.recent or value in self.in_flight
+        )
+
+    def start(self, uid: str) -> None:
+        self.in_flight.add(int(uid))
+
+    def cancel(self, uid: str) -> None:
+        self.in_flight.discard(int(uid))
+
+    def add(self, uid: str) -> None:
+        value = int(uid)
+        self.in_flight.discard(value)
+        if self.contains(uid):
+            return
+        bisect.insort(self.recent, value)
+        while len(self.recent) > FORWARDED_UIDS_WINDOW and (
+            len(self.in_flight) == 0 or self.recent[0] < min(self.in_flight)
+        ):
+            self.high_water = max(self.high_water, self.recent.pop(0))
+
+    def stored(self) -> list[int]:
+        # a send interrupted by a restart may have reached telegram, so it is not repeated
+        return sorted(self.recent + list(self.in_flight))
+
 
 class Context:
     def __init__(
@@ -9,6 +49,8 @@ class Context:
         samoware_login: str,
         polling_context: SamowarePollingContext | None = None,
         last_revalidation: datetime | None = None,
+        last_mail_at: datetime | None = None,
+        forwarded_uids: ForwardedUids | None = None,
     ) -> None:
         self.telegram_id = telegram_id
         self.samoware_login = samoware_login
@@ -18,3 +60,9 @@ class Context:
         self.last_revalidation = last_revalidation
         if self.last_revalidation is None:
             self.last_revalidation = datetime.now(timezone.utc)
+        self.last_mail_at = last_mail_at
+        if self.last_mail_at is None:
+            self.last_mail_at = datetime.now(timezone.utc)
+        self.forwarded_uids = forwarded_uids
+        if self.forwarded_uids is None:
+            self.forwarded_uids = ForwardedUids()
@@ -1,11 +1,28 @@
 from http.cookies import SimpleCookie
+import json
 import logging as log
+from typing import AsyncIterator
 from encryption import Encrypter
 from samoware_api import SamowarePollingContext
-from context import Context
+from context import Context, ForwardedUids
 import migrations
+from psycopg import AsyncConnection
 from psycopg_pool import AsyncConnectionPool
 import env
+from metrics import db_cache_metric
+
+USERS_PAGE_SIZE = 100
+MIN_TELEGRAM_ID = -(2**63)
+
+CONTEXT_COLUMNS = "samoware_login, samoware_cookies, samoware_session, samoware_ack_seq, samoware_request_id, samoware_command_id, samoware_rand, last_revalidation, last_mail_at, forwarded_uid_high_water, forwarded_uids"
+
+USER_CHANGES_CHANNEL = "user_changes"
+USER_ADDED_EVENT = "added"
+USER_REMOVED_EVENT = "removed"
+AUTOREAD_CHANGED_EVENT = "autoread"
+PASSWORD_CHANGED_EVENT = "password"
+USER_PARKED_EVENT = "parked"
+USER_UNPARKED_EVENT = "unparked"
 
 
 def make_context(telegram_id: int, row: tuple) -> Context:
@@ -23,6 +40,19 @@ def make_context(telegram_id: int, row: tuple) -> Context:
             rand=row[6],
         ),
         last_revalidation=row[7],
+        last_mail_at=row[8],
+        forwarded_uids=ForwardedUids(row[9] or 0, row[10]),
+    )
+
+
+async def notify_user_change(conn: AsyncConnection, telegram_id: int, event: str):
+    # delivered to the listeners when the transaction is committed
+    await conn.execute(
+        "SELECT pg_notify(%s, %s)",
+        (
+            USER_CHANGES_CHANNEL,
+            json.dumps({"telegram_id": telegram_id, "event": event}),
+        ),
     )
 
 
@@ -43,10 +73,15 @@ class Database:
         log.debug("initializing db...")
         self.pool = make_connection_pool()
         self.encrypter = encrypter
-        migrations.apply()
+        self.is_cache_enabled = False
+        self.cache_generation = 0
+        self.active_cache: dict[int, bool] = {}
+        self.autoread_cache: dict[int, bool] = {}
         log.info("db has initialized")
 
     async def open(self):
+        if env.is_migrations_on_start_enabled():
+            await migrations.apply_if_needed()
         await self.pool.open()
         log.info("db has opened")
 
@@ -58,13 +93,36 @@ class Database:
         await self.pool.close()
         log.info("db was closed")
 
+    def enable_cache(self) -> None:
+        # caches are valid only while change notifications are received
+        self.cache_generation += 1
+        self.active_cache.clear()
+        self.autoread_cache.clear()
+        self.is_cache_enabled = True
+        log.info("db cache is enabled")
+
+    def disable_cache(self) -> None:
+        self.is_cache_enabled = False
+        self.cache_generation += 1
+        self.active_cache.clear()
+        self.autoread_cache.clear()
+        log.info("db cache is disabled")
+
+    def invalidate_user(self, telegram_id: int) -> None:
+        # prevents caching of values read before the invalidation
+        self.cache_generation += 1
+        self.active_cache.pop(telegram_id, None)
+        self.autoread_cache.pop(telegram_id, None)
+
     async def add_user(self, telegram_id: int, ctx: Context) -> None:
         pctx = ctx.polling_context
         async with self.pool.connection() as conn:
             await conn.execute(
                 "INSERT INTO users \
                  (telegram_id, samoware_login, samoware_password, samoware_cookies, samoware_session, samoware_ack_seq, samoware_request_id, samoware_command_id, samoware_rand, last_revalidation, autoread) VALUES \
-                 (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                 (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) \
+                 ON CONFLICT (telegram_id) DO UPDATE SET \
+                 samoware_login=EXCLUDED.samoware_login, samoware_password=EXCLUDED.samoware_password, samoware_cookies=EXCLUDED.samoware_cookies, samoware_session=EXCLUDED.samoware_session, samoware_ack_seq=EXCLUDED.samoware_ack_seq, samoware_request_id=EXCLUDED.samoware_request_id, samoware_command_id=EXCLUDED.samoware_command_id, samoware_rand=EXCLUDED.samoware_rand, last_revalidation=EXCLUDED.last_revalidation, autoread=EXCLUDED.autoread, parked_at=NULL, last_mail_at=now()",
                 (
                     telegram_id,
                     ctx.samoware_login,
@@ -79,7 +137,9 @@ class Database:
                     False,
                 ),
             )
+            await notify_user_change(conn, telegram_id, USER_ADDED_EVENT)
             await conn.commit()
+            self.invalidate_user(telegram_id)
             log.debug(f"user {telegram_id} has inserted")
 
     async def set_password(self, telegram_id: int, password: str) -> None:
@@ -88,7 +148,9 @@ class Database:
                 "UPDATE users SET samoware_password=%s WHERE telegram_id=%s",
                 (self.encrypter.encrypt(password), telegram_id),
             )
+            await notify_user_change(conn, telegram_id, PASSWORD_CHANGED_EVENT)
             await conn.commit()
+            self.invalidate_user(telegram_id)
             log.debug(f"set password for the user {telegram_id}")
 
     async def set_handler_context(self, ctx: Context) -> None:
@@ -96,7 +158,7 @@ class Database:
         async with self.pool.connection() as conn:
             await conn.execute(
                 "UPDATE users \
-                 SET samoware_cookies=%s, samoware_session=%s, samoware_ack_seq=%s, samoware_request_id=%s, samoware_command_id=%s, samoware_rand=%s, last_revalidation=%s \
+                 SET samoware_cookies=%s, samoware_session=%s, samoware_ack_seq=%s, samoware_request_id=%s, samoware_command_id=%s, samoware_rand=%s, last_revalidation=%s, last_mail_at=%s, forwarded_uid_high_water=%s, forwarded_uids=%s \
                  WHERE telegram_id=%s",
                 (
                     pctx.cookies.output(header=""),
@@ -106,17 +168,33 @@ class Database:
                     pctx.command_id,
                     pctx.rand,
                     ctx.last_revalidation,
+                    ctx.last_mail_at,
+                    ctx.forwarded_uids.high_water,
+                    ctx.forwarded_uids.stored(),
                     ctx.telegram_id,
                 ),
             )
             await conn.commit()
             log.debug(f"samoware context for the user {ctx.telegram_id} has inserted")
 
+    async def set_forwarded_uids(self, ctx: Context) -> None:
+        async with self.pool.connection() as conn:
+            await conn.execute(
+                "UPDATE users SET forwarded_uid_high_water=%s, forwarded_uids=%s WHERE telegram_id=%s",
+                (
+                    ctx.forwarded_uids.high_water,
+                    ctx.forwarded_uids.stored(),
+                    ctx.telegram_id,
+                ),
+            )
+            await conn.commit()
+            log.debug(f"forwarded uids of the user {ctx.telegram_id} have updated")
+
     async def get_samoware_context(self, telegram_id: int) -> Context | None:
         async with self.pool.connection() as conn:
             row = await (
                 await conn.execute(
-                    "SELECT samoware_login, samoware_cookies, samoware_session, samoware_ack_seq, samoware_request_id, samoware_command_id, samoware_rand, last_revalidation \
+                    f"SELECT {CONTEXT_COLUMNS} \
                 FROM users \
                 WHERE telegram_id=%s",
                     (telegram_id,),
@@ -148,16 +226,23 @@ class Database:
             )
 
     async def is_user_active(self, telegram_id: int) -> bool:
+        if self.is_cache_enabled and telegram_id in self.active_cache:
+            db_cache_metric.labels(cache="active", result="hit").inc()
+            return self.active_cache[telegram_id]
+        db_cache_metric.labels(cache="active", result="miss").inc()
+        generation = self.cache_generation
         async with self.pool.connection() as conn:
             is_active = (
                 await (
                     await conn.execute(
-                        "SELECT COUNT(*) FROM users WHERE telegram_id = %s",
+                        "SELECT COUNT(*) FROM users WHERE telegram_id = %s AND parked_at IS NULL",
                         (int(telegram_id),),
                     )
                 ).fetchone()
             )[0] != 0
             await conn.commit()
+            if self.is_cache_enabled and generation == self.cache_generation:
+                self.active_cache[telegram_id] = is_active
             log.debug(f"user {telegram_id} is active: {is_active}")
             return is_active
 
@@ -171,7 +256,7 @@ class Database:
                     mapper,
                     await (
                         await conn.execute(
-                            "SELECT telegram_id, samoware_login, samoware_cookies, samoware_session, samoware_ack_seq, samoware_request_id, samoware_command_id, samoware_rand, last_revalidation \
+                            f"SELECT telegram_id, {CONTEXT_COLUMNS} \
                          FROM users"
                         )
                     ).fetchall(),
@@ -183,6 +268,134 @@ class Database:
             )
             return users
 
+    async def iterate_all_users(
+        self, shard_count: int = 1, shard_index: int = 0
+    ) -> AsyncIterator[Context]:
+        # every page is a short transaction, nothing is held while the users are started
+        last_telegram_id = MIN_TELEGRAM_ID
+        while True:
+            async with self.pool.connection() as conn:
+                rows = await (
+                    await conn.execute(
+                        f"SELECT telegram_id, {CONTEXT_COLUMNS} \
+                         FROM users \
+                         WHERE telegram_id %% %s = %s AND parked_at IS NULL \
+                         AND telegram_id > %s \
+                         ORDER BY telegram_id LIMIT %s",
+                        (
+                            shard_count,
+                            shard_index,
+                            last_telegram_id,
+                            USERS_PAGE_SIZE,
+                        ),
+                    )
+                ).fetchall()
+                await conn.commit()
+            log.debug(f"fetched a page of {len(rows)} users from database")
+            for row in rows:
+                yield make_context(telegram_id=row[0], row=row[1:])
+            if len(rows) < USERS_PAGE_SIZE:
+                return
+            last_telegram_id = rows[-1][0]
+
+    async def heartbeat_node(self, node_id: str, ttl_sec: int) -> int:
+        async with self.pool.connection() as conn:
+            await conn.execute(
+                "INSERT INTO nodes (node_id, heartbeat_at) VALUES (%s, now()) \
+                 ON CONFLICT (node_id) DO UPDATE SET heartbeat_at=now()",
+                (node_id,),
+            )
+            await conn.execute(
+                "DELETE FROM nodes WHERE heartbeat_at < now() - make_interval(secs => %s)",
+                (ttl_sec,),
+            )
+            nodes_count = (
+                await (await conn.execute("SELECT COUNT(*) FROM nodes")).fetchone()
+            )[0]
+            await conn.commit()
+            log.debug(f"heartbeat of node {node_id}, alive nodes {nodes_count}")
+            return nodes_count
+
+    async def remove_node(self, node_id: str) -> None:
+        async with self.pool.connection() as conn:
+            await conn.execute("DELETE FROM nodes WHERE node_id=%s", (node_id,))
+            await conn.commit()
+            log.debug(f"node {node_id} was removed")
+
+    async def count_users(self) -> int:
+        async with self.pool.connection() as conn:
+            count = (
+                await (
+                    await conn.execute(
+                        "SELECT COUNT(*) FROM users WHERE parked_at IS NULL"
+                    )
+                ).fetchone()
+            )[0]
+            await conn.commit()
+            return count
+
+    async def renew_leases(self, node_id: str, ttl_sec: int) -> set[int]:
+        async with self.pool.connection() as conn:
+            rows = await (
+                await conn.execute(
+                    "UPDATE users SET lease_expires_at=now() + make_interval(secs => %s) \
+                     WHERE lease_owner=%s AND lease_expires_at >= now() AND parked_at IS NULL \
+                     RETURNING telegram_id",
+                    (ttl_sec, node_id),
+                )
+            ).fetchall()
+            await conn.commit()
+            log.debug(f"node {node_id} renewed {len(rows)} leases")
+            return set(row[0] for row in rows)
+
+    async def claim_leases(
+        self, node_id: str, ttl_sec: int, limit: int
+    ) -> list[Context]:
+        async with self.pool.connection() as conn:
+            rows = await (
+                await conn.execute(
+                    f"UPDATE users SET lease_owner=%s, lease_expires_at=now() + make_interval(secs => %s) \
+                     WHERE telegram_id IN ( \
+                         SELECT telegram_id FROM users \
+                         WHERE (lease_owner IS NULL OR lease_expires_at < now()) AND parked_at IS NULL \
+                         LIMIT %s FOR UPDATE SKIP LOCKED \
+                     ) \
+                     RETURNING telegram_id, {CONTEXT_COLUMNS}",
+                    (node_id, ttl_sec, limit),
+                )
+            ).fetchall()
+            await conn.commit()
+            log.debug(f"node {node_id} claimed {len(rows)} leases")
+            return [make_context(telegram_id=row[0], row=row[1:]) for row in rows]
+
+    async def claim_lease(self, telegram_id: int, node_id: str, ttl_sec: int) -> bool:
+        async with self.pool.connection() as conn:
+            # a live lease of another node is not taken over
+            is_claimed = (
+                (
+                    await conn.execute(
+                        "UPDATE users SET lease_owner=%s, lease_expires_at=now() + make_interval(secs => %s) \
+                     WHERE telegram_id=%s AND parked_at IS NULL \
+                     AND (lease_owner IS NULL OR lease_owner=%s OR lease_expires_at < now())",
+                        (node_id, ttl_sec, telegram_id, node_id),
+                    )
+                ).rowcount
+                > 0
+            )
+            await conn.commit()
+            log.debug(f"node {node_id} claimed lease of {telegram_id}: {is_claimed}")
+            return is_claimed
+
+    async def release_leases(self, node_id: str, telegram_ids: list[int]) -> None:
+        async with self.pool.connection() as conn:
+            await conn.execute(
+                "UPDATE users SET lease_owner=NULL, lease_expires_at=NULL \
+                 WHERE lease_owner=%s AND telegram_id = ANY(%s)",
+                (node_id, telegram_ids),
+            )
+            await conn.commit()
+            log.debug(f"node {node_id} released {len(telegram_ids)} leases")
+
     async def get_all_users_stat(self) -> list[tuple[bool, bool]]:
         def mapper(row):
             (password, autoread) = row
@@ -208,10 +421,40 @@ class Database:
             )
             return users
 
+    async def park_user(self, telegram_id: int) -> None:
+        async with self.pool.connection() as conn:
+            # a parked user is not handled by any node, so the lease is freed
+            await conn.execute(
+                "UPDATE users SET parked_at=now(), lease_owner=NULL, lease_expires_at=NULL \
+                 WHERE telegram_id=%s AND parked_at IS NULL",
+                (telegram_id,),
+            )
+            await notify_user_change(conn, telegram_id, USER_PARKED_EVENT)
+            await conn.commit()
+            self.invalidate_user(telegram_id)
+            log.debug(f"user {telegram_id} was parked")
+
+    async def unpark_user(self, telegram_id: int) -> bool:
+        async with self.pool.connection() as conn:
+            is_unparked = (
+                await conn.execute(
+                    "UPDATE users SET parked_at=NULL, last_mail_at=now() WHERE telegram_id=%s AND parked_at IS NOT NULL",
+                    (telegram_id,),
+                )
+            ).rowcount > 0
+            if is_unparked:
+                await notify_user_change(conn, telegram_id, USER_UNPARKED_EVENT)
+            await conn.commit()
+            self.invalidate_user(telegram_id)
+            log.debug(f"user {telegram_id} was unparked: {is_unparked}")
+            return is_unparked
+
     async def remove_user(self, telegram_id: int) -> None:
         async with self.pool.connection() as conn:
             await conn.execute("DELETE FROM users WHERE telegram_id=%s", (telegram_id,))
+            await notify_user_change(conn, telegram_id, USER_REMOVED_EVENT)
             await conn.commit()
+            self.invalidate_user(telegram_id)
             log.debug(f"user {telegram_id} was removed")
 
     async def set_autoread(self, telegram_id: int, enabled: bool) -> None:
@@ -223,10 +466,17 @@ class Database:
                     telegram_id,
                 ),
             )
+            await notify_user_change(conn, telegram_id, AUTOREAD_CHANGED_EVENT)
             await conn.commit()
+            self.invalidate_user(telegram_id)
             log.debug(f"autoread for {telegram_id} was set to {enabled}")
 
     async def get_autoread(self, telegram_id: int) -> bool:
+        if self.is_cache_enabled and telegram_id in self.autoread_cache:
+            db_cache_metric.labels(cache="autoread", result="hit").inc()
+            return self.autoread_cache[telegram_id]
+        db_cache_metric.labels(cache="autoread", result="miss").inc()
+        generation = self.cache_generation
         async with self.pool.connection() as conn:
             enabled = (
                 await (
@@ -237,5 +487,7 @@ class Database:
                 ).fetchone()
             )[0]
             await conn.commit()
+            if self.is_cache_enabled and generation == self.cache_generation:
+                self.autoread_cache[telegram_id] = enabled
             log.debug(f"autoread for {telegram_id} is set to {enabled}")
             return enabled
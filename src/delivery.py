@@ -0,0 +1,47 @@
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+from metrics import (
+    mail_delivery_stage_metric,
+    mail_delivery_latency_metric,
+    mail_delivery_slo_metric,
+)
+
+NOTIFIED_STAGE = "notified"
+HEADERS_STAGE = "headers"
+BODY_STAGE = "body"
+RENDERED_STAGE = "rendered"
+MESSAGE_SENT_STAGE = "message_sent"
+ATTACHMENTS_SENT_STAGE = "attachments_sent"
+
+DELIVERY_SLO_SEC = (10, 30, 60, 300)
+
+
+# latencies are counted from INTERNALDATE, so they rely on synchronized clocks
+class Delivery:
+    def __init__(self, internal_date: datetime, notified_at: datetime) -> None:
+        self.internal_date = internal_date.replace(tzinfo=timezone.utc)
+        self.last_stage_at = self.internal_date
+        self.stage(NOTIFIED_STAGE, notified_at)
+
+    def stage(self, name: str, at: datetime | None = None) -> None:
+        if at is None:
+            at = datetime.now(timezone.utc)
+        mail_delivery_stage_metric.labels(stage=name).observe(
+            max(0, (at - self.last_stage_at).total_seconds())
+        )
+        mail_delivery_latency_metric.labels(stage=name).observe(
+            max(0, (at - self.internal_date).total_seconds())
+        )
+        self.last_stage_at = at
+
+    def delivered(self) -> None:
+        total = (self.last_stage_at - self.internal_date).total_seconds()
+        for slo in DELIVERY_SLO_SEC:
+            mail_delivery_slo_metric.labels(slo=f"{slo}s", is_met=total <= slo).inc()
+
+
+# set for the send of a forwarded letter
+current_delivery: ContextVar[Delivery | None] = ContextVar(
+    "current_delivery", default=None
+)
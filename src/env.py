@@ -34,6 +34,122 @@ def get_prometheus_metrics_server_port() -> int:
     return int(get_var_or_default("PROMETHEUS_METRICS_SERVER_PORT", 53000))
 
 
+def get_workers_count() -> int:
+    return int(get_var_or_default("WORKERS", 1))
+
+
+def get_admin_server_host() -> str:
+    return get_var_or_default("ADMIN_SERVER_HOST", "127.0.0.1")
+
+
+def get_admin_server_port() -> int:
+    return int(get_var_or_default("ADMIN_SERVER_PORT", 53100))
+
+
+def get_admin_token() -> str | None:
+    return get_var_or_default("ADMIN_TOKEN", None)
+
+
+def get_node_id() -> str | None:
+    return get_var_or_default("NODE_ID", None)
+
+
+def get_lease_ttl_sec() -> int:
+    return int(get_var_or_default("LEASE_TTL_SEC", 60))
+
+
+def get_lease_heartbeat_sec() -> int:
+    return int(get_var_or_default("LEASE_HEARTBEAT_SEC", 10))
+
+
+def get_lease_claim_batch() -> int:
+    return int(get_var_or_default("LEASE_CLAIM_BATCH", 100))
+
+
+def get_cold_after_hours() -> float:
+    return float(get_var_or_default("COLD_AFTER_HOURS", 24))
+
+
+def get_cold_longpoll_wait_sec() -> int:
+    return int(get_var_or_default("COLD_LONGPOLL_WAIT_SEC", 60))
+
+
+def get_park_inactive_after_days() -> float:
+    return float(get_var_or_default("PARK_INACTIVE_AFTER_DAYS", 0))
+
+
+def get_catch_up_max_letters() -> int:
+    return int(get_var_or_default("CATCH_UP_MAX_LETTERS", 20))
+
+
+def get_attachment_max_size_bytes() -> int:
+    return int(get_var_or_default("ATTACHMENT_MAX_SIZE_MB", 50)) * 1024 * 1024
+
+
+def get_mail_body_mode() -> str:
+    return get_var_or_default("MAIL_BODY_MODE", "full")
+
+
+def get_telegram_concurrent_updates() -> int:
+    return int(get_var_or_default("TELEGRAM_CONCURRENT_UPDATES", 16))
+
+
+def get_login_concurrency() -> int:
+    return int(get_var_or_default("LOGIN_CONCURRENCY", 8))
+
+
+def get_telegram_api_url() -> str | None:
+    return get_var_or_default("TELEGRAM_API_URL", None)
+
+
+def get_telegram_webhook_url() -> str | None:
+    return get_var_or_default("TELEGRAM_WEBHOOK_URL", None)
+
+
+def get_telegram_webhook_host() -> str:
+    return get_var_or_default("TELEGRAM_WEBHOOK_HOST", "0.0.0.0")
+
+
+def get_telegram_webhook_port() -> int:
+    return int(get_var_or_default("TELEGRAM_WEBHOOK_PORT", 8443))
+
+
+def get_telegram_webhook_max_connections() -> int:
+    return int(get_var_or_default("TELEGRAM_WEBHOOK_MAX_CONNECTIONS", 40))
+
+
+def get_telegram_webhook_secret() -> str | None:
+    return get_var_or_default("TELEGRAM_WEBHOOK_SECRET", None)
+
+
+def get_loop_slow_callback_sec() -> float:
+    return float(get_var_or_default("LOOP_SLOW_CALLBACK_SEC", 0.5))
+
+
+def get_tracing_sample_rate() -> float:
+    return float(get_var_or_default("TRACING_SAMPLE_RATE", 0))
+
+
+def get_tracing_file_path() -> str:
+    return get_var_or_default("TRACING_FILE", "logs/traces.jsonl")
+
+
+def get_log_max_bytes() -> int:
+    return int(get_var_or_default("LOG_MAX_MB", 100)) * 1024 * 1024
+
+
+def get_log_rotate_when() -> str:
+    return get_var_or_default("LOG_ROTATE_WHEN", "midnight")
+
+
+def get_log_backup_count() -> int:
+    return int(get_var_or_default("LOG_BACKUP_COUNT", 14))
+
+
+def get_log_queue_size() -> int:
+    return int(get_var_or_default("LOG_QUEUE_SIZE", 10000))
+
+
 def get_postgres_db() -> str:
     return get_var_or_throw("POSTGRES_DB")
 
@@ -54,6 +170,66 @@ def get_postgres_connections_count() -> str:
     return int(get_var_or_default("POSTGRES_CONNECTIONS_COUNT", 4))
 
 
+def get_startup_rate() -> float:
+    return float(get_var_or_default("STARTUP_RATE", 20))
+
+
+def get_startup_jitter_sec() -> float:
+    return float(get_var_or_default("STARTUP_JITTER_SEC", 1))
+
+
+def get_startup_concurrency() -> int:
+    return int(get_var_or_default("STARTUP_CONCURRENCY", 50))
+
+
+def get_revalidation_concurrency() -> int:
+    return int(get_var_or_default("REVALIDATION_CONCURRENCY", 10))
+
+
+def get_revalidation_jitter_sec() -> float:
+    return float(get_var_or_default("REVALIDATION_JITTER_SEC", 30 * 60))
+
+
+def get_revalidation_overdue_spread_sec() -> float:
+    return float(get_var_or_default("REVALIDATION_OVERDUE_SPREAD_SEC", 10 * 60))
+
+
+def get_samoware_url() -> str:
+    return get_var_or_default("SAMOWARE_URL", "https://student.bmstu.ru")
+
+
+def get_samoware_login_url() -> str:
+    return get_var_or_default("SAMOWARE_LOGIN_URL", "https://mailstudent.bmstu.ru")
+
+
+def get_samoware_rate_limit() -> float:
+    return float(get_var_or_default("SAMOWARE_RATE_LIMIT", 50))
+
+
+def get_samoware_rate_burst() -> float:
+    return float(get_var_or_default("SAMOWARE_RATE_BURST", 100))
+
+
+def get_samoware_min_concurrency() -> int:
+    return int(get_var_or_default("SAMOWARE_MIN_CONCURRENCY", 4))
+
+
+def get_samoware_max_concurrency() -> int:
+    return int(get_var_or_default("SAMOWARE_MAX_CONCURRENCY", 64))
+
+
+def get_samoware_target_latency_sec() -> float:
+    return float(get_var_or_default("SAMOWARE_TARGET_LATENCY_SEC", 2))
+
+
+def get_samoware_breaker_failure_rate() -> float:
+    return float(get_var_or_default("SAMOWARE_BREAKER_FAILURE_RATE", 0.5))
+
+
+def get_samoware_breaker_cooldown_sec() -> float:
+    return float(get_var_or_default("SAMOWARE_BREAKER_COOLDOWN_SEC", 30))
+
+
 def get_postgres_connection_string() -> str:
     return "postgresql://{}:{}@{}/{}".format(
         get_postgres_user(),
@@ -67,6 +243,26 @@ def is_ip_check_enabled() -> bool:
     return get_var_or_default("IP_CHECK", None) is not None
 
 
+def is_telegram_webhook_enabled() -> bool:
+    return get_telegram_webhook_url() is not None
+
+
+def is_tracing_enabled() -> bool:
+    return get_tracing_sample_rate() > 0
+
+
+def is_loop_monitor_enabled() -> bool:
+    return get_var_or_default("LOOP_MONITOR", None) is not None
+
+
+def is_leasing_enabled() -> bool:
+    return get_var_or_default("LEASING", None) is not None
+
+
+def is_migrations_on_start_enabled() -> bool:
+    return get_var_or_default("SKIP_MIGRATIONS", None) is None
+
+
 def is_dev_profile() -> bool:
     return get_profile() == "DEV"
 
@@ -79,5 +275,9 @@ def is_debug() -> bool:
     return get_var_or_default("DEBUG", None) is not None
 
 
+def is_admin_server_enabled() -> bool:
+    return get_var_or_default("ENABLE_ADMIN_SERVER", None) is not None
+
+
 def is_prometheus_metrics_server_enabled() -> bool:
     return get_var_or_default("ENABLE_PROMETHEUS_METRICS_SERVER", None) is not None
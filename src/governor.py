@@ -0,0 +1,299 @@
+import asyncio
+import functools
+import heapq
+import itertools
+import logging as log
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator
+from urllib.error import HTTPError
+
+import aiohttp
+
+from const import HTTP_RETRY_BASE_DELAY_SEC, HTTP_RETRY_MAX_DELAY_SEC
+import env
+from instrumentation import instrumented
+from metrics import (
+    governor_tokens_metric,
+    governor_concurrency_limit_metric,
+    governor_in_flight_metric,
+    governor_circuit_state_metric,
+    governor_rejected_metric,
+)
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+CIRCUIT_STATE_VALUES = {CIRCUIT_CLOSED: 0, CIRCUIT_HALF_OPEN: 1, CIRCUIT_OPEN: 2}
+
+AIMD_DECREASE_FACTOR = 0.5
+AIMD_LATENCY_DECREASE_FACTOR = 0.9
+BREAKER_WINDOW_SIZE = 100
+BREAKER_MIN_REQUESTS = 20
+BREAKER_HALF_OPEN_PROBES = 3
+# low priority requests wait behind the others that came up to this much later
+LOW_PRIORITY_DELAY_SEC = 5
+
+FAILURE_EXCEPTIONS = (aiohttp.ClientError, asyncio.TimeoutError, HTTPError)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+is_low_priority = ContextVar("is_low_priority", default=False)
+
+
+def set_low_priority(value: bool) -> None:
+    # applies to the requests of the current task
+    is_low_priority.set(value)
+
+
+def backoff_delay(retry_count: int) -> float:
+    # exponential backoff with full jitter
+    return random.uniform(
+        0, min(HTTP_RETRY_MAX_DELAY_SEC, HTTP_RETRY_BASE_DELAY_SEC * 2**retry_count)
+    )
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        # (turn, arrival order, waiter), the earliest turn gets the next token
+        self.waiters: list[tuple[float, int, asyncio.Future]] = []
+        self.arrivals = itertools.count()
+        self.dispatcher: asyncio.Task | None = None
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def take(self) -> None:
+        self.tokens -= 1
+        governor_tokens_metric.set(self.tokens)
+
+    async def acquire(self, is_low_priority: bool = False) -> None:
+        self.refill()
+        if len(self.waiters) == 0 and self.tokens >= 1:
+            self.take()
+            return
+        turn = time.monotonic() + (LOW_PRIORITY_DELAY_SEC if is_low_priority else 0)
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (turn, next(self.arrivals), waiter))
+        if self.dispatcher is None:
+            self.dispatcher = asyncio.create_task(self.dispatch())
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the token was given right before the cancellation
+                self.tokens += 1
+            raise
+
+    async def dispatch(self) -> None:
+        try:
+            while len(self.waiters) > 0:
+                self.refill()
+                if self.tokens < 1:
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+                    continue
+                (_, _, waiter) = heapq.heappop(self.waiters)
+                if waiter.done():
+                    continue
+                self.take()
+                waiter.set_result(None)
+        finally:
+            self.dispatcher = None
+
+
+class AimdLimiter:
+    def __init__(
+        self, min_limit: int, max_limit: int, target_latency_sec: float
+    ) -> None:
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency_sec = target_latency_sec
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+        governor_concurrency_limit_metric.set(self.limit)
+
+    async def acquire(self) -> None:
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+            governor_in_flight_metric.set(self.in_flight)
+
+    async def release(self) -> None:
+        async with self.condition:
+            self.in_flight -= 1
+            governor_in_flight_metric.set(self.in_flight)
+            self.condition.notify_all()
+
+    def on_success(self, latency_sec: float) -> None:
+        if latency_sec > self.target_latency_sec:
+            self.limit = max(self.min_limit, self.limit * AIMD_LATENCY_DECREASE_FACTOR)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        governor_concurrency_limit_metric.set(self.limit)
+
+    def on_failure(self) -> None:
+        self.limit = max(self.min_limit, self.limit * AIMD_DECREASE_FACTOR)
+        governor_concurrency_limit_metric.set(self.limit)
+
+
+class CircuitBreaker:
+    def __init__(self, failure_rate: float, cooldown_sec: float) -> None:
+        self.failure_rate = failure_rate
+        self.cooldown_sec = cooldown_sec
+        self.outcomes: deque[bool] = deque(maxlen=BREAKER_WINDOW_SIZE)
+        self.opened_at = 0.0
+        self.probes = 0
+        self.probe_successes = 0
+        # a probe of an earlier half-open period must not free a slot of the current one
+        self.half_open_generation = 0
+        self.state = CIRCUIT_CLOSED
+        governor_circuit_state_metric.set(CIRCUIT_STATE_VALUES[CIRCUIT_CLOSED])
+
+    def set_state(self, state: str) -> None:
+        if self.state != state:
+            log.warning(f"samoware circuit breaker is {state}")
+        self.state = state
+        governor_circuit_state_metric.set(CIRCUIT_STATE_VALUES[state])
+
+    # returns the generation of the taken probe slot, if any
+    def before_request(self) -> int | None:
+        if self.state == CIRCUIT_OPEN:
+            if time.monotonic() - self.opened_at < self.cooldown_sec:
+                governor_rejected_metric.labels(reason="circuit_open").inc()
+                raise CircuitOpenError
+            self.probes = 0
+            self.probe_successes = 0
+            self.half_open_generation += 1
+            self.set_state(CIRCUIT_HALF_OPEN)
+        if self.state == CIRCUIT_HALF_OPEN:
+            if self.probes >= BREAKER_HALF_OPEN_PROBES:
+                governor_rejected_metric.labels(reason="circuit_half_open").inc()
+                raise CircuitOpenError
+            self.probes += 1
+            return self.half_open_generation
+        return None
+
+    def release_probe(self, generation: int | None) -> None:
+        # a cancelled probe has no outcome, so its slot is given to the next request
+        if (
+            generation is not None
+            and self.state == CIRCUIT_HALF_OPEN
+            and generation == self.half_open_generation
+        ):
+            self.probes -= 1
+
+    def on_success(self) -> None:
+        if self.state == CIRCUIT_HALF_OPEN:
+            self.probe_successes += 1
+            if self.probe_successes >= BREAKER_HALF_OPEN_PROBES:
+                self.outcomes.clear()
+                self.set_state(CIRCUIT_CLOSED)
+            return
+        self.outcomes.append(True)
+
+    def on_failure(self) -> None:
+        if self.state == CIRCUIT_HALF_OPEN:
+            self.open()
+            return
+        self.outcomes.append(False)
+        failures = self.outcomes.count(False)
+        if (
+            len(self.outcomes) >= BREAKER_MIN_REQUESTS
+            and failures / len(self.outcomes) >= self.failure_rate
+        ):
+            self.open()
+
+    def open(self) -> None:
+        self.opened_at = time.monotonic()
+        self.outcomes.clear()
+        self.set_state(CIRCUIT_OPEN)
+
+
+class SamowareGovernor:
+    def __init__(self) -> None:
+        self.bucket = TokenBucket(
+            env.get_samoware_rate_limit(), env.get_samoware_rate_burst()
+        )
+        self.limiter = AimdLimiter(
+            env.get_samoware_min_concurrency(),
+            env.get_samoware_max_concurrency(),
+            env.get_samoware_target_latency_sec(),
+        )
+        self.breaker = CircuitBreaker(
+            env.get_samoware_breaker_failure_rate(),
+            env.get_samoware_breaker_cooldown_sec(),
+        )
+
+    @asynccontextmanager
+    async def request(
+        self, limit_concurrency: bool = True, limit_rate: bool = True
+    ) -> AsyncIterator[None]:
+        probe = self.breaker.before_request()
+        try:
+            if limit_rate:
+                await self.bucket.acquire(is_low_priority.get())
+            if limit_concurrency:
+                await self.limiter.acquire()
+        except BaseException:
+            self.breaker.release_probe(probe)
+            raise
+        started_at = time.monotonic()
+        # None means cancelled, samoware has not answered then
+        is_failed: bool | None = None
+        try:
+            yield
+            is_failed = False
+        except asyncio.CancelledError:
+            raise
+        except FAILURE_EXCEPTIONS:
+            is_failed = True
+            raise
+        except BaseException:
+            # any other outcome (including UnauthorizedError) means samoware has answered
+            is_failed = False
+            raise
+        finally:
+            if is_failed is None:
+                self.breaker.release_probe(probe)
+            elif is_failed:
+                self.breaker.on_failure()
+            else:
+                self.breaker.on_success()
+            if limit_concurrency:
+                if is_failed:
+                    self.limiter.on_failure()
+                elif is_failed is not None:
+                    self.limiter.on_success(time.monotonic() - started_at)
+                await self.limiter.release()
+
+
+governor = SamowareGovernor()
+
+
+def governed(limit_concurrency: bool = True, limit_rate: bool = True):
+    def decorator(func):
+        func = instrumented(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            async with governor.request(limit_concurrency, limit_rate):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
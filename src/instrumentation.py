@@ -0,0 +1,162 @@
+import asyncio
+import functools
+import time
+from contextvars import ContextVar
+from urllib.error import HTTPError
+
+import aiohttp
+
+from accounting import (
+    BYTES_RESOURCE,
+    ERRORS_RESOURCE,
+    REQUESTS_RESOURCE,
+    accountant,
+)
+from metrics import (
+    samoware_request_duration_metric,
+    samoware_in_flight_metric,
+    samoware_connect_duration_metric,
+    samoware_ttfb_metric,
+    samoware_server_wait_metric,
+    samoware_transfer_metric,
+    samoware_response_bytes_metric,
+)
+from tracing import tracer
+
+
+class OperationStats:
+    def __init__(self, operation: str) -> None:
+        self.operation = operation
+        self.request_started_at = 0.0
+        self.connection_started_at = 0.0
+        self.headers_sent_at = 0.0
+        self.response_started_at = 0.0
+        self.last_chunk_at = 0.0
+        self.response_bytes = 0
+
+
+current_operation: ContextVar[OperationStats | None] = ContextVar(
+    "current_operation", default=None
+)
+
+
+def get_outcome(error: BaseException | None) -> str:
+    # UnauthorizedError is not imported to keep samoware_api free to import this module
+    if error is None:
+        return "ok"
+    if isinstance(error, asyncio.CancelledError):
+        return "cancelled"
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(error, aiohttp.ClientError):
+        return "network"
+    if isinstance(error, HTTPError):
+        return "http_error"
+    if type(error).__name__ == "UnauthorizedError":
+        return "unauthorized"
+    return "error"
+
+
+def instrumented(func):
+    operation = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        stats = OperationStats(operation)
+        token = current_operation.set(stats)
+        samoware_in_flight_metric.labels(operation=operation).inc()
+        started_at = time.perf_counter()
+        error = None
+        try:
+            with tracer.span(operation):
+                return await func(*args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            outcome = get_outcome(error)
+            samoware_request_duration_metric.labels(
+                operation=operation, outcome=outcome
+            ).observe(time.perf_counter() - started_at)
+            if stats.last_chunk_at > stats.response_started_at > 0:
+                samoware_transfer_metric.labels(operation=operation).observe(
+                    stats.last_chunk_at - stats.response_started_at
+                )
+            accountant.account(REQUESTS_RESOURCE)
+            accountant.account(BYTES_RESOURCE, stats.response_bytes)
+            if outcome not in ("ok", "cancelled"):
+                accountant.account(ERRORS_RESOURCE)
+            samoware_response_bytes_metric.labels(operation=operation).observe(
+                stats.response_bytes
+            )
+            samoware_in_flight_metric.labels(operation=operation).dec()
+            current_operation.reset(token)
+
+    return wrapper
+
+
+# trace callbacks run in the task making the request, so they see its operation
+async def on_request_start(session, trace_context, params) -> None:
+    stats = current_operation.get()
+    if stats is not None:
+        stats.request_started_at = time.perf_counter()
+
+
+async def on_connection_create_start(session, trace_context, params) -> None:
+    stats = current_operation.get()
+    if stats is not None:
+        stats.connection_started_at = time.perf_counter()
+
+
+async def on_connection_create_end(session, trace_context, params) -> None:
+    stats = current_operation.get()
+    if stats is not None:
+        samoware_connect_duration_metric.labels(operation=stats.operation).observe(
+            time.perf_counter() - stats.connection_started_at
+        )
+
+
+async def on_request_headers_sent(session, trace_context, params) -> None:
+    stats = current_operation.get()
+    if stats is not None:
+        stats.headers_sent_at = time.perf_counter()
+    on_sent = getattr(trace_context.trace_request_ctx, "on_sent", None)
+    if on_sent is not None:
+        on_sent()
+
+
+# aiohttp ends a request when the response headers arrive, the body is read later
+async def on_request_end(session, trace_context, params) -> None:
+    stats = current_operation.get()
+    if stats is None:
+        return
+    now = time.perf_counter()
+    stats.response_started_at = now
+    samoware_ttfb_metric.labels(operation=stats.operation).observe(
+        now - stats.request_started_at
+    )
+    # a long poll spends most of it waiting for updates on the server side
+    samoware_server_wait_metric.labels(operation=stats.operation).observe(
+        now - stats.headers_sent_at
+    )
+
+
+async def on_response_chunk_received(session, trace_context, params) -> None:
+    stats = current_operation.get()
+    if stats is not None:
+        stats.response_bytes += len(params.chunk)
+        stats.last_chunk_at = time.perf_counter()
+
+
+def make_trace_config() -> aiohttp.TraceConfig:
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_request_headers_sent.append(on_request_headers_sent)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_response_chunk_received.append(on_response_chunk_received)
+    return trace_config
+
+
+TRACE_CONFIGS = [make_trace_config()]
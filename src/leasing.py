@@ -0,0 +1,195 @@
+import asyncio
+import logging as log
+import math
+import os
+import socket
+import uuid
+from typing import AsyncIterator, Awaitable, Callable
+
+from psycopg import AsyncConnection
+
+from client_handler import UserHandler
+from context import Context
+from database import Database
+import env
+from metrics import (
+    leases_owned_metric,
+    lease_nodes_metric,
+    is_leader_metric,
+    lease_events_metric,
+)
+from startup import StartupScheduler
+
+# any constant shared by all the nodes
+LEADER_LOCK_KEY = 0x53414D4F
+LEADER_ELECTION_INTERVAL_SEC = 10
+
+
+def make_node_id() -> str:
+    node_id = env.get_node_id()
+    if node_id is not None:
+        return node_id
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+class LeaseManager:
+    def __init__(
+        self,
+        db: Database,
+        start_handler: Callable[[Context], Awaitable[UserHandler]],
+        stop_handler: Callable[[int], Awaitable[None]],
+    ) -> None:
+        self.db = db
+        self.start_handler = start_handler
+        self.stop_handler = stop_handler
+        self.node_id = make_node_id()
+        self.ttl_sec = env.get_lease_ttl_sec()
+        self.heartbeat_sec = env.get_lease_heartbeat_sec()
+        self.claim_batch = env.get_lease_claim_batch()
+        self.owned: set[int] = set()
+        self.claimed: asyncio.Queue[Context] = asyncio.Queue()
+
+    async def run(self) -> None:
+        log.info(f"leasing users as node {self.node_id}")
+        # claimed users are started in waves, a failover does not cause a login stampede
+        startup_task = asyncio.create_task(
+            StartupScheduler(self.start_handler).run(self.iterate_claimed())
+        )
+        try:
+            while True:
+                try:
+                    await self.heartbeat()
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    log.exception("exception in lease heartbeat")
+                await asyncio.sleep(self.heartbeat_sec)
+        finally:
+            startup_task.cancel()
+            log.info(f"leasing as node {self.node_id} is stopped")
+
+    async def iterate_claimed(self) -> AsyncIterator[Context]:
+        while True:
+            context = await self.claimed.get()
+            # the lease can be lost while the user waits for the start
+            if context.telegram_id in self.owned:
+                yield context
+
+    async def heartbeat(self) -> None:
+        nodes_count = await self.db.heartbeat_node(self.node_id, self.ttl_sec)
+        lease_nodes_metric.set(nodes_count)
+
+        renewed = await self.db.renew_leases(self.node_id, self.ttl_sec)
+        lost = self.owned - renewed
+        self.owned = renewed
+        for telegram_id in lost:
+            log.warning(f"lease of {telegram_id} is lost")
+            lease_events_metric.labels(event="lost").inc()
+            await self.stop_handler(telegram_id)
+
+        fair_share = math.ceil(await self.db.count_users() / max(1, nodes_count))
+        if len(self.owned) > fair_share:
+            excess = sorted(self.owned)[fair_share:]
+            log.info(f"releasing {len(excess)} leases to rebalance")
+            self.owned.difference_update(excess)
+            for telegram_id in excess:
+                await self.stop_handler(telegram_id)
+            await self.db.release_leases(self.node_id, excess)
+            lease_events_metric.labels(event="released").inc(len(excess))
+        elif len(self.owned) < fair_share:
+            contexts = await self.db.claim_leases(
+                self.node_id,
+                self.ttl_sec,
+                min(self.claim_batch, fair_share - len(self.owned)),
+            )
+            if len(contexts) > 0:
+                log.info(f"claimed {len(contexts)} leases")
+            for context in contexts:
+                self.owned.add(context.telegram_id)
+                self.claimed.put_nowait(context)
+            lease_events_metric.labels(event="claimed").inc(len(contexts))
+        leases_owned_metric.set(len(self.owned))
+
+    async def adopt(self, telegram_id: int) -> bool:
+        if not await self.db.claim_lease(telegram_id, self.node_id, self.ttl_sec):
+            log.info(f"lease of {telegram_id} is held by another node")
+            return False
+        self.owned.add(telegram_id)
+        leases_owned_metric.set(len(self.owned))
+        lease_events_metric.labels(event="claimed").inc()
+        return True
+
+    async def release(self, telegram_id: int) -> None:
+        if telegram_id not in self.owned:
+            return
+        self.owned.discard(telegram_id)
+        await self.db.release_leases(self.node_id, [telegram_id])
+        leases_owned_metric.set(len(self.owned))
+        lease_events_metric.labels(event="released").inc()
+
+    async def release_all(self) -> None:
+        if len(self.owned) > 0:
+            await self.db.release_leases(self.node_id, list(self.owned))
+            lease_events_metric.labels(event="released").inc(len(self.owned))
+        self.owned.clear()
+        leases_owned_metric.set(0)
+        await self.db.remove_node(self.node_id)
+        log.info(f"leases of node {self.node_id} are released")
+
+
+class LeaderElection:
+    def __init__(
+        self,
+        on_elected: Callable[[], Awaitable[None]],
+        on_demoted: Callable[[], Awaitable[None]],
+    ) -> None:
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.conn: AsyncConnection | None = None
+        self.is_leader = False
+
+    async def run(self) -> None:
+        try:
+            while True:
+                try:
+                    await self.check()
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    log.exception("exception in leader election")
+                    await self.demote()
+                await asyncio.sleep(LEADER_ELECTION_INTERVAL_SEC)
+        finally:
+            await self.demote()
+
+    async def check(self) -> None:
+        if self.conn is None or self.conn.closed:
+            # session advisory lock lives as long as this connection
+            self.conn = await AsyncConnection.connect(
+                env.get_postgres_connection_string(), autocommit=True
+            )
+        if self.is_leader:
+            await self.conn.execute("SELECT 1")
+            return
+        is_acquired = (
+            await (
+                await self.conn.execute(
+                    "SELECT pg_try_advisory_lock(%s)", (LEADER_LOCK_KEY,)
+                )
+            ).fetchone()
+        )[0]
+        if is_acquired:
+            log.info("node is elected as the leader")
+            self.is_leader = True
+            is_leader_metric.set(1)
+            await self.on_elected()
+
+    async def demote(self) -> None:
+        if self.is_leader:
+            log.warning("node is not the leader anymore")
+            self.is_leader = False
+            is_leader_metric.set(0)
+            await self.on_demoted()
+        if self.conn is not None and not self.conn.closed:
+            await self.conn.close()
+        self.conn = None
@@ -0,0 +1,90 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+from const import LOGGER_FORMAT
+import env
+from metrics import log_metric, log_dropped_metric
+
+
+class SizeAndTimeRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    def __init__(
+        self, filename: str, when: str, max_bytes: int, backup_count: int
+    ) -> None:
+        super().__init__(
+            filename, when=when, backupCount=backup_count, encoding="utf-8"
+        )
+        self.max_bytes = max_bytes
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if super().shouldRollover(record):
+            return True
+        if self.max_bytes <= 0:
+            return False
+        if self.stream is None:
+            self.stream = self._open()
+        return self.stream.tell() >= self.max_bytes
+
+    def rotation_filename(self, default_name: str) -> str:
+        # a size rollover can happen several times within one time interval
+        name = default_name
+        index = 1
+        while os.path.exists(name):
+            name = f"{default_name}.{index:03d}"
+            index += 1
+        return name
+
+    def getFilesToDelete(self) -> list[str]:
+        # the stock matching does not expect the .NNN index after the time suffix
+        (folder, base_name) = os.path.split(self.baseFilename)
+        prefix = base_name + "."
+        rotated = []
+        for name in os.listdir(folder):
+            if not name.startswith(prefix):
+                continue
+            (time_suffix, _, index) = name[len(prefix) :].partition(".")
+            if self.extMatch.match(time_suffix) and (index == "" or index.isdigit()):
+                rotated.append(os.path.join(folder, name))
+        if len(rotated) <= self.backupCount:
+            return []
+        # a freed name can be taken again, so the age is not told by the name
+        rotated.sort(key=lambda path: (os.path.getmtime(path), path))
+        return rotated[: len(rotated) - self.backupCount]
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the listener thread is in this process, so the message and lazy payloads
+        # are formatted there instead of on the event loop
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_dropped_metric.inc()
+
+
+class MetricsHandler(logging.Handler):
+    def emit(self, record):
+        log_metric.labels(level=record.levelname).inc()
+
+
+def start(path: str, level: int) -> logging.handlers.QueueListener:
+    file_handler = SizeAndTimeRotatingFileHandler(
+        path,
+        when=env.get_log_rotate_when(),
+        max_bytes=env.get_log_max_bytes(),
+        backup_count=env.get_log_backup_count(),
+    )
+    file_handler.setFormatter(logging.Formatter(LOGGER_FORMAT))
+    log_queue = queue.Queue(env.get_log_queue_size())
+    listener = logging.handlers.QueueListener(log_queue, file_handler, MetricsHandler())
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(DroppingQueueHandler(log_queue))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
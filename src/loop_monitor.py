@@ -0,0 +1,77 @@
+import asyncio
+import logging as log
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+import env
+from metrics import loop_lag_metric, live_tasks_metric, slow_callback_metric
+
+LAG_PROBE_INTERVAL_SEC = 0.25
+TASKS_COUNT_INTERVAL_SEC = 15
+
+
+def get_coroutine_name(task: asyncio.Task) -> str:
+    coroutine = task.get_coro()
+    return getattr(coroutine, "__qualname__", type(coroutine).__name__)
+
+
+# a watchdog thread logs the stack of the loop thread when the lag probe
+# does not wake up in time
+class LoopMonitor:
+    def __init__(self) -> None:
+        self.slow_callback_sec = env.get_loop_slow_callback_sec()
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = threading.get_ident()
+        self.is_running = False
+
+    async def run(self) -> None:
+        log.info("starting the event loop monitor...")
+        self.loop_thread_id = threading.get_ident()
+        self.is_running = True
+        watchdog = threading.Thread(
+            target=self.watch, name="loop-watchdog", daemon=True
+        )
+        watchdog.start()
+        loop = asyncio.get_running_loop()
+        next_tasks_count_at = loop.time()
+        try:
+            while True:
+                started_at = loop.time()
+                self.heartbeat = time.monotonic()
+                await asyncio.sleep(LAG_PROBE_INTERVAL_SEC)
+                now = loop.time()
+                loop_lag_metric.observe(
+                    max(0, now - started_at - LAG_PROBE_INTERVAL_SEC)
+                )
+                if now >= next_tasks_count_at:
+                    self.count_tasks()
+                    next_tasks_count_at = now + TASKS_COUNT_INTERVAL_SEC
+        finally:
+            self.is_running = False
+            log.info("event loop monitor is stopped")
+
+    def count_tasks(self) -> None:
+        counts = Counter(get_coroutine_name(task) for task in asyncio.all_tasks())
+        live_tasks_metric.clear()
+        for name, amount in counts.items():
+            live_tasks_metric.labels(coroutine=name).set(amount)
+
+    def watch(self) -> None:
+        reported_heartbeat = None
+        while self.is_running:
+            time.sleep(self.slow_callback_sec / 2)
+            heartbeat = self.heartbeat
+            stalled_for = time.monotonic() - heartbeat - LAG_PROBE_INTERVAL_SEC
+            if stalled_for < self.slow_callback_sec or heartbeat == reported_heartbeat:
+                continue
+            # one report per stall
+            reported_heartbeat = heartbeat
+            slow_callback_metric.inc()
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "unknown"
+            log.warning(
+                f"event loop is blocked for {stalled_for:.2f} seconds, loop thread stack:\n{stack}"
+            )
@@ -1,34 +1,223 @@
-from prometheus_client import Gauge, Counter
+from prometheus_client import Gauge, Counter, Histogram
 
 GATHER_METRIC_DELAY_SEC = 3 * 60  # 3 min
 
 users_amount_metric = Gauge("users_amount", "Users", labelnames=["pswd", "autoread"])
 
+# Startup
+startup_handlers_online_metric = Gauge(
+    "startup_handlers_online", "Handlers brought online by the startup scheduler"
+)
+startup_handlers_starting_metric = Gauge(
+    "startup_handlers_starting", "Handlers that are starting right now"
+)
+startup_duration_metric = Gauge(
+    "startup_duration_sec", "Time to bring all the users online after start"
+)
+
+# Leasing
+leases_owned_metric = Gauge("leases_owned", "Users leased by this node")
+lease_nodes_metric = Gauge("lease_nodes", "Alive nodes sharing the users")
+is_leader_metric = Gauge("is_leader", "Node runs the telegram updater")
+lease_events_metric = Counter(
+    "lease_events", "Lease events metric", labelnames=["event"]
+)
+
+# Database
+db_cache_metric = Counter(
+    "db_cache", "Database cache lookups metric", labelnames=["cache", "result"]
+)
+user_change_notification_metric = Counter(
+    "user_change_notification",
+    "Received user change notifications metric",
+    labelnames=["event"],
+)
+
 # Logging
 log_metric = Counter("log_info", "Logs metric", labelnames=["level"])
+log_dropped_metric = Counter("log_dropped", "Log records dropped on a full queue")
+
+# Event loop
+loop_lag_metric = Histogram(
+    "event_loop_lag_sec",
+    "Event loop lag",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+live_tasks_metric = Gauge(
+    "event_loop_live_tasks", "Live asyncio tasks", labelnames=["coroutine"]
+)
+slow_callback_metric = Counter(
+    "event_loop_slow_callback", "Event loop stalls longer than the threshold"
+)
+
+# Tracing
+exported_spans_metric = Counter(
+    "tracing_spans", "Finished tracing spans", labelnames=["result"]
+)
 
 # Telegram
 incoming_commands_metric = Counter(
     "incoming_command", "Incoming commands metric", labelnames=["command_name"]
 )
 sent_message_metric = Counter("sent_message", "Sent messages metric")
+login_jobs_metric = Gauge("login_jobs", "Running and waiting login jobs")
+update_delay_metric = Histogram(
+    "telegram_update_delay_sec",
+    "Time from sending a message to the start of its processing",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+update_processing_duration_metric = Histogram(
+    "telegram_update_processing_duration_sec", "Telegram update processing duration"
+)
+webhook_request_metric = Counter(
+    "telegram_webhook_request", "Telegram webhook requests", labelnames=["result"]
+)
 
 # Samoware
 samoware_response_status_code_metric = Counter(
     "samoware_response_sc", "Samoware reponses status code metric", labelnames=["sc"]
 )
+samoware_request_duration_metric = Histogram(
+    "samoware_request_duration_sec",
+    "Samoware operation duration",
+    labelnames=["operation", "outcome"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120),
+)
+samoware_in_flight_metric = Gauge(
+    "samoware_in_flight", "Samoware operations in flight", labelnames=["operation"]
+)
+samoware_connect_duration_metric = Histogram(
+    "samoware_connect_duration_sec",
+    "Samoware connection establishment duration",
+    labelnames=["operation"],
+)
+samoware_ttfb_metric = Histogram(
+    "samoware_ttfb_sec",
+    "Time from the start of a samoware request to the response headers",
+    labelnames=["operation"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120),
+)
+samoware_server_wait_metric = Histogram(
+    "samoware_server_wait_sec",
+    "Time from sending a samoware request to the response headers",
+    labelnames=["operation"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120),
+)
+samoware_transfer_metric = Histogram(
+    "samoware_transfer_sec",
+    "Time from the samoware response headers to the last body chunk",
+    labelnames=["operation"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+samoware_response_bytes_metric = Histogram(
+    "samoware_response_bytes",
+    "Samoware response body size per operation",
+    labelnames=["operation"],
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216),
+)
+governor_tokens_metric = Gauge(
+    "samoware_governor_tokens", "Tokens left in the samoware rate limiter bucket"
+)
+governor_concurrency_limit_metric = Gauge(
+    "samoware_governor_concurrency_limit", "Current samoware concurrency limit"
+)
+governor_in_flight_metric = Gauge(
+    "samoware_governor_in_flight", "Samoware requests under the concurrency limit"
+)
+governor_circuit_state_metric = Gauge(
+    "samoware_governor_circuit_state",
+    "Samoware circuit breaker state (0 - closed, 1 - half open, 2 - open)",
+)
+governor_rejected_metric = Counter(
+    "samoware_governor_rejected",
+    "Samoware requests rejected by the governor",
+    labelnames=["reason"],
+)
+attachment_skipped_metric = Counter(
+    "samoware_attachment_skipped", "Attachments skipped for being too large"
+)
+attachment_avoided_bytes_metric = Counter(
+    "samoware_attachment_avoided_bytes", "Bytes of skipped attachments not downloaded"
+)
+mail_body_bytes_metric = Histogram(
+    "samoware_mail_body_bytes",
+    "Size of the mail body responses",
+    labelnames=["mode"],
+    buckets=(1024, 4096, 16384, 65536, 262144, 1048576, 4194304),
+)
+mail_body_duration_metric = Histogram(
+    "samoware_mail_body_duration_sec",
+    "Mail body fetch duration without attachments",
+    labelnames=["mode"],
+)
+mail_body_fallback_metric = Counter(
+    "samoware_mail_body_fallback",
+    "Text only mail body reads falling back to the full body",
+    labelnames=["reason"],
+)
 
 # Domain
+user_usage_top_metric = Gauge(
+    "user_usage_top",
+    "Decayed usage of the heaviest users by rank, the users are listed by the admin server",
+    labelnames=["resource", "rank"],
+)
+mail_delivery_stage_metric = Histogram(
+    "mail_delivery_stage_sec",
+    "Time a letter spends in a delivery stage",
+    labelnames=["stage"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+mail_delivery_latency_metric = Histogram(
+    "mail_delivery_latency_sec",
+    "Time from the letter arrival to the end of a delivery stage",
+    labelnames=["stage"],
+    buckets=(1, 5, 10, 30, 60, 120, 300, 900, 3600),
+)
+mail_delivery_slo_metric = Counter(
+    "mail_delivery_slo",
+    "Delivered letters by whether they are delivered within the slo",
+    labelnames=["slo", "is_met"],
+)
 login_metric = Counter("login", "Login events metric", labelnames=["is_successful"])
 relogin_metric = Counter(
     "relogin", "Relogin events metric", labelnames=["is_successful"]
 )
+login_duration_metric = Histogram(
+    "login_duration_sec", "Login duration", labelnames=["path"]
+)
+login_step_duration_metric = Histogram(
+    "login_step_duration_sec", "Login step duration", labelnames=["step"]
+)
 revalidation_metric = Counter(
     "revalidation", "Revalidation events metric", labelnames=["is_successful"]
 )
+revalidation_queue_depth_metric = Gauge(
+    "revalidation_queue_depth", "Revalidations queue depth", labelnames=["state"]
+)
+revalidation_in_progress_metric = Gauge(
+    "revalidation_in_progress", "Revalidations running right now"
+)
+revalidation_lag_metric = Histogram(
+    "revalidation_lag_sec",
+    "Delay between a revalidation deadline and the start of the revalidation",
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600),
+)
 logout_metric = Counter("logout", "Logout events metric")
 forced_logout_metric = Counter("forced_logout", "Forced logout events metric")
 user_handler_error_metric = Counter(
     "user_handler_error", "Client handler error events metric", labelnames=["type"]
 )
 incoming_letter_metric = Counter("incoming_letter", "Incoming letter events metric")
+longpoll_metric = Counter("longpoll", "Long-poll requests metric", labelnames=["tier"])
+longpoll_saved_metric = Counter(
+    "longpoll_saved", "Long-poll requests saved by longer waits of cold users"
+)
+folder_sync_page_metric = Counter("folder_sync_page", "Fetched folderSync pages metric")
+catch_up_skipped_letter_metric = Counter(
+    "catch_up_skipped_letter", "Letters summarised instead of being forwarded"
+)
+duplicate_letter_metric = Counter(
+    "duplicate_letter", "Already forwarded letters skipped metric"
+)
+parked_metric = Counter("parked", "Parked users metric", labelnames=["reason"])
@@ -1,8 +1,59 @@
+import asyncio
+import logging as log
+import os
+import sys
+
+from psycopg import AsyncConnection
 from yoyo import read_migrations, get_backend
 import env
 
+MIGRATIONS_PATH = "./migrations"
+
 
 def apply():
     backend = get_backend(env.get_postgres_connection_string())
-    migrations = read_migrations("./migrations")
+    migrations = read_migrations(MIGRATIONS_PATH)
     backend.apply_migrations(backend.to_apply(migrations))
+
+
+def get_migration_ids() -> set[str]:
+    # only file names are needed, so the migrations are not parsed
+    return set(
+        os.path.splitext(name)[0]
+        for name in os.listdir(MIGRATIONS_PATH)
+        if name.endswith(".sql")
+    )
+
+
+async def is_schema_current() -> bool:
+    async with await AsyncConnection.connect(
+        env.get_postgres_connection_string()
+    ) as conn:
+        table = (
+            await (
+                await conn.execute("SELECT to_regclass('_yoyo_migration')")
+            ).fetchone()
+        )[0]
+        if table is None:
+            return False
+        applied = set(
+            row[0]
+            for row in await (
+                await conn.execute("SELECT migration_id FROM _yoyo_migration")
+            ).fetchall()
+        )
+        return get_migration_ids().issubset(applied)
+
+
+async def apply_if_needed():
+    if await is_schema_current():
+        log.info("db schema is up to date, skipping migrations")
+        return
+    log.info("applying migrations...")
+    await asyncio.to_thread(apply)
+    log.info("migrations have applied")
+
+
+if __name__ == "__main__":
+    log.basicConfig(level=log.INFO, stream=sys.stdout)
+    asyncio.run(apply_if_needed())
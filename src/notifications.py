@@ -0,0 +1,59 @@
+import asyncio
+import json
+import logging as log
+from typing import Awaitable, Callable
+
+from psycopg import AsyncConnection
+
+from database import USER_CHANGES_CHANNEL, Database
+import env
+from metrics import user_change_notification_metric
+
+LISTENER_RECONNECT_DELAY_SEC = 5
+
+UserChangeSubscriber = Callable[[int, str], Awaitable[None]]
+
+
+class UserChangesListener:
+    def __init__(self, db: Database) -> None:
+        self.db = db
+        self.subscribers: list[UserChangeSubscriber] = []
+
+    def subscribe(self, subscriber: UserChangeSubscriber) -> None:
+        self.subscribers.append(subscriber)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception(
+                    f"user changes listener has failed, reconnecting in {LISTENER_RECONNECT_DELAY_SEC} seconds..."
+                )
+            finally:
+                self.db.disable_cache()
+            await asyncio.sleep(LISTENER_RECONNECT_DELAY_SEC)
+
+    async def listen(self) -> None:
+        async with await AsyncConnection.connect(
+            env.get_postgres_connection_string(), autocommit=True
+        ) as conn:
+            await conn.execute(f"LISTEN {USER_CHANGES_CHANNEL}")
+            log.info(f"listening to {USER_CHANGES_CHANNEL} notifications")
+            self.db.enable_cache()
+            async for notify in conn.notifies():
+                change = json.loads(notify.payload)
+                telegram_id = int(change["telegram_id"])
+                event = change["event"]
+                log.debug(f"received {event} notification for {telegram_id}")
+                user_change_notification_metric.labels(event=event).inc()
+                self.db.invalidate_user(telegram_id)
+                for subscriber in self.subscribers:
+                    try:
+                        await subscriber(telegram_id, event)
+                    except Exception:
+                        log.exception(
+                            f"can not handle {event} notification for {telegram_id}"
+                        )
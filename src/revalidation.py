@@ -0,0 +1,110 @@
+import asyncio
+import heapq
+import logging as log
+import random
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import AsyncIterator
+
+import env
+from metrics import (
+    revalidation_queue_depth_metric,
+    revalidation_in_progress_metric,
+    revalidation_lag_metric,
+)
+
+REVALIDATE_INTERVAL = timedelta(hours=5)
+MAX_SCHEDULER_SLEEP_SEC = 60
+
+
+# owns revalidation deadlines of all the handlers, expired deadlines are moved
+# to the due set and handlers revalidate after taking one of the limited slots
+class RevalidationScheduler:
+    def __init__(
+        self,
+        concurrency: int | None = None,
+        jitter_sec: float | None = None,
+        overdue_spread_sec: float | None = None,
+    ) -> None:
+        self.semaphore = asyncio.Semaphore(
+            env.get_revalidation_concurrency() if concurrency is None else concurrency
+        )
+        self.jitter_sec = (
+            env.get_revalidation_jitter_sec() if jitter_sec is None else jitter_sec
+        )
+        self.overdue_spread_sec = (
+            env.get_revalidation_overdue_spread_sec()
+            if overdue_spread_sec is None
+            else overdue_spread_sec
+        )
+        self.heap: list[tuple[float, int]] = []
+        self.deadlines: dict[int, float] = {}
+        self.due: dict[int, float] = {}
+        self.wakeup = asyncio.Event()
+
+    def schedule(self, telegram_id: int, last_revalidation: datetime) -> None:
+        now = time.time()
+        deadline = (last_revalidation + REVALIDATE_INTERVAL).timestamp()
+        deadline -= random.uniform(0, self.jitter_sec)
+        if deadline < now:
+            deadline = now + random.uniform(0, self.overdue_spread_sec)
+        self.due.pop(telegram_id, None)
+        self.deadlines[telegram_id] = deadline
+        heapq.heappush(self.heap, (deadline, telegram_id))
+        log.debug(
+            f"revalidation for {telegram_id} is scheduled in {deadline - now:.0f} seconds"
+        )
+        self.update_metrics()
+        self.wakeup.set()
+
+    def unschedule(self, telegram_id: int) -> None:
+        # heap entries are removed lazily when popped
+        self.deadlines.pop(telegram_id, None)
+        self.due.pop(telegram_id, None)
+        self.update_metrics()
+
+    def is_due(self, telegram_id: int) -> bool:
+        return telegram_id in self.due
+
+    @asynccontextmanager
+    async def slot(self, telegram_id: int) -> AsyncIterator[None]:
+        async with self.semaphore:
+            deadline = self.due.get(telegram_id)
+            if deadline is not None:
+                revalidation_lag_metric.observe(max(0, time.time() - deadline))
+            revalidation_in_progress_metric.inc()
+            try:
+                yield
+            finally:
+                revalidation_in_progress_metric.dec()
+
+    async def run(self) -> None:
+        log.info("revalidation scheduler is started")
+        try:
+            while True:
+                self.wakeup.clear()
+                now = time.time()
+                while len(self.heap) > 0 and self.heap[0][0] <= now:
+                    (deadline, telegram_id) = heapq.heappop(self.heap)
+                    if self.deadlines.get(telegram_id) != deadline:
+                        continue
+                    del self.deadlines[telegram_id]
+                    self.due[telegram_id] = deadline
+                    log.debug(f"revalidation for {telegram_id} is due")
+                self.update_metrics()
+                timeout = MAX_SCHEDULER_SLEEP_SEC
+                if len(self.heap) > 0:
+                    timeout = min(timeout, self.heap[0][0] - now)
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            log.info("revalidation scheduler is stopped")
+
+    def update_metrics(self) -> None:
+        revalidation_queue_depth_metric.labels(state="scheduled").set(
+            len(self.deadlines)
+        )
+        revalidation_queue_depth_metric.labels(state="due").set(len(self.due))
@@ -3,9 +3,11 @@ import html
 from datetime import datetime
 from http.client import HTTPResponse
 from http.cookies import SimpleCookie
-from typing import Self
+from types import SimpleNamespace
+from typing import Callable, Self
 
 import re
+import time
 import logging as log
 import bs4 as bs
 import xml.etree.ElementTree as ET
@@ -13,18 +15,29 @@ from aiohttp import ClientSession, ClientTimeout
 from urllib.error import HTTPError
 
 import env
+from governor import governed
+from instrumentation import TRACE_CONFIGS, instrumented
 from const import (
     HTTP_COMMON_TIMEOUT_SEC,
     HTTP_CONNECT_LONGPOLL_TIMEOUT_SEC,
     HTTP_FILE_LOAD_TIMEOUT_SEC,
-    HTTP_TOTAL_LONGPOLL_TIMEOUT_SEC,
+    HTTP_LONGPOLL_TIMEOUT_MARGIN_SEC,
 )
 import metrics
+from util import LazyPayload
 
 SESSION_TOKEN_PATTERN = re.compile("^[0-9]{6}-[a-zA-Z0-9]{20}$")
 
 AGGRESSIVE_FORMAT_LETTER = True
 
+LOGIN_BASE_URL = env.get_samoware_login_url()
+BASE_URL = env.get_samoware_url()
+
+FULL_BODY_MODE = "full"
+TEXT_BODY_MODE = "text"
+TEXT_BODY_SIZE_LIMIT = 1024 * 1024
+ATTACHMENT_READ_CHUNK_BYTES = 64 * 1024
+
 
 class UnauthorizedError(Exception):
     pass
@@ -66,6 +79,12 @@ class SamowarePollingContext:
         )
 
 
+class AttachmentInfo:
+    def __init__(self, name: str, size: int | None) -> None:
+        self.name = name
+        self.size = size
+
+
 class MailHeader:
     def __init__(
         self,
@@ -77,6 +96,7 @@ class MailHeader:
         from_mail: str,
         from_name: str,
         subject: str,
+        size: int | None,
     ) -> None:
         self.uid = uid
         self.flags = flags
@@ -86,6 +106,10 @@ class MailHeader:
         self.from_mail = from_mail
         self.from_name = from_name
         self.subject = subject
+        # the size of the whole letter, no attachment of it is larger
+        self.size = size
+        # read from the message structure when the letter can have a too large attachment
+        self.attachments: list[AttachmentInfo] | None = None
 
 
 class MailBody:
@@ -100,10 +124,11 @@ class Mail:
         self.body = body
 
 
+@governed()
 async def login(login: str, password: str) -> SamowarePollingContext | None:
     log.debug(f"logging in for {login}")
 
-    url = "https://mailstudent.bmstu.ru/XIMSSLogin/"
+    url = f"{LOGIN_BASE_URL}/XIMSSLogin/"
     params = {
         "errorAsXML": "1",
         "EnableUseCookie": "1",
@@ -121,6 +146,7 @@ async def login(login: str, password: str) -> SamowarePollingContext | None:
 
     async with ClientSession(
         timeout=ClientTimeout(sock_read=HTTP_COMMON_TIMEOUT_SEC),
+        trace_configs=TRACE_CONFIGS,
     ) as http_session:
         response = await http_session.get(url, params=params)
         metrics.samoware_response_status_code_metric.labels(sc=response.status).inc()
@@ -148,10 +174,11 @@ async def login(login: str, password: str) -> SamowarePollingContext | None:
         return SamowarePollingContext(session=session)
 
 
+@governed()
 async def revalidate(login: str, session: str) -> SamowarePollingContext | None:
     log.debug(f"revalidating session for {login}")
 
-    url = "https://mailstudent.bmstu.ru/XIMSSLogin/"
+    url = f"{LOGIN_BASE_URL}/XIMSSLogin/"
     params = {
         "errorAsXML": "1",
         "EnableUseCookie": "1",
@@ -166,6 +193,7 @@ async def revalidate(login: str, session: str) -> SamowarePollingContext | None:
 
     async with ClientSession(
         timeout=ClientTimeout(sock_read=HTTP_COMMON_TIMEOUT_SEC),
+        trace_configs=TRACE_CONFIGS,
     ) as http_session:
         response = await http_session.get(url, params=params)
         metrics.samoware_response_status_code_metric.labels(sc=response.status).inc()
@@ -189,25 +217,33 @@ async def revalidate(login: str, session: str) -> SamowarePollingContext | None:
         return SamowarePollingContext(session=new_session)
 
 
+# a long poll mostly waits on the server, its rate is bounded by the number of users
+@governed(limit_concurrency=False, limit_rate=False)
 async def longpoll_updates(
     context: SamowarePollingContext,
+    max_wait: int = 20,
+    on_sent: Callable[[], None] | None = None,
 ) -> tuple[str, SamowarePollingContext]:
     async with ClientSession(
         timeout=ClientTimeout(
             connect=HTTP_CONNECT_LONGPOLL_TIMEOUT_SEC,
-            total=HTTP_TOTAL_LONGPOLL_TIMEOUT_SEC,
-        )
+            total=max_wait + HTTP_LONGPOLL_TIMEOUT_MARGIN_SEC,
+        ),
+        trace_configs=TRACE_CONFIGS,
     ) as http_session:
-        url = f"https://student.bmstu.ru/Session/{context.session}/?ackSeq={context.ack_seq}&maxWait=20&random={context.rand}"
+        url = f"{BASE_URL}/Session/{context.session}/?ackSeq={context.ack_seq}&maxWait={max_wait}&random={context.rand}"
         response = await http_session.get(
             url=url,
             cookies=context.cookies,
+            trace_request_ctx=SimpleNamespace(on_sent=on_sent),
         )
 
         metrics.samoware_response_status_code_metric.labels(sc=response.status).inc()
         response_text = await response.text()
         log.debug(
-            f"samoware longpoll response code: {response.status}, text: {response_text}"
+            "samoware longpoll response code: %s, text: %s",
+            response.status,
+            LazyPayload(response_text),
         )
         if response.status == 550:
             log.warning(
@@ -229,17 +265,81 @@ async def longpoll_updates(
         )
 
 
+def parse_mail_header(element: ET.Element) -> MailHeader:
+    uid = element.attrib["UID"]
+    local_time = datetime.strptime(
+        element.find("INTERNALDATE").attrib["localTime"], "%Y%m%dT%H%M%S"
+    )
+    utc_time = datetime.strptime(element.find("INTERNALDATE").text, "%Y%m%dT%H%M%SZ")
+    flags = element.find("FLAGS").text
+    from_mail = element.find("E-From").text
+    if "realName" in element.find("E-From").attrib:
+        from_name = element.find("E-From").attrib["realName"]
+    else:
+        from_name = element.find("E-From").text
+    if element.find("Subject") is not None and element.find("Subject").text is not None:
+        subject = html.escape(element.find("Subject").text)
+    else:
+        subject = "Письмо без темы"
+    to = []
+    for el in element.findall("E-To"):
+        to_mail = el.text
+        if "realName" in el.attrib:
+            to_name = el.attrib["realName"]
+        else:
+            to_name = el.text
+        to.append((to_mail, to_name))
+    size = None
+    if element.find("SIZE") is not None and element.find("SIZE").text is not None:
+        size = int(element.find("SIZE").text)
+
+    return MailHeader(
+        flags=flags,
+        from_mail=from_mail,
+        from_name=from_name,
+        local_time=local_time,
+        subject=subject,
+        recipients=to,
+        uid=uid,
+        utc_time=utc_time,
+        size=size,
+    )
+
+
+def parse_attachments(message: ET.Element) -> list[AttachmentInfo]:
+    attachments = []
+    for part in message.iter("MIME"):
+        if part.attrib.get("disposition") == "attachment" or "fileName" in part.attrib:
+            size = part.attrib.get("estimatedSize")
+            attachments.append(
+                AttachmentInfo(
+                    part.attrib.get("fileName", ""),
+                    int(size) if size is not None else None,
+                )
+            )
+    return attachments
+
+
+def may_have_large_attachments(mail_header: MailHeader) -> bool:
+    return (
+        mail_header.size is not None
+        and mail_header.size > env.get_attachment_max_size_bytes()
+    )
+
+
+@governed()
 async def get_new_mails(
-    context: SamowarePollingContext,
-) -> tuple[list[MailHeader], SamowarePollingContext]:
+    context: SamowarePollingContext, limit: int = 300
+) -> tuple[list[MailHeader], SamowarePollingContext, bool]:
     async with ClientSession(
         timeout=ClientTimeout(sock_read=HTTP_COMMON_TIMEOUT_SEC),
         cookies=context.cookies,
+        trace_configs=TRACE_CONFIGS,
     ) as http_session:
-        url = f"https://student.bmstu.ru/Session/{context.session}/sync?reqSeq={context.request_id}&random={context.rand}"
+        url = f"{BASE_URL}/Session/{context.session}/sync?reqSeq={context.request_id}&random={context.rand}"
         response = await http_session.get(
             url=url,
-            data=f'<XIMSS><folderSync folder="INBOX-MM-1" limit="300" id="{context.command_id}"/></XIMSS>',
+            data=f'<XIMSS><folderSync folder="INBOX-MM-1" limit="{limit}" id="{context.command_id}"/></XIMSS>',
             cookies=context.cookies,
             timeout=HTTP_COMMON_TIMEOUT_SEC,
         )
@@ -259,50 +359,16 @@ async def get_new_mails(
             )
         tree = ET.fromstring(await response.text())
         mail_headers = []
-        for element in tree.findall("folderReport"):
-            log.debug("folderReport: " + str(ET.tostring(element, encoding="utf8")))
+        reports = tree.findall("folderReport")
+        for element in reports:
+            log.debug(
+                "folderReport: %s",
+                LazyPayload(element, lambda e: ET.tostring(e, encoding="unicode")),
+            )
             if element.attrib["mode"] == "added":
-                uid = element.attrib["UID"]
-                local_time = datetime.strptime(
-                    element.find("INTERNALDATE").attrib["localTime"], "%Y%m%dT%H%M%S"
-                )
-                utc_time = datetime.strptime(
-                    element.find("INTERNALDATE").text, "%Y%m%dT%H%M%SZ"
-                )
-                flags = element.find("FLAGS").text
-                from_mail = element.find("E-From").text
-                if "realName" in element.find("E-From").attrib:
-                    from_name = element.find("E-From").attrib["realName"]
-                else:
-                    from_name = element.find("E-From").text
-                if (
-                    element.find("Subject") is not None
-                    and element.find("Subject").text is not None
-                ):
-                    subject = html.escape(element.find("Subject").text)
-                else:
-                    subject = "Письмо без темы"
-                to = []
-                for el in element.findall("E-To"):
-                    to_mail = el.text
-                    if "realName" in el.attrib:
-                        to_name = el.attrib["realName"]
-                    else:
-                        to_name = el.text
-                    to.append((to_mail, to_name))
-
-                mail_headers.append(
-                    MailHeader(
-                        flags=flags,
-                        from_mail=from_mail,
-                        from_name=from_name,
-                        local_time=local_time,
-                        subject=subject,
-                        recipients=to,
-                        uid=uid,
-                        utc_time=utc_time,
-                    )
-                )
+                mail_headers.append(parse_mail_header(element))
+        # the server returns at most limit reports, the rest is left for the next sync
+        has_more = len(reports) >= limit
         return (
             mail_headers,
             context.make_next(
@@ -310,22 +376,40 @@ async def get_new_mails(
                 rand=context.rand + 1,
                 command_id=context.command_id + 1,
             ),
+            has_more,
         )
 
 
-async def set_session_info(context: SamowarePollingContext) -> SamowarePollingContext:
+@governed()
+async def read_prefs(context: SamowarePollingContext) -> SamowarePollingContext:
     async with ClientSession(
         timeout=ClientTimeout(sock_read=HTTP_COMMON_TIMEOUT_SEC),
         cookies=context.cookies,
+        trace_configs=TRACE_CONFIGS,
     ) as http_session:
         response = await http_session.post(
-            url=f"https://student.bmstu.ru/Session/{context.session}/sync?reqSeq={context.request_id}&random={context.rand}",
+            url=f"{BASE_URL}/Session/{context.session}/sync?reqSeq={context.request_id}&random={context.rand}",
             data='<XIMSS><prefsRead id="1"><name>Language</name></prefsRead></XIMSS>',
         )
         metrics.samoware_response_status_code_metric.labels(sc=response.status).inc()
 
-        await http_session.post(
-            f"https://student.bmstu.ru/Session/{context.session}/sessionadmin.wcgp",
+        return context.make_next(
+            cookies=response.cookies,
+            request_id=context.request_id + 1,
+            rand=context.rand + 1,
+        )
+
+
+@governed()
+async def set_session_info(context: SamowarePollingContext) -> None:
+    # does not take part in the request sequence, so can be sent concurrently
+    async with ClientSession(
+        timeout=ClientTimeout(sock_read=HTTP_COMMON_TIMEOUT_SEC),
+        cookies=context.cookies,
+        trace_configs=TRACE_CONFIGS,
+    ) as http_session:
+        response = await http_session.post(
+            f"{BASE_URL}/Session/{context.session}/sessionadmin.wcgp",
             data={
                 "op": "setSessionInfo",
                 "paramType": "json",
@@ -333,15 +417,12 @@ async def set_session_info(context: SamowarePollingContext) -> SamowarePollingCo
                 "session": context.session,
             },
         )
-        return context.make_next(
-            cookies=response.cookies,
-            request_id=context.request_id + 1,
-            rand=context.rand + 1,
-        )
+        metrics.samoware_response_status_code_metric.labels(sc=response.status).inc()
 
 
+@governed()
 async def open_inbox(context: SamowarePollingContext) -> SamowarePollingContext:
-    url = f"https://student.bmstu.ru/Session/{context.session}/sync?reqSeq={context.request_id}&random={context.rand}"
+    url = f"{BASE_URL}/Session/{context.session}/sync?reqSeq={context.request_id}&random={context.rand}"
     data = f"""<XIMSS>
             <listKnownValues id="{context.command_id}"/>
             <mailboxList filter="%" pureFolder="yes" id="{context.command_id + 1}"/>
@@ -368,6 +449,7 @@ async def open_inbox(context: SamowarePollingContext) -> SamowarePollingContext:
     async with ClientSession(
         timeout=ClientTimeout(sock_read=HTTP_COMMON_TIMEOUT_SEC),
         cookies=context.cookies,
+        trace_configs=TRACE_CONFIGS,
     ) as http_session:
         response = await http_session.get(url, data=data)
         metrics.samoware_response_status_code_metric.labels(sc=response.status).inc()
@@ -392,11 +474,168 @@ async def open_inbox(context: SamowarePollingContext) -> SamowarePollingContext:
         )
 
 
-async def get_mail_body_by_id(context: SamowarePollingContext, uid: str) -> MailBody:
-    url = f"https://student.bmstu.ru/Session/{context.session}/FORMAT/Samoware/INBOX-MM-1/{uid}"
+async def fetch_mail_body(
+    context: SamowarePollingContext, mail_header: MailHeader
+) -> tuple[MailBody, SamowarePollingContext]:
+    if env.get_mail_body_mode() == TEXT_BODY_MODE:
+        (mail_body, context) = await read_mail_text(context, mail_header)
+        if mail_body is not None:
+            return (mail_body, context)
+    if mail_header.attachments is None and may_have_large_attachments(mail_header):
+        context = await read_attachments(context, mail_header)
+    mail_body = await get_mail_body_by_id(
+        context, mail_header.uid, mail_header.attachments
+    )
+    return (mail_body, context)
+
+
+# no body is returned when the letter has attachments or no text part,
+# they are taken from the Samoware page then
+@governed()
+async def read_mail_text(
+    context: SamowarePollingContext, mail_header: MailHeader
+) -> tuple[MailBody | None, SamowarePollingContext]:
+    url = f"{BASE_URL}/Session/{context.session}/sync?reqSeq={context.request_id}&random={context.rand}"
+    data = f'<XIMSS><folderRead folder="INBOX-MM-1" id="{context.command_id}" UID="{mail_header.uid}" totalSizeLimit="{TEXT_BODY_SIZE_LIMIT}"/></XIMSS>'
+    started_at = time.perf_counter()
+    async with ClientSession(
+        timeout=ClientTimeout(sock_read=HTTP_COMMON_TIMEOUT_SEC),
+        cookies=context.cookies,
+        trace_configs=TRACE_CONFIGS,
+    ) as http_session:
+        response = await http_session.post(url=url, data=data)
+        metrics.samoware_response_status_code_metric.labels(sc=response.status).inc()
+
+        if response.status == 550:
+            log.error(
+                f"received 550 code in read_mail_text - Samoware Unauthorized\nresponse: {await response.text()}"
+            )
+            raise UnauthorizedError
+        next_context = context.make_next(
+            request_id=context.request_id + 1,
+            rand=context.rand + 1,
+            command_id=context.command_id + 1,
+        )
+        if response.status != 200:
+            log.warning(
+                f"received non 200 code in read_mail_text: {response.status}, falling back to the full body"
+            )
+            metrics.mail_body_fallback_metric.labels(reason="status").inc()
+            return (None, next_context)
+        body = await response.read()
+        metrics.mail_body_bytes_metric.labels(mode=TEXT_BODY_MODE).observe(len(body))
+
+    try:
+        message = ET.fromstring(body).find("folderMessage/EMail")
+    except ET.ParseError:
+        log.warning(
+            "can not parse the folderRead response, falling back to the full body"
+        )
+        metrics.mail_body_fallback_metric.labels(reason="parse_error").inc()
+        return (None, next_context)
+    if message is None:
+        metrics.mail_body_fallback_metric.labels(reason="no_message").inc()
+        return (None, next_context)
+    # the full body path uses the sizes to skip large attachments without requesting them
+    mail_header.attachments = parse_attachments(message)
+    if len(mail_header.attachments) > 0:
+        metrics.mail_body_fallback_metric.labels(reason="attachments").inc()
+        return (None, next_context)
+    plain_text = None
+    html_text = None
+    for part in message.iter("MIME"):
+        if part.attrib.get("type") != "text" or part.text is None:
+            continue
+        if part.attrib.get("subtype") == "plain" and plain_text is None:
+            plain_text = normalize_plain_text(html.escape(part.text))
+        elif part.attrib.get("subtype") == "html" and html_text is None:
+            html_text = "".join(
+                html_element_to_text(element)
+                for element in bs.BeautifulSoup(part.text, "html.parser").children
+            )
+    if plain_text is not None:
+        text = plain_text
+    elif html_text is not None:
+        text = normalize_text(html_text)
+    else:
+        metrics.mail_body_fallback_metric.labels(reason="no_text").inc()
+        return (None, next_context)
+    metrics.mail_body_duration_metric.labels(mode=TEXT_BODY_MODE).observe(
+        time.perf_counter() - started_at
+    )
+    return (MailBody(text, []), next_context)
+
+
+@governed()
+async def read_attachments(
+    context: SamowarePollingContext, mail_header: MailHeader
+) -> SamowarePollingContext:
+    url = f"{BASE_URL}/Session/{context.session}/sync?reqSeq={context.request_id}&random={context.rand}"
+    # the part bodies are not needed, only their descriptors
+    data = f'<XIMSS><folderRead folder="INBOX-MM-1" id="{context.command_id}" UID="{mail_header.uid}" totalSizeLimit="1"/></XIMSS>'
+    async with ClientSession(
+        timeout=ClientTimeout(sock_read=HTTP_COMMON_TIMEOUT_SEC),
+        cookies=context.cookies,
+        trace_configs=TRACE_CONFIGS,
+    ) as http_session:
+        response = await http_session.post(url=url, data=data)
+        metrics.samoware_response_status_code_metric.labels(sc=response.status).inc()
+
+        if response.status == 550:
+            log.error(
+                f"received 550 code in read_attachments - Samoware Unauthorized\nresponse: {await response.text()}"
+            )
+            raise UnauthorizedError
+        next_context = context.make_next(
+            request_id=context.request_id + 1,
+            rand=context.rand + 1,
+            command_id=context.command_id + 1,
+        )
+        if response.status != 200:
+            log.warning(
+                f"received non 200 code in read_attachments: {response.status}, attachment sizes are unknown"
+            )
+            return next_context
+        body = await response.read()
+
+    try:
+        message = ET.fromstring(body).find("folderMessage/EMail")
+    except ET.ParseError:
+        log.warning(
+            "can not parse the folderRead response, attachment sizes are unknown"
+        )
+        return next_context
+    if message is not None:
+        mail_header.attachments = parse_attachments(message)
+    return next_context
+
+
+def make_skipped_attachment_notice(name: str, size: int | None) -> str:
+    if size is None:
+        size_text = f"более {env.get_attachment_max_size_bytes() / 1024 / 1024:.1f} МБ"
+    else:
+        size_text = f"{size / 1024 / 1024:.1f} МБ"
+    return f"Вложение «{html.escape(name)}» ({size_text}) слишком большое для пересылки, его можно скачать в Samoware."
+
+
+def skip_attachment(size: int | None) -> None:
+    metrics.attachment_skipped_metric.inc()
+    if size is not None:
+        metrics.attachment_avoided_bytes_metric.inc(size)
+
+
+@governed()
+async def get_mail_body_by_id(
+    context: SamowarePollingContext,
+    uid: str,
+    attachments_info: list[AttachmentInfo] | None = None,
+) -> MailBody:
+    url = f"{BASE_URL}/Session/{context.session}/FORMAT/Samoware/INBOX-MM-1/{uid}"
+    started_at = time.perf_counter()
     async with ClientSession(
         timeout=ClientTimeout(sock_read=HTTP_COMMON_TIMEOUT_SEC),
         cookies=context.cookies,
+        trace_configs=TRACE_CONFIGS,
     ) as http_session:
         response = await http_session.get(url)
         metrics.samoware_response_status_code_metric.labels(sc=response.status).inc()
@@ -413,12 +652,15 @@ async def get_mail_body_by_id(context: SamowarePollingContext, uid: str) -> Mail
             raise HTTPError(
                 url=url, code=response.status, msg=(await response.text()), hdrs=None
             )
+        metrics.mail_body_bytes_metric.labels(mode=FULL_BODY_MODE).observe(
+            len(await response.read())
+        )
         tree = bs.BeautifulSoup((await response.text()), "html.parser")
         mailBodiesHtml = tree.findAll("div", {"class": "samoware-RFC822-body"})
 
         text = ""
         for mailBodyHtml in mailBodiesHtml:
-            log.debug("mail body: " + str(mailBodyHtml.encode()))
+            log.debug("mail body: %s", LazyPayload(mailBodyHtml))
             foundTextBeg = False
             for element in mailBodyHtml.children:
                 if (
@@ -438,37 +680,76 @@ async def get_mail_body_by_id(context: SamowarePollingContext, uid: str) -> Mail
                 if foundTextBeg:
                     text += html_element_to_text(element)
 
-        text = re.sub(r"(\r)+", "\r", text).strip()
-        text = re.sub(r"(\n)+", "\n", text).strip()
-        text = text.replace("\r", "\n\n")
-        if AGGRESSIVE_FORMAT_LETTER:
-            text = text.replace("\n\xa0\n", "\n\n")
-        text = re.sub(r"(\n){2,}", "\n\n", text).strip()
+        text = normalize_text(text)
+        # the attachments are not a part of the body, the modes are compared without them
+        metrics.mail_body_duration_metric.labels(mode=FULL_BODY_MODE).observe(
+            time.perf_counter() - started_at
+        )
 
+        known_sizes = {
+            info.name: info.size
+            for info in attachments_info or []
+            if info.size is not None
+        }
+        max_size = env.get_attachment_max_size_bytes()
         attachments = []
+        skipped_attachments = []
         for attachment_html in tree.find_all("cg-message-attachment"):
-            attachment_url = (
-                "https://student.bmstu.ru" + attachment_html["attachment-ref"]
-            )
-            file = await (
-                await http_session.get(
-                    attachment_url,
-                    timeout=HTTP_FILE_LOAD_TIMEOUT_SEC,
-                )
-            ).read()
+            attachment_url = BASE_URL + attachment_html["attachment-ref"]
             name = attachment_html["attachment-name"]
+            size = known_sizes.get(name)
+            if size is not None and size > max_size:
+                # the message structure tells the size, so the file is not requested
+                skip_attachment(size)
+                file = None
+            else:
+                (file, size) = await download_attachment(http_session, attachment_url)
+            if file is None:
+                log.info(f"skipping attachment {name} of {size} bytes")
+                skipped_attachments.append((name, size))
+                continue
             attachments.append((file, name))
+        if len(skipped_attachments) > 0:
+            text += "\n\n" + "\n".join(
+                make_skipped_attachment_notice(name, size)
+                for (name, size) in skipped_attachments
+            )
         return MailBody(text, attachments)
 
 
+@instrumented
+async def download_attachment(
+    http_session: ClientSession, url: str
+) -> tuple[bytes | None, int | None]:
+    max_size = env.get_attachment_max_size_bytes()
+    response = await http_session.get(url, timeout=HTTP_FILE_LOAD_TIMEOUT_SEC)
+    # the size is known from the headers, so the body is not read when it is too large
+    size = response.content_length
+    if size is not None and size > max_size:
+        response.close()
+        skip_attachment(size)
+        return (None, size)
+    # a chunked response has no length, its read stops at the limit
+    file = bytearray()
+    async for chunk in response.content.iter_chunked(ATTACHMENT_READ_CHUNK_BYTES):
+        file += chunk
+        if len(file) > max_size:
+            response.close()
+            skip_attachment(None)
+            return (None, size)
+    return (bytes(file), len(file))
+
+
+@governed()
 async def mark_as_read(
     context: SamowarePollingContext, uid: str
 ) -> SamowarePollingContext:
-    url = f"https://student.bmstu.ru/Session/{context.session}/sync?reqSeq={context.request_id}&random={context.rand}"
+    url = f"{BASE_URL}/Session/{context.session}/sync?reqSeq={context.request_id}&random={context.rand}"
     data = f'<XIMSS><messageMark flags="Read" folder="INBOX-MM-1" id="{context.command_id}"><UID>{uid}</UID></messageMark></XIMSS>'
     async with ClientSession(
         timeout=ClientTimeout(sock_read=HTTP_COMMON_TIMEOUT_SEC),
         cookies=context.cookies,
+        trace_configs=TRACE_CONFIGS,
     ) as http_session:
         response = await http_session.post(url=url, data=data)
         metrics.samoware_response_status_code_metric.labels(sc=response.status).inc()
@@ -492,8 +773,23 @@ async def mark_as_read(
         )
 
 
+def normalize_plain_text(text: str) -> str:
+    # unlike html, every line break of a plain text part is meant as it is
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return re.sub(r"(\n){3,}", "\n\n", text).strip()
+
+
+def normalize_text(text: str) -> str:
+    text = re.sub(r"(\r)+", "\r", text).strip()
+    text = re.sub(r"(\n)+", "\n", text).strip()
+    text = text.replace("\r", "\n\n")
+    if AGGRESSIVE_FORMAT_LETTER:
+        text = text.replace("\n\xa0\n", "\n\n")
+    return re.sub(r"(\n){2,}", "\n\n", text).strip()
+
+
 def html_element_to_text(element):
-    log.debug(f"converting html element to text: {element}")
+    log.debug("converting html element to text: %s", LazyPayload(element))
     if isinstance(element, bs.NavigableString):
         return html.escape(
             re.sub(
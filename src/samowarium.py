@@ -1,38 +1,73 @@
 #!/bin/python3
 
-import logging.handlers
 from telegram_bot import TelegramBot
 from prometheus_client import start_http_server
 import asyncio
+import multiprocessing
 
 import logging
 import signal
 
-from metrics import GATHER_METRIC_DELAY_SEC, users_amount_metric, log_metric
-from const import LOGGER_FOLDER_PATH, LOGGER_PATH
+from metrics import GATHER_METRIC_DELAY_SEC, users_amount_metric
+from accounting import accountant
+from admin import AdminServer
+from const import LOGGER_FOLDER_PATH, LOGGER_PATH, LOGGER_WORKER_PATH_FORMAT
 from database import Database
 from encryption import Encrypter
+from loop_monitor import LoopMonitor
+from shard import Shard, ShardRouter
+from tracing import tracer
 import env
+import log_pipeline
+import supervisor
 import util
 
 
 class Application:
+    def __init__(self, shard: Shard = Shard(), router: ShardRouter | None = None):
+        self.shard = shard
+        self.router = router
+
     async def start(self) -> None:
         self.encrypter = Encrypter()
         self.db = Database(self.encrypter)
         await self.db.open()
-        self.bot = TelegramBot(self.db)
+        self.bot = TelegramBot(self.db, self.shard, self.router)
         await self.bot.start_bot()
         self.gathering_metric_task = asyncio.create_task(
             self.gather_users_amount_metric()
         )
+        self.admin_server = None
+        if env.is_admin_server_enabled():
+            # every worker gets its own port
+            self.admin_server = AdminServer(
+                env.get_admin_server_port() + self.shard.index
+            )
+            await self.admin_server.start()
+        self.accounting_task = asyncio.create_task(accountant.run())
+        self.tracer_task = None
+        if env.is_tracing_enabled():
+            self.tracer_task = asyncio.create_task(
+                tracer.run(self.shard.index if self.shard.count > 1 else None)
+            )
+        self.loop_monitor_task = None
+        if env.is_loop_monitor_enabled():
+            self.loop_monitor_task = asyncio.create_task(LoopMonitor().run())
         self.setupShutdown(asyncio.get_event_loop())
 
     def setupShutdown(self, event_loop: asyncio.AbstractEventLoop):
         async def shutdown(signal) -> None:
             logging.info(f"received exit signal {signal}")
             self.gathering_metric_task.cancel()
+            self.accounting_task.cancel()
+            if self.loop_monitor_task is not None:
+                self.loop_monitor_task.cancel()
             await self.bot.stop_bot()
+            if self.tracer_task is not None:
+                # exports the spans of the stopped handlers
+                self.tracer_task.cancel()
+            if self.admin_server is not None:
+                await self.admin_server.stop()
             await self.db.close()
             logging.info("application has stopped successfully")
 
@@ -42,6 +77,8 @@ class Application:
             )
 
     async def gather_users_amount_metric(self):
+        if not self.shard.is_bot_worker():
+            return
         try:
             while self.db.is_open():
                 users = await self.db.get_all_users_stat()
@@ -62,41 +99,48 @@ class Application:
             pass
 
 
-def setup_logger():
+def setup_logger(shard: Shard | None = None):
     LOGGER_LEVEL = logging.INFO
     if env.is_debug():
         LOGGER_LEVEL = logging.DEBUG
     util.make_dir_if_not_exist(LOGGER_FOLDER_PATH)
-    logging.basicConfig(
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        filename=LOGGER_PATH,
-        encoding="utf-8",
-        level=LOGGER_LEVEL,
+    log_pipeline.start(
+        (
+            LOGGER_PATH
+            if shard is None
+            else LOGGER_WORKER_PATH_FORMAT.format(shard.index)
+        ),
+        LOGGER_LEVEL,
     )
     logging.getLogger("httpx").setLevel(logging.WARN)
     if env.is_prod_profile():
         logging.getLogger("telegram.ext.Updater").setLevel(logging.CRITICAL)
 
-    class MetricsHandler(logging.Handler):
-        def emit(self, record):
-            log_metric.labels(level=record.levelname).inc()
-
-    logging.getLogger("root").addHandler(MetricsHandler())
-
 
-async def main() -> None:
-    setup_logger()
-    if env.is_prometheus_metrics_server_enabled():
+async def main(shard: Shard = Shard(), router: ShardRouter | None = None) -> None:
+    if env.is_prometheus_metrics_server_enabled() and router is None:
         port = env.get_prometheus_metrics_server_port()
         logging.info(f"starting the metrics server on {port} port...")
         start_http_server(port)
-    logging.info("starting the application...")
-    app = Application()
+    logging.info(f"starting the application (shard {shard})...")
+    app = Application(shard, router)
     await app.start()
     await asyncio.gather(
         *[task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
     )
 
 
+def run_worker(shard: Shard, inboxes: list[multiprocessing.Queue]) -> None:
+    setup_logger(shard)
+    asyncio.run(main(shard, ShardRouter(shard, inboxes)))
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    setup_logger()
+    workers_count = env.get_workers_count()
+    if workers_count > 1 and env.is_leasing_enabled():
+        raise EnvironmentError("WORKERS and LEASING can not be used together")
+    if workers_count > 1:
+        supervisor.run(workers_count, run_worker)
+    else:
+        asyncio.run(main())
@@ -0,0 +1,57 @@
+import asyncio
+import logging as log
+import multiprocessing
+import queue
+from typing import Awaitable, Callable
+
+BOT_WORKER_INDEX = 0
+INBOX_POLL_TIMEOUT_SEC = 1
+
+START_HANDLER_COMMAND = "start"
+STOP_HANDLER_COMMAND = "stop"
+
+
+class Shard:
+    def __init__(self, index: int = 0, count: int = 1) -> None:
+        self.index = index
+        self.count = count
+
+    def owner(self, telegram_id: int) -> int:
+        return telegram_id % self.count
+
+    def owns(self, telegram_id: int) -> bool:
+        return self.owner(telegram_id) == self.index
+
+    def is_bot_worker(self) -> bool:
+        return self.index == BOT_WORKER_INDEX
+
+    def __str__(self) -> str:
+        return f"{self.index}/{self.count}"
+
+
+class ShardRouter:
+    def __init__(self, shard: Shard, inboxes: list[multiprocessing.Queue]) -> None:
+        self.shard = shard
+        self.inboxes = inboxes
+
+    def send(self, telegram_id: int, command: str) -> None:
+        owner = self.shard.owner(telegram_id)
+        log.debug(f"routing {command} for {telegram_id} to worker {owner}")
+        self.inboxes[owner].put((command, telegram_id))
+
+    async def listen(self, on_command: Callable[[str, int], Awaitable[None]]) -> None:
+        inbox = self.inboxes[self.shard.index]
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                # the timeout lets the executor thread finish on shutdown
+                (command, telegram_id) = await loop.run_in_executor(
+                    None, inbox.get, True, INBOX_POLL_TIMEOUT_SEC
+                )
+            except queue.Empty:
+                continue
+            log.debug(f"received routed {command} for {telegram_id}")
+            try:
+                await on_command(command, telegram_id)
+            except Exception:
+                log.exception(f"can not handle routed {command} for {telegram_id}")
@@ -0,0 +1,85 @@
+import asyncio
+import logging as log
+import random
+import time
+from typing import AsyncIterator, Awaitable, Callable
+
+from client_handler import UserHandler
+from context import Context
+import env
+from metrics import (
+    startup_handlers_online_metric,
+    startup_handlers_starting_metric,
+    startup_duration_metric,
+)
+
+HANDLER_ONLINE_TIMEOUT_SEC = 30
+
+
+class StartupScheduler:
+    def __init__(
+        self,
+        start_handler: Callable[[Context], Awaitable[UserHandler]],
+        rate: float | None = None,
+        jitter_sec: float | None = None,
+        concurrency: int | None = None,
+    ) -> None:
+        self.start_handler = start_handler
+        self.rate = env.get_startup_rate() if rate is None else rate
+        self.jitter_sec = (
+            env.get_startup_jitter_sec() if jitter_sec is None else jitter_sec
+        )
+        self.semaphore = asyncio.Semaphore(
+            env.get_startup_concurrency() if concurrency is None else concurrency
+        )
+        self.tasks: set[asyncio.Task] = set()
+        self.online_count = 0
+
+    async def run(self, contexts: AsyncIterator[Context]) -> None:
+        log.info(
+            f"starting handlers with rate={self.rate}/s, jitter={self.jitter_sec}s"
+        )
+        started_at = time.monotonic()
+        scheduled = 0
+        startup_handlers_online_metric.set(0)
+        try:
+            async for context in contexts:
+                await self.semaphore.acquire()
+                task = asyncio.create_task(self.bring_online(context))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+                scheduled += 1
+                if self.rate > 0:
+                    await asyncio.sleep(1 / self.rate)
+            await asyncio.gather(*self.tasks)
+        except asyncio.CancelledError:
+            for task in self.tasks:
+                task.cancel()
+            raise
+        duration = time.monotonic() - started_at
+        startup_duration_metric.set(duration)
+        log.info(
+            f"{self.online_count} of {scheduled} handlers are online in {duration:.1f} seconds"
+        )
+
+    async def bring_online(self, context: Context) -> None:
+        try:
+            await asyncio.sleep(random.uniform(0, self.jitter_sec))
+            startup_handlers_starting_metric.inc()
+            try:
+                handler = await self.start_handler(context)
+            finally:
+                startup_handlers_starting_metric.dec()
+        finally:
+            # waiting for the first poll does not hold the slot
+            self.semaphore.release()
+        try:
+            await asyncio.wait_for(
+                handler.wait_online(), timeout=HANDLER_ONLINE_TIMEOUT_SEC
+            )
+            self.online_count += 1
+            startup_handlers_online_metric.inc()
+        except asyncio.TimeoutError:
+            log.warning(
+                f"handler for {context.samoware_login} is not online in {HANDLER_ONLINE_TIMEOUT_SEC} seconds"
+            )
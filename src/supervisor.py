@@ -0,0 +1,78 @@
+import logging as log
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+from typing import Callable
+
+from prometheus_client import CollectorRegistry, start_http_server
+from prometheus_client import multiprocess
+
+from shard import Shard
+import env
+
+WORKER_JOIN_TIMEOUT_SEC = 1
+WORKER_RESTART_DELAY_SEC = 5
+
+WorkerTarget = Callable[[Shard, list[multiprocessing.Queue]], None]
+
+
+def run(workers_count: int, target: WorkerTarget) -> None:
+    metrics_dir = tempfile.mkdtemp(prefix="samowarium-metrics-")
+    # must be set before the workers import prometheus_client
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = metrics_dir
+    if env.is_prometheus_metrics_server_enabled():
+        port = env.get_prometheus_metrics_server_port()
+        log.info(f"starting the aggregated metrics server on {port} port...")
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=metrics_dir)
+        start_http_server(port, registry=registry)
+
+    mp = multiprocessing.get_context("spawn")
+    inboxes = [mp.Queue() for _ in range(workers_count)]
+    workers: dict[int, multiprocessing.Process] = {}
+    is_stopping = False
+
+    def start_worker(index: int) -> None:
+        worker = mp.Process(
+            target=target,
+            args=(Shard(index, workers_count), inboxes),
+            name=f"samowarium-worker-{index}",
+        )
+        worker.start()
+        workers[index] = worker
+        log.info(f"worker {index} has started with pid {worker.pid}")
+
+    def stop_workers(signum, frame) -> None:
+        nonlocal is_stopping
+        log.info(f"received exit signal {signum}, stopping workers...")
+        is_stopping = True
+        for worker in workers.values():
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+
+    for s in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(s, stop_workers)
+
+    log.info(f"starting {workers_count} workers...")
+    for index in range(workers_count):
+        start_worker(index)
+
+    while len(workers) > 0:
+        for index, worker in list(workers.items()):
+            worker.join(WORKER_JOIN_TIMEOUT_SEC)
+            if worker.is_alive():
+                continue
+            multiprocess.mark_process_dead(worker.pid)
+            del workers[index]
+            if is_stopping:
+                log.info(f"worker {index} has stopped")
+                continue
+            log.error(
+                f"worker {index} has exited with code {worker.exitcode}, restarting in {WORKER_RESTART_DELAY_SEC} seconds..."
+            )
+            time.sleep(WORKER_RESTART_DELAY_SEC)
+            if not is_stopping:
+                start_worker(index)
+    log.info("all workers have stopped")
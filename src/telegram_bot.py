@@ -4,9 +4,30 @@ from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQuer
 import logging as log
 from typing import Optional
 import asyncio
+from accounting import ERRORS_RESOURCE, SENDS_RESOURCE, accountant
 from client_handler import UserHandler
 from const import MARKDOWN_FORMAT, TELEGRAM_SEND_RETRY_DELAY_SEC
-from database import Database
+from context import Context
+from delivery import ATTACHMENTS_SENT_STAGE, MESSAGE_SENT_STAGE, current_delivery
+from database import (
+    USER_ADDED_EVENT,
+    USER_PARKED_EVENT,
+    USER_REMOVED_EVENT,
+    USER_UNPARKED_EVENT,
+    Database,
+)
+from leasing import LeaderElection, LeaseManager
+from notifications import UserChangesListener
+from revalidation import RevalidationScheduler
+from shard import (
+    START_HANDLER_COMMAND,
+    STOP_HANDLER_COMMAND,
+    Shard,
+    ShardRouter,
+)
+from startup import StartupScheduler
+from tracing import traced
+from webhook import TimedUpdateProcessor, WebhookServer
 import env
 import metrics
 
@@ -44,6 +65,7 @@ LOGIN_WRONG_FORMAT_PROMPT = (
     "Неверный формат использования команды:\n/login <i>логин</i> <i>пароль</i>"
 )
 WAIT_TO_AUTH_PROMPT = "Авторизация. Пожалуйста, подождите..."
+LOGIN_IN_PROGRESS_PROMPT = "Авторизация уже выполняется. Пожалуйста, подождите..."
 SAVE_PASSWORD_PROMPT = (
     "Сохранить пароль? Подробнее о хранении и использовании паролей: /about"
 )
@@ -55,6 +77,8 @@ AUTOREAD_PROMPT = (
 AUTOREAD_ON_PROMPT = "Письма будут отмечаться прочитанными автоматически."
 AUTOREAD_OFF_PROMPT = "Письма не будут отмечаться прочитанными."
 
+UNPARKED_PROMPT = "Пересылка писем возобновлена."
+
 MAX_TELEGRAM_MESSAGE_LENGTH = 4096
 
 HTTP_FILE_SEND_TIMEOUT_SEC = 60
@@ -67,8 +91,12 @@ AUTOREAD_OFF_CALLBACK = "AUTOREAD_OFF"
 
 
 class TelegramBot:
-    def __init__(self, db: Database) -> None:
+    def __init__(
+        self, db: Database, shard: Shard = Shard(), router: ShardRouter | None = None
+    ) -> None:
         self.db = db
+        self.shard = shard
+        self.router = router
         self.commands = [
             ("start", self.start_command),
             ("stop", self.stop_command),
@@ -76,6 +104,9 @@ class TelegramBot:
             ("about", self.about_command),
         ]
         self.handlers: dict[int, UserHandler] = {}
+        self.revalidation_scheduler = RevalidationScheduler()
+        self.login_jobs: dict[int, asyncio.Task] = {}
+        self.login_semaphore = asyncio.Semaphore(env.get_login_concurrency())
 
     async def callback_query_handler(
         self, update: Update, context: ContextTypes.DEFAULT_TYPE
@@ -109,17 +140,22 @@ class TelegramBot:
 
     async def start_bot(self) -> None:
         log.info("starting the bot...")
-        log.info("loading handlers...")
-        for context in await self.db.get_all_users():
-            handler = await UserHandler.make_from_context(
-                context, self.send_message, self.db
-            )
-            await handler.start_handling()
-            self.handlers[context.telegram_id] = handler
-        log.info("handlers are loaded")
-
         log.info("connecting to telegram api...")
-        self.application = Application.builder().token(env.get_telegram_token()).build()
+        builder = (
+            Application.builder()
+            .token(env.get_telegram_token())
+            .concurrent_updates(
+                TimedUpdateProcessor(env.get_telegram_concurrent_updates())
+            )
+        )
+        if env.get_telegram_api_url() is not None:
+            builder = builder.base_url(
+                env.get_telegram_api_url() + "/bot"
+            ).base_file_url(env.get_telegram_api_url() + "/file/bot")
+        self.application = builder.build()
+        self.webhook_server = None
+        if env.is_telegram_webhook_enabled():
+            self.webhook_server = WebhookServer(self.application)
 
         for command, handler in self.commands:
             self.application.add_handler(CommandHandler(command, handler))
@@ -127,17 +163,125 @@ class TelegramBot:
 
         await self.application.initialize()
         await self.application.start()
+        self.lease_manager = None
+        self.leader_task = None
+        if env.is_leasing_enabled():
+            self.lease_manager = LeaseManager(
+                self.db, self.start_handler, self.stop_handler
+            )
+            self.leader_task = asyncio.create_task(
+                LeaderElection(self.start_updater, self.stop_updater).run()
+            )
+        elif self.shard.is_bot_worker():
+            await self.start_updater()
+        log.info("application is online")
+
+        self.router_task = None
+        if self.router is not None:
+            self.router_task = asyncio.create_task(
+                self.router.listen(self.handle_routed_command)
+            )
+        self.revalidation_task = asyncio.create_task(self.revalidation_scheduler.run())
+        self.user_changes_listener = UserChangesListener(self.db)
+        self.user_changes_listener.subscribe(self.handle_user_change)
+        self.listener_task = asyncio.create_task(self.user_changes_listener.run())
+        log.info("loading handlers...")
+        if self.lease_manager is not None:
+            self.loading_task = asyncio.create_task(self.lease_manager.run())
+        else:
+            self.loading_task = asyncio.create_task(
+                StartupScheduler(self.start_handler).run(
+                    self.db.iterate_all_users(self.shard.count, self.shard.index)
+                )
+            )
+
+    async def start_updater(self) -> None:
+        if self.webhook_server is not None:
+            log.info("starting telegram webhook...")
+            await self.webhook_server.start()
+            return
         log.info("starting telegram polling...")
         await self.application.updater.start_polling()
-        log.info("application is online")
+
+    async def stop_updater(self) -> None:
+        if self.webhook_server is not None:
+            if self.webhook_server.is_running():
+                log.info("stopping telegram webhook...")
+                await self.webhook_server.stop()
+            return
+        if self.application.updater.running:
+            log.info("stopping telegram polling...")
+            await self.application.updater.stop()
+
+    async def start_handler(self, context: Context) -> UserHandler:
+        handler = self.handlers.get(context.telegram_id)
+        if handler is not None and not handler.get_polling_task().done():
+            log.debug(f"handler for {context.telegram_id} is already started")
+            return handler
+        handler = await UserHandler.make_from_context(
+            context, self.send_message, self.db, self.revalidation_scheduler
+        )
+        self.handlers[context.telegram_id] = handler
+        await handler.start_handling()
+        return handler
+
+    async def stop_handler(self, telegram_id: int) -> None:
+        if telegram_id in self.handlers:
+            await self.handlers.pop(telegram_id).stop_handling()
+        # the lease manager forgets a lease before stopping its handler,
+        # a lease that is still owned here belongs to a stopped user
+        if self.lease_manager is not None:
+            await self.lease_manager.release(telegram_id)
+
+    async def handle_routed_command(self, command: str, telegram_id: int) -> None:
+        if command == START_HANDLER_COMMAND:
+            context = await self.db.get_samoware_context(telegram_id)
+            if context is not None:
+                await self.start_handler(context)
+        elif command == STOP_HANDLER_COMMAND:
+            await self.stop_handler(telegram_id)
+        else:
+            log.error(f"unknown routed command {command}")
+
+    async def handle_user_change(self, telegram_id: int, event: str) -> None:
+        if event in (USER_REMOVED_EVENT, USER_PARKED_EVENT):
+            await self.stop_handler(telegram_id)
+        elif event in (USER_ADDED_EVENT, USER_UNPARKED_EVENT):
+            if self.lease_manager is not None:
+                # every node is notified, only the one that gets the lease starts the user
+                if not await self.lease_manager.adopt(telegram_id):
+                    return
+            elif not self.shard.owns(telegram_id):
+                return
+            context = await self.db.get_samoware_context(telegram_id)
+            if context is not None:
+                await self.start_handler(context)
 
     async def stop_bot(self):
+        self.listener_task.cancel()
+        if self.router_task is not None:
+            self.router_task.cancel()
+        if self.leader_task is not None:
+            self.leader_task.cancel()
+            await asyncio.wait([self.leader_task])
+        if not self.loading_task.done():
+            log.info("interrupting loading of handlers...")
+            self.loading_task.cancel()
+            await asyncio.wait([self.loading_task])
+        if len(self.login_jobs) > 0:
+            log.info("cancelling login jobs...")
+            for job in list(self.login_jobs.values()):
+                job.cancel()
+            await asyncio.wait(list(self.login_jobs.values()))
         log.info("shutting down handlers...")
         await asyncio.gather(
             *[handler.stop_handling() for handler in self.handlers.values()]
         )
+        if self.lease_manager is not None:
+            await self.lease_manager.release_all()
+        self.revalidation_task.cancel()
         log.info("shutting down the bot...")
-        await self.application.updater.stop()
+        await self.stop_updater()
         await self.application.stop()
         await self.application.shutdown()
         log.info("telegram bot is shutted down")
@@ -147,6 +291,10 @@ class TelegramBot:
     ) -> None:
         log.debug(f"received /start from {update.effective_user.id}")
         metrics.incoming_commands_metric.labels(command_name="start").inc()
+        if await self.db.unpark_user(update.effective_user.id):
+            log.info(f"user {update.effective_user.id} is unparked")
+            await update.message.reply_markdown(UNPARKED_PROMPT)
+            return
         await update.message.reply_markdown(START_PROMPT)
 
     async def stop_command(
@@ -154,7 +302,10 @@ class TelegramBot:
     ) -> None:
         log.debug(f"received /stop from {update.effective_user.id}")
         telegram_id = update.effective_user.id
-        await self.handlers[telegram_id].stop_handling()
+        if self.shard.owns(telegram_id):
+            await self.stop_handler(telegram_id)
+        else:
+            self.router.send(telegram_id, STOP_HANDLER_COMMAND)
         await self.db.remove_user(
             telegram_id
         )  # TODO: не удалять запись, а удалять только контекст и пароль
@@ -172,19 +323,76 @@ class TelegramBot:
             )
             await update.message.reply_html(LOGIN_WRONG_FORMAT_PROMPT)
             return
-        wait_message = await update.message.reply_markdown(WAIT_TO_AUTH_PROMPT)
         telegram_id = update.effective_user.id
+        job = self.login_jobs.get(telegram_id)
+        if job is not None and not job.done():
+            log.debug(f"login for {telegram_id} is already in progress")
+            await update.message.reply_markdown(LOGIN_IN_PROGRESS_PROMPT)
+            return
+        wait_message = await update.message.reply_markdown(WAIT_TO_AUTH_PROMPT)
         samoware_login = context.args[0]
         samoware_password = context.args[1]
         log.debug(f'user entered login "{samoware_login}" and password')
+        # the login can take a while, so it does not hold the update processing
+        self.login_jobs[telegram_id] = asyncio.create_task(
+            self.login_job(
+                telegram_id,
+                update.effective_chat.id,
+                [update.effective_message.id, wait_message.id],
+                samoware_login,
+                samoware_password,
+            )
+        )
+        metrics.login_jobs_metric.set(len(self.login_jobs))
+
+    async def login_job(
+        self,
+        telegram_id: int,
+        chat_id: int,
+        message_ids: list[int],
+        samoware_login: str,
+        samoware_password: str,
+    ) -> None:
+        try:
+            async with self.login_semaphore:
+                await self.login_user(
+                    telegram_id, chat_id, samoware_login, samoware_password
+                )
+            await self.application.bot.delete_messages(chat_id, message_ids)
+        except asyncio.CancelledError:
+            log.info(f"login job for {telegram_id} is cancelled")
+        except Exception:
+            log.exception(f"exception in login job for {telegram_id}")
+        finally:
+            self.login_jobs.pop(telegram_id, None)
+            metrics.login_jobs_metric.set(len(self.login_jobs))
+
+    async def login_user(
+        self,
+        telegram_id: int,
+        chat_id: int,
+        samoware_login: str,
+        samoware_password: str,
+    ) -> None:
         new_handler = await UserHandler.make_new(
-            telegram_id, samoware_login, samoware_password, self.send_message, self.db
+            telegram_id,
+            samoware_login,
+            samoware_password,
+            self.send_message,
+            self.db,
+            self.revalidation_scheduler,
         )
         if new_handler is not None:
-            await new_handler.start_handling()
-            self.handlers[telegram_id] = new_handler
+            if self.lease_manager is not None:
+                # the node holding the lease keeps handling the user otherwise
+                if await self.lease_manager.adopt(telegram_id):
+                    await self.start_handler(new_handler.context)
+            elif self.shard.owns(telegram_id):
+                await self.start_handler(new_handler.context)
+            else:
+                self.router.send(telegram_id, START_HANDLER_COMMAND)
             await self.application.bot.send_message(
-                update.effective_chat.id,
+                chat_id,
                 SAVE_PASSWORD_PROMPT,
                 parse_mode=MARKDOWN_FORMAT,
                 reply_markup=telegram.InlineKeyboardMarkup(
@@ -208,7 +416,7 @@ class TelegramBot:
                 ),
             )
             await self.application.bot.send_message(
-                update.effective_chat.id,
+                chat_id,
                 AUTOREAD_PROMPT,
                 parse_mode=MARKDOWN_FORMAT,
                 reply_markup=telegram.InlineKeyboardMarkup(
@@ -225,9 +433,6 @@ class TelegramBot:
                     ]
                 ),
             )
-        await self.application.bot.delete_messages(
-            update.effective_chat.id, [update.effective_message.id, wait_message.id]
-        )
 
     async def about_command(
         self, update: Update, context: ContextTypes.DEFAULT_TYPE
@@ -238,6 +443,7 @@ class TelegramBot:
             disable_web_page_preview=True,
         )
 
+    @traced
     async def send_message(
         self,
         telegram_id: int,
@@ -246,6 +452,7 @@ class TelegramBot:
         attachments: Optional[list[tuple[bytes, str]]] = None,
     ) -> None:
         is_sent = False
+        delivery = current_delivery.get()
         log.debug(f"sending a message to {telegram_id} ...")
         metrics.sent_message_metric.inc()
         while not is_sent:
@@ -257,21 +464,34 @@ class TelegramBot:
                     await self.application.bot.send_message(
                         telegram_id, message_part, parse_mode=format
                     )
+                if delivery is not None:
+                    delivery.stage(MESSAGE_SENT_STAGE)
                 if attachments is not None:
                     await self.send_attachments(telegram_id, attachments)
+                    if delivery is not None:
+                        delivery.stage(ATTACHMENTS_SENT_STAGE)
+                if delivery is not None:
+                    delivery.delivered()
+                accountant.account(SENDS_RESOURCE, telegram_id=telegram_id)
                 is_sent = True
                 log.info(f"sent message to {telegram_id}")
+            except telegram.error.Forbidden as error:
+                await self.park_blocked_user(telegram_id, error)
+                break
             except telegram.error.BadRequest as error:
                 log.exception("exception in send_message:\n" + str(error))
                 log.info("error is bad request. Not retrying")
+                accountant.account(ERRORS_RESOURCE, telegram_id=telegram_id)
                 break
             except Exception as error:
                 log.exception("exception in send_message:\n" + str(error))
+                accountant.account(ERRORS_RESOURCE, telegram_id=telegram_id)
                 log.info(
                     f"retrying to send message for {telegram_id} in {TELEGRAM_SEND_RETRY_DELAY_SEC} seconds..."
                 )
                 await asyncio.sleep(TELEGRAM_SEND_RETRY_DELAY_SEC)
 
+    @traced
     async def send_attachments(
         self, telegram_id: int, attachments: Optional[list[tuple[bytes, str]]]
     ):
@@ -293,6 +513,9 @@ class TelegramBot:
                 )
                 sent = True
                 log.info(f"sent attachments to {telegram_id}")
+            except telegram.error.Forbidden as error:
+                await self.park_blocked_user(telegram_id, error)
+                break
             except telegram.error.BadRequest as error:
                 log.exception("exception in send_attachments:\n" + str(error))
                 log.info("error is bad request. Not retrying")
@@ -303,3 +526,11 @@ class TelegramBot:
                     f"retrying to send attachments for {telegram_id} in {TELEGRAM_SEND_RETRY_DELAY_SEC} seconds..."
                 )
                 await asyncio.sleep(TELEGRAM_SEND_RETRY_DELAY_SEC)
+
+    async def park_blocked_user(
+        self, telegram_id: int, error: telegram.error.Forbidden
+    ) -> None:
+        # the parked notification stops the handler of the user
+        log.info(f"bot is blocked by {telegram_id}, parking: {str(error)}")
+        await self.db.park_user(telegram_id)
+        metrics.parked_metric.labels(reason="blocked").inc()
@@ -0,0 +1,213 @@
+import asyncio
+import functools
+import json
+import logging as log
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+import env
+from metrics import exported_spans_metric
+
+FLUSH_INTERVAL_SEC = 5
+MAX_BUFFERED_SPANS = 10000
+SERVICE_NAME = "samowarium"
+
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+def make_id(bytes_count: int) -> str:
+    return random.getrandbits(bytes_count * 8).to_bytes(bytes_count, "big").hex()
+
+
+def make_attributes(attributes: dict) -> list[dict]:
+    result = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            result.append({"key": key, "value": {"boolValue": value}})
+        elif isinstance(value, int):
+            # int64 is a string in otlp json
+            result.append({"key": key, "value": {"intValue": str(value)}})
+        else:
+            result.append({"key": key, "value": {"stringValue": str(value)}})
+    return result
+
+
+class Span:
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_span_id: str | None,
+        attributes: dict,
+        links: list["Span"],
+    ) -> None:
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = make_id(8)
+        self.parent_span_id = parent_span_id
+        self.attributes = attributes
+        self.links = links
+        self.start_ns = time.time_ns()
+        self.end_ns = self.start_ns
+        self.error: str | None = None
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": make_attributes(self.attributes),
+            "status": (
+                {"code": STATUS_OK}
+                if self.error is None
+                else {"code": STATUS_ERROR, "message": self.error}
+            ),
+        }
+        if self.parent_span_id is not None:
+            span["parentSpanId"] = self.parent_span_id
+        if len(self.links) > 0:
+            span["links"] = [
+                {"traceId": link.trace_id, "spanId": link.span_id}
+                for link in self.links
+            ]
+        return span
+
+
+current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+
+# finished spans are appended to the file as one OTLP/JSON export request per line
+class Tracer:
+    def __init__(self) -> None:
+        self.sample_rate = env.get_tracing_sample_rate()
+        self.path = env.get_tracing_file_path()
+        self.finished: list[Span] = []
+
+    @contextmanager
+    def trace(
+        self, name: str, attributes: dict, links: list[Span | None] | None = None
+    ) -> Iterator[Span | None]:
+        # the sampling decision is made once for the whole trace
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            token = current_span.set(None)
+            try:
+                yield None
+            finally:
+                current_span.reset(token)
+            return
+        with self.start_span(
+            name,
+            make_id(16),
+            None,
+            attributes,
+            [link for link in links or [] if link is not None],
+        ) as span:
+            yield span
+
+    @contextmanager
+    def span(self, name: str, attributes: dict | None = None) -> Iterator[Span | None]:
+        parent = current_span.get()
+        if parent is None:
+            yield None
+            return
+        with self.start_span(
+            name, parent.trace_id, parent.span_id, dict(attributes or {}), []
+        ) as span:
+            yield span
+
+    @contextmanager
+    def start_span(
+        self,
+        name: str,
+        trace_id: str,
+        parent_span_id: str | None,
+        attributes: dict,
+        links: list[Span],
+    ) -> Iterator[Span]:
+        span = Span(name, trace_id, parent_span_id, attributes, links)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as error:
+            span.error = type(error).__name__
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            current_span.reset(token)
+            self.finish(span)
+
+    def finish(self, span: Span) -> None:
+        if len(self.finished) >= MAX_BUFFERED_SPANS:
+            exported_spans_metric.labels(result="dropped").inc()
+            return
+        self.finished.append(span)
+
+    async def run(self, worker_index: int | None = None) -> None:
+        if worker_index is not None:
+            # the workers do not share a file, their lines could interleave
+            (root, extension) = os.path.splitext(self.path)
+            self.path = f"{root}-{worker_index}{extension}"
+        log.info(f"exporting traces to {self.path}, sample rate {self.sample_rate}")
+        try:
+            while True:
+                await asyncio.sleep(FLUSH_INTERVAL_SEC)
+                (spans, self.finished) = (self.finished, [])
+                await asyncio.to_thread(self.export, spans)
+        finally:
+            (spans, self.finished) = (self.finished, [])
+            self.export(spans)
+
+    def export(self, spans: list[Span]) -> None:
+        if len(spans) == 0:
+            return
+        request = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": make_attributes(
+                            {
+                                "service.name": SERVICE_NAME,
+                                "service.version": env.get_version(),
+                                "process.pid": os.getpid(),
+                            }
+                        )
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": SERVICE_NAME},
+                            "spans": [span.to_otlp() for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        try:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(request) + "\n")
+            exported_spans_metric.labels(result="exported").inc(len(spans))
+        except OSError:
+            log.exception(f"can not export {len(spans)} spans")
+            exported_spans_metric.labels(result="dropped").inc(len(spans))
+
+
+tracer = Tracer()
+
+
+def traced(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with tracer.span(func.__name__):
+            return await func(*args, **kwargs)
+
+    return wrapper
@@ -1,8 +1,10 @@
 from http.client import HTTPResponse
 import os
-from typing import Awaitable, Callable, Optional
+from typing import Any, Awaitable, Callable, Optional
 import logging as log
 
+from const import DEBUG_PAYLOAD_MAX_LENGTH
+
 MessageSender = Callable[
     [int, str, str, Optional[list[tuple[HTTPResponse, str]]]], Awaitable[None]
 ]
@@ -12,3 +14,15 @@ def make_dir_if_not_exist(path):
     if not os.path.exists(path):
         log.debug(f"creates dir {path}")
         os.makedirs(path)
+
+
+class LazyPayload:
+    def __init__(self, value: Any, formatter: Callable[[Any], str] = str) -> None:
+        self.value = value
+        self.formatter = formatter
+
+    def __str__(self) -> str:
+        text = self.formatter(self.value)
+        if len(text) <= DEBUG_PAYLOAD_MAX_LENGTH:
+            return text
+        return f"{text[:DEBUG_PAYLOAD_MAX_LENGTH]}... ({len(text) - DEBUG_PAYLOAD_MAX_LENGTH} more characters)"
@@ -0,0 +1,93 @@
+import hmac
+import logging as log
+import secrets
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable
+from urllib.parse import urlparse
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application, SimpleUpdateProcessor
+
+import env
+from metrics import (
+    update_delay_metric,
+    update_processing_duration_metric,
+    webhook_request_metric,
+)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class TimedUpdateProcessor(SimpleUpdateProcessor):
+    async def do_process_update(
+        self, update: object, coroutine: Awaitable[Any]
+    ) -> None:
+        # callback queries carry the date of the message with the buttons
+        if isinstance(update, Update) and update.message is not None:
+            update_delay_metric.observe(
+                (datetime.now(timezone.utc) - update.message.date).total_seconds()
+            )
+        started_at = time.perf_counter()
+        try:
+            await coroutine
+        finally:
+            update_processing_duration_metric.observe(time.perf_counter() - started_at)
+
+
+class WebhookServer:
+    def __init__(self, application: Application) -> None:
+        self.application = application
+        self.url = env.get_telegram_webhook_url()
+        self.path = urlparse(self.url).path or "/"
+        self.host = env.get_telegram_webhook_host()
+        self.port = env.get_telegram_webhook_port()
+        self.max_connections = env.get_telegram_webhook_max_connections()
+        self.secret_token = env.get_telegram_webhook_secret()
+        if self.secret_token is None:
+            # only telegram has to know it, the webhook is set on every start
+            self.secret_token = secrets.token_urlsafe(32)
+        self.runner: web.AppRunner | None = None
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        log.info(f"listening to telegram webhook on {self.host}:{self.port}{self.path}")
+        await self.application.bot.set_webhook(
+            self.url,
+            max_connections=self.max_connections,
+            secret_token=self.secret_token,
+        )
+        log.info(f"telegram webhook is set to {self.url}")
+
+    async def stop(self) -> None:
+        # the webhook itself is kept, the next leader or polling replaces it
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+            log.info("telegram webhook server is stopped")
+
+    def is_running(self) -> bool:
+        return self.runner is not None
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        token = request.headers.get(SECRET_TOKEN_HEADER, "")
+        if not hmac.compare_digest(token, self.secret_token):
+            log.warning(
+                f"webhook request from {request.remote} with a wrong secret token"
+            )
+            webhook_request_metric.labels(result="forbidden").inc()
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), self.application.bot)
+        except Exception:
+            log.exception("can not parse webhook update")
+            webhook_request_metric.labels(result="bad_request").inc()
+            return web.Response(status=400)
+        await self.application.update_queue.put(update)
+        webhook_request_metric.labels(result="accepted").inc()
+        return web.Response()